@@ -0,0 +1,102 @@
+"""
+Compare the write and read throughput and the file sizes of photon and
+event files written with different HDF5 chunking and compression options,
+using the beta-model dataset from the tests.
+
+Run with:
+
+    python benchmarks/io_benchmark.py [--radius 500] [--exp-time 500]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from yt.units.yt_array import YTQuantity
+from yt.utilities.physical_constants import mp
+from pyxsim import PowerLawSourceModel, PhotonList, EventList, \
+    HDF5Options, merge_files
+from pyxsim.tests.utils import BetaModelSource
+
+options = OrderedDict()
+options["contiguous"] = HDF5Options(chunk_size=None, compression=None, shuffle=False)
+options["chunked"] = HDF5Options(compression=None, shuffle=False)
+options["default"] = HDF5Options()
+options["gzip-6"] = HDF5Options(compression_level=6)
+options["lzf"] = HDF5Options(compression="lzf")
+options["gzip-single"] = HDF5Options(precision="single")
+options["small-chunks"] = HDF5Options(chunk_size=16384)
+options["fletcher32"] = HDF5Options(fletcher32=True)
+
+def make_photons(radius, exp_time):
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    sphere = ds.sphere("c", (radius, "kpc"))
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission", 1.1, prng=41)
+    return PhotonList.from_data_source(sphere, 0.01, (2000., "cm**2"),
+                                       (exp_time, "ks"), plaw_model, center="c")
+
+def timeit(func, repeats=3):
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        func()
+        times.append(time.time()-t0)
+    return min(times)
+
+def run(radius, exp_time, repeats):
+    photons = make_photons(radius, exp_time)
+    events = photons.project_photons("z", prng=24)
+    row = "%-14s %-7s %10s %12s %12s %12s"
+    print("%d cells, %d photons, %d events" % (photons.num_cells,
+                                              photons.p_bins[-1],
+                                              events.num_events))
+    print(row % ("options", "file", "size (MB)", "write (MB/s)",
+                 "read (MB/s)", "merge (s)"))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmpdir, "plain_photons.h5")
+        photons.write_h5_file(plain, io_options=options["contiguous"])
+        # Throughputs are relative to the size of the uncompressed data
+        photon_mb = os.path.getsize(plain)/1.0e6
+        plain = os.path.join(tmpdir, "plain_events.h5")
+        events.write_h5_file(plain, io_options=options["contiguous"])
+        event_mb = os.path.getsize(plain)/1.0e6
+        for name, io_options in options.items():
+            photon_file = os.path.join(tmpdir, "%s_photons.h5" % name)
+            event_file = os.path.join(tmpdir, "%s_events.h5" % name)
+            merged_file = os.path.join(tmpdir, "%s_merged.h5" % name)
+            t_write = timeit(lambda: photons.write_h5_file(photon_file, io_options=io_options),
+                             repeats)
+            t_read = timeit(lambda: PhotonList.from_file(photon_file), repeats)
+            print(row % (name, "photons", "%.2f" % (os.path.getsize(photon_file)/1.0e6),
+                         "%.1f" % (photon_mb/t_write), "%.1f" % (photon_mb/t_read), ""))
+            t_write = timeit(lambda: events.write_h5_file(event_file, io_options=io_options),
+                             repeats)
+            t_read = timeit(lambda: EventList.from_h5_file(event_file), repeats)
+            t_merge = timeit(lambda: merge_files([event_file]*2, merged_file, clobber=True,
+                                                 add_exposure_times=True,
+                                                 io_options=io_options), repeats)
+            print(row % ("", "events", "%.2f" % (os.path.getsize(event_file)/1.0e6),
+                         "%.1f" % (event_mb/t_write), "%.1f" % (event_mb/t_read),
+                         "%.3f" % t_merge))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--radius", type=float, default=500.,
+                        help="The radius of the sphere of photons in kpc.")
+    parser.add_argument("--exp-time", type=float, default=500.,
+                        help="The exposure time of the photons in ks.")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="The number of times each step is timed, of which "
+                             "the fastest is kept.")
+    args = parser.parse_args()
+    run(args.radius, args.exp_time, args.repeats)
@@ -4,13 +4,23 @@ from pyxsim.source_models import \
    SourceModel, \
    ThermalSourceModel, \
    LineSourceModel, \
-   PowerLawSourceModel
+   PowerLawSourceModel, \
+   TableSpectrumSourceModel
 
 from pyxsim.photon_list import \
     PhotonList
 
+from pyxsim.photon_cache import \
+    PhotonCache
+
 from pyxsim.utils import \
-    merge_files
+    merge_files, HDF5Options
+
+from pyxsim.rng import \
+    CellKeyedPRNG
+
+from pyxsim.ragged_array import \
+    RaggedArray
 
 from pyxsim.event_list import \
     EventList
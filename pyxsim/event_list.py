@@ -14,8 +14,10 @@ from yt.utilities.parallel_tools.parallel_analysis_interface import \
 from yt.units.yt_array import YTQuantity, YTArray, uconcatenate
 from yt.utilities.on_demand_imports import _astropy
 import h5py
-from pyxsim.utils import force_unicode, validate_parameters, parse_value
+from pyxsim.utils import force_unicode, validate_parameters, parse_value, \
+    HDF5Options
 from pyxsim.responses import RedistributionMatrixFile
+from pyxsim.rng import parse_prng
 import os
 
 
@@ -104,15 +106,14 @@ class EventList(object):
         spectra : list (size N) of :class:`~yt.units.yt_array.YTArray`\s with units of photons/s/cm**2, each with shape M
             The spectra for the point sources, where M is the number of bins and N is
             the number of point sources
-        prng : :class:`~numpy.random.RandomState` object or :mod:`numpy.random`, optional
+        prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
             A pseudo-random number generator. Typically will only be specified
             if you have a reason to generate the same set of random numbers, such as for a
             test. Default is the :mod:`numpy.random` module.
         absorb_model : :class:`~pyxsim.spectral_models.AbsorptionModel`
             A model for foreground galactic absorption.
         """
-        if prng is None:
-            prng = np.random
+        prng = parse_prng(prng)
 
         spectra = ensure_list(spectra)
         positions = ensure_list(positions)
@@ -149,21 +150,20 @@ class EventList(object):
             bins
         spectrum : :class:`~yt.units.yt_array.YTArray` with units of photons/s/cm**2, size M
             The spectrum for the background, where M is the number of bins.
-        prng : :class:`~numpy.random.RandomState` object or :mod:`numpy.random`, optional
+        prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
             A pseudo-random number generator. Typically will only be specified
             if you have a reason to generate the same set of random numbers, such as for a
             test. Default is the :mod:`numpy.random` module.
         absorb_model : :class:`~pyxsim.spectral_models.AbsorptionModel`
             A model for foreground galactic absorption.
         """
-        if prng is None:
-            prng = np.random
+        prng = parse_prng(prng)
 
         eobs = self._add_events(energy_bins, spectrum, prng, absorb_model)
         ne = len(eobs)
-        x = np.random.uniform(
+        x = prng.uniform(
             low=0.5, high=2. * self.parameters["pix_center"][0] - 0.5, size=ne)
-        y = np.random.uniform(
+        y = prng.uniform(
             low=0.5, high=2. * self.parameters["pix_center"][1] - 0.5, size=ne)
 
         events = {}
@@ -309,14 +309,18 @@ class EventList(object):
         return cls(events, parameters)
 
     @parallel_root_only
-    def write_fits_file(self, fitsfile, overwrite=False):
+    def write_fits_file(self, fitsfile, overwrite=False, prng=None):
         """
         Write events to a FITS binary table file with filename *fitsfile*.
         Set *overwrite* to True if you need to overwrite a previous file.
+        The pseudo-random number generator *prng* (or a seed for one) is used
+        to generate the event times, if they are needed.
         """
         from astropy.time import Time, TimeDelta
         pyfits = _astropy.pyfits
 
+        prng = parse_prng(prng)
+
         exp_time = float(self.parameters["ExposureTime"])
 
         t_begin = Time.now()
@@ -346,7 +350,7 @@ class EventList(object):
                        "distribution. In future versions this will be made "
                        "more general.")
 
-            time = np.random.uniform(size=self.num_events, low=0.0,
+            time = prng.uniform(size=self.num_events, low=0.0,
                                      high=float(self.parameters["ExposureTime"]))
             col_t = pyfits.Column(name="TIME", format='1D', unit='s',
                                   array=time)
@@ -532,10 +536,16 @@ class EventList(object):
         wrhdu.writeto(simputfile, overwrite=overwrite)
 
     @parallel_root_only
-    def write_h5_file(self, h5file):
+    def write_h5_file(self, h5file, io_options=None):
         """
         Write an :class:`~pyxsim.event_list.EventList` to the HDF5 file given by *h5file*.
+        The datasets are chunked and compressed as set by *io_options*, an
+        :class:`~pyxsim.utils.HDF5Options` object, or by its defaults if it
+        is not given.
         """
+        if io_options is None:
+            io_options = HDF5Options()
+
         f = h5py.File(h5file, "w")
 
         p = f.create_group("parameters")
@@ -565,15 +575,15 @@ class EventList(object):
         p.create_dataset("dtheta", data=float(self.parameters["dtheta"]))
 
         d = f.create_group("data")
-        d.create_dataset("xpix", data=self["xpix"])
-        d.create_dataset("ypix", data=self["ypix"])
-        d.create_dataset("xsky", data=self["xsky"].d)
-        d.create_dataset("ysky", data=self["ysky"].d)
-        d.create_dataset("eobs", data=self["eobs"].d)
+        io_options.create_dataset(d, "xpix", self["xpix"])
+        io_options.create_dataset(d, "ypix", self["ypix"])
+        io_options.create_dataset(d, "xsky", self["xsky"].d)
+        io_options.create_dataset(d, "ysky", self["ysky"].d)
+        io_options.create_dataset(d, "eobs", self["eobs"].d)
         if "PI" in self.events:
-            d.create_dataset("pi", data=self.events["PI"])
+            io_options.create_dataset(d, "pi", self.events["PI"])
         if "PHA" in self.events:
-            d.create_dataset("pha", data=self.events["PHA"])
+            io_options.create_dataset(d, "pha", self.events["PHA"])
 
         f.close()
 
@@ -3,6 +3,7 @@ from pyxsim.event_list import EventList
 from pyxsim.responses import AuxiliaryResponseFile, \
     RedistributionMatrixFile
 from pyxsim.utils import mylog
+from pyxsim.rng import parse_prng
 from yt.funcs import get_pbar, ensure_numpy_array, \
     iterable
 from yt.units.yt_array import YTQuantity, YTArray
@@ -51,8 +52,7 @@ class InstrumentSimulator(object):
                  convolve_rmf=True, prng=None):
         new_events = EventList(deepcopy(events.events), 
                                events.parameters.copy(), events.wcs.copy())
-        if prng is None:
-            prng = np.random
+        prng = parse_prng(prng)
         if rebin:
             self.rebin(new_events)
         if convolve_psf:
@@ -90,7 +90,7 @@ class InstrumentSimulator(object):
         r"""
         Convolve the event positions with a PSF.
         """
-        dtheta = events.parameters["dtheta"]
+        dtheta = events.parameters["dtheta"].v
         psf = lambda n: prng.normal(scale=self.psf_scale/sigma_to_fwhm/dtheta, size=n)
         events.events["xpix"] += psf(events.num_events)
         events.events["ypix"] += psf(events.num_events)
@@ -110,7 +110,7 @@ class InstrumentSimulator(object):
             raise RuntimeError("The area used to create the events is less than "
                                "the maximum of the effective area curve! Re-create the "
                                "events with a collecting area higher than %s!" % arf.max_area)
-        detected = arf.detect_events(events["eobs"], events.parameters["Area"], prng=prng)
+        detected = arf.detect_events(events["eobs"].d, events.parameters["Area"], prng=prng)
         mylog.info("%s events detected." % detected.sum())
         for key in ["xpix", "ypix", "xsky", "ysky", "eobs"]:
             events.events[key] = events[key][detected]
@@ -124,8 +124,8 @@ class InstrumentSimulator(object):
         mylog.info("Reading response matrix file (RMF): %s" % self.rmf)
         rmf = RedistributionMatrixFile(self.rmf)
 
-        eidxs = np.argsort(events["eobs"])
-        sorted_e = events["eobs"][eidxs].d
+        eidxs = np.argsort(events["eobs"].d)
+        sorted_e = events["eobs"].d[eidxs]
 
         detectedChannels = []
 
@@ -0,0 +1,221 @@
+"""
+A cache of photon lists on disk, keyed by the inputs used to generate them
+"""
+import os
+import glob
+import shutil
+import hashlib
+import types
+import numbers
+import numpy as np
+import h5py
+from six import string_types
+from yt.units.yt_array import YTArray
+from yt.utilities.parallel_tools.parallel_analysis_interface import \
+    communication_system
+from pyxsim.utils import mylog
+
+comm = communication_system.communicators[-1]
+
+def hash_object(h, obj, seen=None):
+    """
+    Update the hash *h* with a description of *obj* which is the same from
+    one session to the next. Containers and arrays are hashed by their
+    contents, and other objects by their type and state, as they would be
+    pickled.
+    """
+    if seen is None:
+        seen = set()
+    h.update(type(obj).__name__.encode("utf8"))
+    if obj is None or isinstance(obj, (numbers.Number, np.number)):
+        h.update(repr(obj).encode("utf8"))
+    elif isinstance(obj, string_types):
+        h.update(obj.encode("utf8"))
+    elif isinstance(obj, bytes):
+        h.update(obj)
+    elif isinstance(obj, YTArray):
+        hash_object(h, obj.d, seen)
+        h.update(str(obj.units).encode("utf8"))
+    elif isinstance(obj, np.ndarray):
+        h.update(str(obj.dtype).encode("utf8"))
+        h.update(repr(obj.shape).encode("utf8"))
+        if obj.dtype.hasobject:
+            for item in obj.flat:
+                hash_object(h, item, seen)
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(repr(len(obj)).encode("utf8"))
+        for item in obj:
+            hash_object(h, item, seen)
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=repr):
+            hash_object(h, key, seen)
+            hash_object(h, obj[key], seen)
+    elif isinstance(obj, types.ModuleType):
+        # The global NumPy generator, which is not seeded by its user, so
+        # its state is left out
+        h.update(obj.__name__.encode("utf8"))
+    elif isinstance(obj, (types.FunctionType, types.MethodType, type)):
+        h.update(getattr(obj, "__module__", "").encode("utf8"))
+        h.update(getattr(obj, "__name__", "").encode("utf8"))
+    elif hasattr(np.random, "SeedSequence") and isinstance(obj, np.random.SeedSequence):
+        # The children spawned from a seed sequence do not change its seed
+        hash_object(h, (obj.entropy, obj.spawn_key, obj.pool_size), seen)
+    elif id(obj) in seen:
+        return
+    else:
+        seen.add(id(obj))
+        h.update(type(obj).__module__.encode("utf8"))
+        if hasattr(np.random, "Generator") and isinstance(obj, np.random.Generator):
+            state = obj.bit_generator.state
+        elif isinstance(obj, np.random.RandomState):
+            state = obj.get_state()
+        elif hasattr(obj, "__getstate__") and \
+            not isinstance(getattr(obj, "__getstate__"), types.BuiltinMethodType):
+            state = obj.__getstate__()
+        elif hasattr(obj, "__dict__"):
+            state = obj.__dict__
+        else:
+            state = repr(obj)
+        if isinstance(state, dict):
+            # Attributes starting with an underscore hold caches and handles
+            state = dict((key, value) for key, value in state.items()
+                         if not (isinstance(key, string_types) and key.startswith("_")))
+        hash_object(h, state, seen)
+
+def get_hash(*objects):
+    """
+    Return a hash of *objects* as a hex string.
+    """
+    h = hashlib.sha1()
+    for obj in objects:
+        hash_object(h, obj)
+    return h.hexdigest()
+
+class PhotonCache(object):
+    r"""
+    A cache of photon lists, stored as HDF5 files in a local *directory*.
+    Each photon list is keyed by a hash of the dataset, the data source,
+    the current state of the source model (including its spectral model
+    and its random number generator), and the other arguments it was
+    generated with, so that generating the same photons again only reads
+    them back from disk. A source model which draws from the global NumPy
+    generator is keyed without its state. When the files in the cache
+    take up more than *max_size* bytes, those which have been used least
+    recently are removed.
+
+    Parameters
+    ----------
+    directory : string
+        The directory to store the photon lists in, which is created if
+        it does not exist.
+    max_size : integer, optional
+        The maximum size of the cache in bytes. If not set, the cache
+        may grow without limit.
+
+    Examples
+    --------
+    >>> cache = PhotonCache("photon_cache", max_size=50e9)
+    >>> photons = PhotonList.from_data_source(sp, redshift, area, exp_time,
+    ...                                       thermal_model, cache=cache)
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        if comm.rank == 0 and not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        comm.barrier()
+
+    def get_key(self, *objects):
+        """
+        Return the key for the photon list generated from *objects*.
+        """
+        return get_hash(*objects)
+
+    def get_model_key(self, source_model):
+        """
+        Return a hash of the current state of *source_model*, taken before
+        it is set up. If the model is in the state it was left in the last
+        time its photons were generated or read from the cache, the hash
+        of the state it had before that is returned, so that repeating the
+        same call with the same model reads the same photons back.
+        """
+        state_key = get_hash(source_model)
+        return getattr(source_model, "_cache_states", {}).get(state_key, state_key)
+
+    def update_model_key(self, source_model, model_key):
+        """
+        Record that *source_model* was in the state with the hash
+        *model_key* before its photons were generated or read from the
+        cache, along with the state it is in now.
+        """
+        if not hasattr(source_model, "_cache_states"):
+            source_model._cache_states = {}
+        source_model._cache_states[get_hash(source_model)] = model_key
+
+    def get_filename(self, key):
+        return os.path.join(self.directory, "%s.h5" % key)
+
+    def get(self, key):
+        """
+        Return the name of the file holding the photon list with *key*,
+        marking it as the most recently used, or None if it is not in the
+        cache.
+        """
+        filename = self.get_filename(key)
+        if comm.rank == 0:
+            if os.path.exists(filename):
+                os.utime(filename, None)
+            else:
+                filename = None
+        return comm.mpi_bcast(filename)
+
+    def store(self, key, photons, photon_file=None):
+        """
+        Store the :class:`~pyxsim.photon_list.PhotonList` *photons* with
+        *key*, copying it from *photon_file* if it has already been written
+        there, and remove the least recently used photon lists if the cache
+        is too large.
+        """
+        filename = self.get_filename(key)
+        # The file is renamed once it is complete, so that a file which
+        # is only partly written is never read from the cache
+        tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+        tmpfile = comm.mpi_bcast(tmpfile)
+        if photon_file is None:
+            # The cache holds single files, so the photons are not split
+            # between the files of the processors
+            parallel_io = "mpio" if h5py.get_config().mpi else "gather"
+            photons.write_h5_file(tmpfile, parallel_io=parallel_io)
+        elif comm.rank == 0:
+            shutil.copyfile(photon_file, tmpfile)
+        if comm.rank == 0:
+            os.rename(tmpfile, filename)
+            mylog.info("Stored the photons in the cache as %s." % filename)
+            self.evict()
+        comm.barrier()
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        files = [(os.path.getmtime(fn), os.path.getsize(fn), fn)
+                 for fn in glob.glob(os.path.join(self.directory, "*.h5"))]
+        files.sort()
+        size = sum(f[1] for f in files)
+        # The most recent file is always kept
+        for mtime, fsize, fn in files[:-1]:
+            if size <= self.max_size:
+                break
+            os.remove(fn)
+            size -= fsize
+            mylog.info("Removed %s from the cache." % fn)
+
+    def clear(self):
+        """
+        Remove all of the photon lists from the cache.
+        """
+        if comm.rank == 0:
+            for fn in glob.glob(os.path.join(self.directory, "*.h5")):
+                os.remove(fn)
+        comm.barrier()
@@ -2,22 +2,41 @@
 Classes for generating lists of photons
 """
 from six import string_types
-from collections import defaultdict
+from six.moves import queue
+from collections import defaultdict, deque, OrderedDict
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Event
 import numpy as np
 from yt.funcs import iterable
 from pyxsim.utils import mylog
 from yt.utilities.physical_constants import clight
 from yt.utilities.cosmology import Cosmology
+from yt.convenience import load
 from yt.utilities.orientation import Orientation
 from yt.utilities.parallel_tools.parallel_analysis_interface import \
-    communication_system, get_mpi_type, parallel_capable, parallel_objects
+    communication_system, get_mpi_type, parallel_capable, \
+    parallel_objects
 from yt.units.yt_array import YTQuantity, YTArray, uconcatenate
 import h5py
-from pyxsim.utils import parse_value, force_unicode, validate_parameters
+import os
+import time
+import shutil
+from pyxsim.utils import parse_value, parse_array, force_unicode, \
+    validate_parameters, get_conversion_factor, HDF5Options, \
+    write_virtual_dataset
 from pyxsim.event_list import EventList
+from pyxsim.rng import CellKeyedPRNG, ThreadLocalPRNG, ChunkStreams, \
+    parse_prng, get_stream_seed, spawn_prng, segment_offsets
+from pyxsim.photon_cache import PhotonCache
+from pyxsim.ragged_array import RaggedArray
+from pyxsim.photon_summary import PhotonSummary, summarize_photon_file
+from pyxsim.scheduling import schedule_chunks, schedules, partitions, \
+    get_rank_range
 
 comm = communication_system.communicators[-1]
 
+ckms = clight.in_units("km/s").v
+
 axes_lookup = {"x": ("y","z"),
                "y": ("x","z"),
                "z": ("x","y")}
@@ -54,14 +73,838 @@ def get_smallest_dds(ds, ds_type):
         dds = dds * (ds.domain_right_edge - ds.domain_left_edge)
     return dds
 
+def get_cosmology(ds, cosmology):
+    if cosmology is None:
+        if hasattr(ds, 'cosmology'):
+            cosmo = ds.cosmology
+        else:
+            cosmo = Cosmology()
+    else:
+        cosmo = cosmology
+    mylog.info("Cosmology: h = %g, omega_matter = %g, omega_lambda = %g" %
+               (cosmo.hubble_constant, cosmo.omega_matter, cosmo.omega_lambda))
+    return cosmo
+
+def get_distance(cosmo, redshift, dist):
+    if dist is None:
+        if redshift <= 0.0:
+            msg = "If redshift <= 0.0, you must specify a distance to the source using the 'dist' argument!"
+            mylog.error(msg)
+            raise ValueError(msg)
+        D_A = cosmo.angular_diameter_distance(0.0, redshift).in_units("Mpc")
+    else:
+        D_A = parse_value(dist, "Mpc")
+        if redshift > 0.0:
+            mylog.warning("Redshift must be zero for nearby sources. Resetting redshift to 0.0.")
+            redshift = 0.0
+    return D_A, redshift
+
+def determine_center(ds, data_source, center):
+    if center == "center" or center == "c":
+        return ds.domain_center
+    elif center == "max" or center == "m":
+        return ds.find_max("density")[-1]
+    elif iterable(center):
+        if isinstance(center, YTArray):
+            return center.in_units("code_length")
+        elif isinstance(center, tuple):
+            if center[0] == "min":
+                return ds.find_min(center[1])[-1]
+            elif center[0] == "max":
+                return ds.find_max(center[1])[-1]
+            else:
+                raise RuntimeError
+        else:
+            return ds.arr(center, "code_length")
+    elif center is None:
+        return data_source.get_field_parameter("center")
+
+def set_fiducial_parameters(parameters, area, exp_time, redshift, D_A, cosmo):
+    """
+    Store the fiducial area, exposure time, redshift, distance, and
+    cosmology in *parameters*, and return the normalization of the
+    spectra which they give.
+    """
+    parameters["FiducialExposureTime"] = parse_value(exp_time, "s")
+    parameters["FiducialArea"] = parse_value(area, "cm**2")
+    parameters["FiducialRedshift"] = redshift
+    parameters["FiducialAngularDiameterDistance"] = D_A
+    parameters["HubbleConstant"] = cosmo.hubble_constant
+    parameters["OmegaMatter"] = cosmo.omega_matter
+    parameters["OmegaLambda"] = cosmo.omega_lambda
+
+    D_A = parameters["FiducialAngularDiameterDistance"].in_cgs()
+    dist_fac = 1.0/(4.*np.pi*D_A.value*D_A.value*(1.+redshift)**2)
+    return parameters["FiducialArea"].v*parameters["FiducialExposureTime"].v*dist_fac
+
+def get_source_edges(data_source, p_fields, parameters):
+    """
+    Find the edges of the box around *data_source*, snapped to the
+    smallest cells of the dataset, and store its dimensions and width
+    in *parameters*.
+    """
+    ds = data_source.ds
+    if hasattr(data_source, "left_edge"):
+        # Region or grid
+        le = data_source.left_edge
+        re = data_source.right_edge
+    elif hasattr(data_source, "radius") and not hasattr(data_source, "height"):
+        # Sphere
+        le = -data_source.radius+data_source.center
+        re = data_source.radius+data_source.center
+    else:
+        # Compute rough boundaries of the object
+        # DOES NOT WORK for objects straddling periodic
+        # boundaries yet
+        if sum(ds.periodicity) > 0:
+            mylog.warning("You are using a region that is not currently "
+                          "supported for straddling periodic boundaries. "
+                          "Check to make sure that this is not the case.")
+        le = ds.arr(np.zeros(3), "code_length")
+        re = ds.arr(np.zeros(3), "code_length")
+        for i, ax in enumerate(p_fields):
+            le[i], re[i] = data_source.quantities.extrema(ax)
+
+    dds_min = get_smallest_dds(ds, parameters["DataType"])
+    le = np.rint((le-ds.domain_left_edge)/dds_min)*dds_min+ds.domain_left_edge
+    re = ds.domain_right_edge-np.rint((ds.domain_right_edge-re)/dds_min)*dds_min
+    width = re-le
+    parameters["Dimension"] = np.rint(width/dds_min).astype("int")
+    parameters["Width"] = parameters["Dimension"]*dds_min.in_units("kpc")
+    return le, re
+
+def group_source_boxes(edges):
+    """
+    Merge the boxes with the given *edges* into groups whose bounding
+    boxes do not intersect, and return the edges of each bounding box
+    along with the indices of the boxes in it.
+    """
+    groups = [(le, re, [k]) for k, (le, re) in enumerate(edges)]
+    merged = True
+    while merged:
+        merged = False
+        for a in range(len(groups)):
+            le_a, re_a, ka = groups[a]
+            for b in range(a+1, len(groups)):
+                le_b, re_b, kb = groups[b]
+                if np.all(le_a <= re_b) and np.all(le_b <= re_a):
+                    groups[a] = (np.minimum(le_a, le_b), np.maximum(re_a, re_b), ka+kb)
+                    del groups[b]
+                    merged = True
+                    break
+            if merged:
+                break
+    return groups
+
+def get_series_filenames(ts):
+    """
+    Return the filenames of the outputs of the time series *ts*, which
+    may be a :class:`~yt.data_objects.time_series.DatasetSeries` or a list
+    of filenames or datasets.
+    """
+    outputs = getattr(ts, "_pre_outputs", ts)
+    return [fn if isinstance(fn, string_types) else os.path.join(fn.fullpath, fn.basename)
+            for fn in outputs]
+
 def concatenate_photons(photons):
     for key in photons:
         if len(photons[key]) > 0:
-            photons[key] = uconcatenate(photons[key])
+            photons[key] = np.concatenate(photons[key])
         elif key == "NumberOfPhotons":
+            photons[key] = np.array([], dtype="int64")
+        else:
             photons[key] = np.array([])
+
+def get_chunk_values(chunk, field, units, idxs):
+    arr = chunk[field]
+    return arr.d[idxs]*get_conversion_factor(arr, units)
+
+def read_chunks(chunks, fields):
+    """
+    Read the *fields* of each of the (index, chunk) pairs in *chunks*
+    into a dict. yt chunks are views of the data source which change as
+    it is iterated over, so they must be read before the next chunk is
+    reached if they are to be used later or in another thread.
+    """
+    for i, chunk in chunks:
+        yield i, dict((field, chunk[field]) for field in fields)
+
+def prefetch_chunks(chunks, nahead):
+    """
+    Iterate over *chunks* in a background thread, which keeps up to
+    *nahead* of them ready, so that reading the data overlaps with
+    generating the photons from it.
+    """
+    ready = queue.Queue(maxsize=nahead)
+    stop = Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def reader():
+        try:
+            for item in chunks:
+                put((item, None))
+                if stop.is_set():
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+# The float and integer types of the photon arrays for each precision
+photon_precisions = {"single": ("float32", "int32"),
+                     "double": ("float64", "int64")}
+
+def get_photon_dtype(key, precision):
+    if precision not in photon_precisions:
+        raise ValueError("precision must be one of %s, not '%s'!" %
+                         (list(photon_precisions.keys()), precision))
+    ftype, itype = photon_precisions[precision]
+    return itype if key == "NumberOfPhotons" else ftype
+
+def set_precision(photons, precision, keys=None):
+    """
+    Cast the photon arrays with *keys* (all of them by default) to the
+    types of *precision*, "single" or "double". If *precision* is None,
+    the arrays are left as they are.
+    """
+    if precision is None:
+        return
+    if keys is None:
+        keys = list(photons.keys())
+    for key in keys:
+        photons[key] = photons[key].astype(get_photon_dtype(key, precision),
+                                           copy=False)
+
+def add_chunk_photons(photons, chunk, chunk_data, p_fields, v_fields, w_field,
+                      precision="double"):
+    if chunk_data is None:
+        return
+    number_of_photons, idxs, energies = chunk_data
+    photons["NumberOfPhotons"].append(
+        number_of_photons.astype(get_photon_dtype("NumberOfPhotons", precision),
+                                 copy=False))
+    photons["Energy"].append(energies.astype(get_photon_dtype("Energy", precision),
+                                             copy=False))
+    # The positions are kept in double precision until they are made
+    # relative to the center of the source
+    for i, ax in enumerate("xyz"):
+        photons[ax].append(get_chunk_values(chunk, p_fields[i], "kpc", idxs))
+        v = get_chunk_values(chunk, v_fields[i], "km/s", idxs)
+        photons["v"+ax].append(v.astype(get_photon_dtype("v"+ax, precision),
+                                        copy=False))
+    if w_field is None:
+        dx = np.zeros(len(photons["x"][-1]))
+    else:
+        dx = get_chunk_values(chunk, w_field, "kpc", idxs)
+    photons["dx"].append(dx.astype(get_photon_dtype("dx", precision), copy=False))
+
+photon_datasets = {"NumberOfPhotons": "num_photons",
+                   "Energy": "energy"}
+for key in ["x", "y", "z", "vx", "vy", "vz", "dx"]:
+    photon_datasets[key] = key
+
+def write_photon_parameters(f, parameters):
+    p = f.create_group("parameters")
+    p.create_dataset("fid_area", data=float(parameters["FiducialArea"]))
+    p.create_dataset("fid_exp_time", data=float(parameters["FiducialExposureTime"]))
+    p.create_dataset("fid_redshift", data=parameters["FiducialRedshift"])
+    p.create_dataset("hubble", data=parameters["HubbleConstant"])
+    p.create_dataset("omega_matter", data=parameters["OmegaMatter"])
+    p.create_dataset("omega_lambda", data=parameters["OmegaLambda"])
+    p.create_dataset("fid_d_a", data=float(parameters["FiducialAngularDiameterDistance"]))
+    p.create_dataset("dimension", data=parameters["Dimension"])
+    p.create_dataset("width", data=parameters["Width"].v)
+    p.create_dataset("data_type", data=parameters["DataType"])
+
+def read_photon_parameters(f):
+    parameters = {}
+    p = f["/parameters"]
+    parameters["FiducialExposureTime"] = YTQuantity(p["fid_exp_time"].value, "s")
+    parameters["FiducialArea"] = YTQuantity(p["fid_area"].value, "cm**2")
+    parameters["FiducialRedshift"] = p["fid_redshift"].value
+    parameters["FiducialAngularDiameterDistance"] = YTQuantity(p["fid_d_a"].value, "Mpc")
+    dims = p["dimension"].value
+    if not isinstance(dims, np.ndarray):
+        dims = np.array([dims]*3)
+    parameters["Dimension"] = dims
+    width = p["width"].value
+    if not isinstance(width, np.ndarray):
+        width = np.array([width]*3)
+    parameters["Width"] = YTArray(width, "kpc")
+    parameters["HubbleConstant"] = p["hubble"].value
+    parameters["OmegaMatter"] = p["omega_matter"].value
+    parameters["OmegaLambda"] = p["omega_lambda"].value
+    if "data_type" in p:
+        parameters["DataType"] = force_unicode(p["data_type"].value)
+    else:
+        parameters["DataType"] = "cells"
+    return parameters
+
+def append_photons(f, parameters, photons, datasets):
+    """
+    Append the *photons* to the *datasets* of the photon file *f*, which
+    must be open for writing and resizable, once their *parameters* have
+    been checked against those of the file. The widths and dimensions of
+    the file are enlarged to cover both, so that photons from different
+    regions may be appended. A spatial index of the file is removed,
+    since the appended cells are not sorted with the others, and its
+    summary is updated, though the images of the summary keep their width.
+    """
+    # The parameters are compared as they would be written to a file
+    with h5py.File("parameters.h5", "w", driver="core", backing_store=False) as fp:
+        write_photon_parameters(fp, parameters)
+        new_parameters = read_photon_parameters(fp)
+    old_parameters = read_photon_parameters(f)
+    validate_parameters(old_parameters, new_parameters, skip=["Dimension", "Width"])
+    d = f["data"]
+    for name in datasets.values():
+        if d[name].maxshape[0] is not None:
+            raise IOError("The photons cannot be appended to %s, " % f.filename +
+                          "since its datasets cannot be extended. Write it again "
+                          "with chunked datasets to append to it.")
+    widths = [old_parameters["Width"].d, new_parameters["Width"].d]
+    dims = [old_parameters["Dimension"], new_parameters["Dimension"]]
+    dx_min = np.minimum(widths[0]/dims[0], widths[1]/dims[1])
+    width = np.maximum(widths[0], widths[1])
+    p = f["parameters"]
+    del p["width"], p["dimension"]
+    p.create_dataset("width", data=width)
+    p.create_dataset("dimension", data=np.ceil(width/dx_min-1.0e-6).astype("int64"))
+    if "index" in f:
+        mylog.warning("Removing the spatial index of %s, " % f.filename +
+                      "since the appended photons are not sorted with the others.")
+        del f["index"]
+    for key, name in datasets.items():
+        dset = d[name]
+        n = dset.shape[0]
+        dset.resize((n+photons[key].size,))
+        dset[n:] = photons[key]
+    if "summary" in f:
+        summary = PhotonSummary.read(f)
+        summary.add(photons)
+        summary.write(f)
+
+parallel_io_modes = ["auto", "mpio", "virtual", "gather"]
+
+def get_parallel_io(parallel_io):
+    """
+    Return the way the photons of the MPI processors are written for the
+    *parallel_io* argument of :meth:`~pyxsim.photon_list.PhotonList.write_h5_file`,
+    choosing the best one which is available for "auto".
+    """
+    if parallel_io not in parallel_io_modes:
+        raise ValueError("parallel_io must be one of %s, not '%s'!" %
+                         (parallel_io_modes, parallel_io))
+    if parallel_io == "auto":
+        if h5py.get_config().mpi:
+            return "mpio"
+        elif hasattr(h5py, "VirtualLayout"):
+            return "virtual"
+        return "gather"
+    return parallel_io
+
+def translate_photons(photons, ds, le, re, center):
+    """
+    Translate the photon coordinates in kpc to the source *center*,
+    fixing those of regions crossing a periodic boundary.
+    """
+    dw = ds.domain_width.to("kpc").d
+    le = le.to("kpc").d
+    re = re.to("kpc").d
+    c = center.to("kpc").d
+    for i, ax in enumerate("xyz"):
+        if ds.periodicity[i] and len(photons[ax]) > 0:
+            tfl = photons[ax] < le[i]
+            tfr = photons[ax] > re[i]
+            photons[ax][tfl] += dw[i]
+            photons[ax][tfr] -= dw[i]
+        photons[ax] -= c[i]
+
+def morton_interleave(idxs, level):
+    """
+    Interleave the bits of the integer grid coordinates *idxs* (three
+    arrays) into Morton (Z-order) keys for a grid of 2**level cells on
+    a side.
+    """
+    idxs = [np.asarray(idx).astype("uint64") for idx in idxs]
+    keys = np.zeros(idxs[0].shape, dtype="uint64")
+    one = np.uint64(1)
+    for b in range(level):
+        for i, idx in enumerate(idxs):
+            keys |= ((idx >> np.uint64(b)) & one) << np.uint64(3*b+2-i)
+    return keys
+
+def get_grid_coords(pos, le, re, level):
+    """
+    Return the coordinates of the positions *pos* (three arrays) in a
+    grid of 2**level cells on a side spanning *le* to *re*.
+    """
+    n = 2**level
+    coords = []
+    for i in range(3):
+        width = re[i]-le[i]
+        if width > 0.0:
+            c = np.floor((np.asarray(pos[i], dtype="float64")-le[i])/width*n)
+        else:
+            c = np.zeros(np.shape(pos[i]))
+        coords.append(np.clip(c, 0, n-1).astype("int64"))
+    return coords
+
+def sort_photons(photons, level):
+    """
+    Sort the cells of *photons* by the Morton keys of their positions on
+    a grid of 2**level cells on a side around them, and return the sorted
+    photons along with a spatial index, which gives the offsets of the
+    cells and photons in each block of the grid.
+    """
+    pos = [np.asarray(photons[ax], dtype="float64") for ax in "xyz"]
+    if pos[0].size > 0:
+        le = np.array([p.min() for p in pos])
+        re = np.array([p.max() for p in pos])
+    else:
+        le = np.zeros(3)
+        re = np.zeros(3)
+    keys = morton_interleave(get_grid_coords(pos, le, re, level), level)
+    order = np.argsort(keys, kind="mergesort")
+    n_ph = np.asarray(photons["NumberOfPhotons"]).astype("int64")
+    p_bins = np.insert(np.cumsum(n_ph), 0, 0)
+    e_idxs = np.repeat(p_bins[:-1][order], n_ph[order]) + segment_offsets(n_ph[order])
+    sorted_photons = {}
+    for key, arr in photons.items():
+        sorted_photons[key] = arr[e_idxs] if key == "Energy" else arr[order]
+    blocks = np.arange(8**level+1, dtype="uint64")
+    cell_offsets = np.searchsorted(keys[order], blocks).astype("int64")
+    photon_offsets = np.insert(np.cumsum(n_ph[order]), 0, 0)[cell_offsets]
+    index = {"level": level, "left_edge": le, "right_edge": re,
+             "cell_offsets": cell_offsets, "photon_offsets": photon_offsets}
+    return sorted_photons, index
+
+energy_index_datasets = {"EnergyMin": "energy_min",
+                         "EnergyMax": "energy_max"}
+
+def sort_energies(photons):
+    """
+    Replace the energies of *photons* with a copy in which the energies
+    of the photons in each cell are sorted, and return the smallest and
+    largest energies of each cell, which are zero for cells with no
+    photons.
+    """
+    n_ph = np.asarray(photons["NumberOfPhotons"])
+    energy = RaggedArray.from_counts(np.array(photons["Energy"]), n_ph)
+    energy.sort()
+    photons["Energy"] = energy.data
+    has_ph = n_ph > 0
+    e_min = np.zeros(n_ph.size, dtype=energy.data.dtype)
+    e_max = np.zeros(n_ph.size, dtype=energy.data.dtype)
+    e_min[has_ph] = energy.data[energy.offsets[:-1][has_ph]]
+    e_max[has_ph] = energy.data[energy.offsets[1:][has_ph]-1]
+    return e_min, e_max
+
+def write_spatial_index(f, index):
+    g = f.create_group("index")
+    g.attrs["level"] = index["level"]
+    g.attrs["left_edge"] = index["left_edge"]
+    g.attrs["right_edge"] = index["right_edge"]
+    g.create_dataset("cell_offsets", data=index["cell_offsets"])
+    g.create_dataset("photon_offsets", data=index["photon_offsets"])
+
+def get_index_ranges(g, le, re):
+    """
+    Return the ranges of cells and photons in the file with the spatial
+    index *g* which may hold cells in the box from *le* to *re*, with
+    adjacent ranges merged.
+    """
+    level = int(g.attrs["level"])
+    ile = g.attrs["left_edge"]
+    ire = g.attrs["right_edge"]
+    if np.any(le > ire) or np.any(re < ile):
+        return []
+    coords = get_grid_coords([[le[i], re[i]] for i in range(3)], ile, ire, level)
+    grid = np.meshgrid(*[np.arange(c[0], c[1]+1) for c in coords], indexing="ij")
+    blocks = np.sort(morton_interleave([c.ravel() for c in grid], level)).astype("int64")
+    cell_offsets = g["cell_offsets"][:]
+    photon_offsets = g["photon_offsets"][:]
+    ranges = []
+    for b in blocks:
+        c0, c1 = cell_offsets[b], cell_offsets[b+1]
+        if c1 == c0:
+            continue
+        if len(ranges) > 0 and ranges[-1][1] == c0:
+            ranges[-1][1] = c1
+            ranges[-1][3] = photon_offsets[b+1]
+        else:
+            ranges.append([c0, c1, photon_offsets[b], photon_offsets[b+1]])
+    return ranges
+
+def read_photon_ranges(d, ranges):
+    """
+    Read the photons in the ranges of cells and photons [c0, c1, p0, p1]
+    in *ranges* from the data group *d* of a photon file.
+    """
+    photons = {}
+    for key, name in photon_datasets.items():
+        dset = d[name]
+        if key == "Energy":
+            slices = [dset[p0:p1] for c0, c1, p0, p1 in ranges]
+        else:
+            slices = [dset[c0:c1] for c0, c1, p0, p1 in ranges]
+        if len(slices) == 0:
+            photons[key] = np.array([], dtype=dset.dtype)
+        else:
+            photons[key] = np.concatenate(slices)
+    return photons
+
+def get_cell_runs(keep, start, p_bins):
+    """
+    Return the ranges of cells and photons [c0, c1, p0, p1] of the runs of
+    cells for which *keep* is True, where *keep* begins at cell *start*
+    and *p_bins* are the offsets of the photons of the cells.
+    """
+    edges = np.diff(np.concatenate([[0], keep.astype("int8"), [0]]))
+    c0 = np.where(edges == 1)[0]+start
+    c1 = np.where(edges == -1)[0]+start
+    return [[i0, i1, p_bins[i0], p_bins[i1]] for i0, i1 in zip(c0, c1)]
+
+def select_cells(photons, cells):
+    """
+    Keep only the *cells* of *photons* (a boolean mask) and their photons.
+    """
+    e_cells = np.repeat(cells, photons["NumberOfPhotons"])
+    for key in photons:
+        photons[key] = photons[key][e_cells if key == "Energy" else cells]
+
+def select_energy_band(photons, emin, emax, sorted_energies=False):
+    """
+    Keep only the photons of *photons* with energies between *emin* and
+    *emax*, and the cells which have any of them. If *sorted_energies* is
+    True, the energies of the photons in each cell are sorted, so those
+    in the band are found by a binary search in each cell.
+    """
+    n_ph = photons["NumberOfPhotons"]
+    if sorted_energies:
+        energy = RaggedArray.from_counts(photons["Energy"], n_ph)
+        dtype = photons["Energy"].dtype
+        lo = energy.offsets[:-1]
+        hi = energy.offsets[1:]
+        if emin is not None:
+            lo = energy.searchsorted(np.array(emin, dtype=dtype), side="left")
+        if emax is not None:
+            hi = energy.searchsorted(np.array(emax, dtype=dtype), side="right")
+        counts = np.maximum(hi-lo, 0)
+        e_idxs = np.repeat(lo, counts) + segment_offsets(counts)
+        photons["NumberOfPhotons"] = counts.astype(n_ph.dtype)
+        photons["Energy"] = photons["Energy"][e_idxs]
+    else:
+        in_band = np.ones(photons["Energy"].size, dtype="bool")
+        if emin is not None:
+            in_band &= photons["Energy"] >= emin
+        if emax is not None:
+            in_band &= photons["Energy"] <= emax
+        cells = np.repeat(np.arange(n_ph.size), n_ph)
+        photons["NumberOfPhotons"] = np.bincount(cells[in_band], minlength=n_ph.size
+                                                 ).astype(n_ph.dtype)
+        photons["Energy"] = photons["Energy"][in_band]
+    keep = photons["NumberOfPhotons"] > 0
+    for key in photons:
+        if key != "Energy":
+            photons[key] = photons[key][keep]
+
+def read_photons_in_box(f, le, re):
+    """
+    Read the photons of the cells in the file *f* which may lie in the box
+    from *le* to *re* (in kpc from the center of the source), using its
+    spatial index if it has one, and otherwise reading all of them.
+    """
+    d = f["data"]
+    if "index" in f:
+        ranges = get_index_ranges(f["index"], le, re)
+    else:
+        num_cells = d["x"].shape[0]
+        ranges = [[0, num_cells, 0, d["energy"].shape[0]]]
+    return read_photon_ranges(d, ranges)
+
+class PhotonWriter(object):
+    """
+    Write photons to the HDF5 file *filename* as they are generated,
+    in the same layout as :meth:`~pyxsim.photon_list.PhotonList.write_h5_file`,
+    by appending them to resizable datasets. The photons passed to
+    :meth:`write` are a dict of lists of arrays, as built up by
+    :func:`add_chunk_photons`, which are emptied once written, so that only
+    the photons of the chunks since the last write are held in memory.
+    If *transform* is given, it is applied to the concatenated photons
+    before they are written. The datasets have the types of *precision*,
+    "single" or "double".
+
+    If *resume* is True and *filename* holds a checkpoint written by
+    :meth:`checkpoint`, the file is opened for appending instead, anything
+    written after the checkpoint is thrown away, and the indices of the
+    chunks which are done and the state saved with the checkpoint are
+    restored to :attr:`chunks` and :attr:`state`.
+
+    The :class:`~pyxsim.photon_summary.PhotonSummary` of the photons is
+    kept in :attr:`summary`, saved with each checkpoint, and written to the
+    file when it is closed.
+    """
+    def __init__(self, filename, parameters, transform=None, resume=False,
+                 precision="double"):
+        self.filename = filename
+        self.transform = transform
+        self.chunks = []
+        self.state = None
+        self.attrs = {}
+        self.num_cells = 0
+        self.num_photons = 0
+        self.summary = PhotonSummary(parameters["Width"].d)
+        if resume and os.path.exists(filename):
+            self.f = h5py.File(filename, "r+")
+            if "checkpoint" in self.f:
+                self.load_checkpoint(parameters)
+                return
+            self.f.close()
+            mylog.warning("%s has no checkpoint to resume from, " % filename +
+                          "so all of the photons will be generated again.")
+        self.f = h5py.File(filename, "w")
+        write_photon_parameters(self.f, parameters)
+        d = self.f.create_group("data")
+        for key, name in photon_datasets.items():
+            d.create_dataset(name, shape=(0,), maxshape=(None,),
+                             dtype=get_photon_dtype(key, precision),
+                             chunks=(65536,))
+
+    def append(self, key, arr):
+        dset = self.f["data"][photon_datasets[key]]
+        n = dset.shape[0]
+        dset.resize((n+arr.size,))
+        dset[n:] = arr
+
+    def write(self, photons, chunks=()):
+        """
+        Write the *photons*, which were generated from the chunks with
+        indices *chunks*.
+        """
+        self.chunks.extend(chunks)
+        if len(photons["x"]) == 0:
+            return
+        concatenate_photons(photons)
+        if self.transform is not None:
+            self.transform(photons)
+        for key in photon_datasets:
+            self.append(key, photons[key])
+        self.summary.add(photons)
+        self.num_cells += photons["x"].size
+        self.num_photons += int(photons["NumberOfPhotons"].sum())
+        photons.clear()
+
+    def checkpoint(self, state, **attrs):
+        """
+        Record the chunks written so far, along with the dict of arrays
+        *state* and the attributes *attrs*, and flush the file to disk.
+        """
+        # The new checkpoint replaces the old one only once it is complete
+        c = self.f.create_group("checkpoint_new")
+        c.attrs["num_cells"] = self.num_cells
+        c.attrs["num_photons"] = self.num_photons
+        for key, value in attrs.items():
+            c.attrs[key] = value
+        c.create_dataset("chunks", data=np.array(self.chunks, dtype="int64"))
+        r = c.create_group("state")
+        for key, value in state.items():
+            r.create_dataset(key, data=value)
+        self.summary.write(c)
+        if "checkpoint" in self.f:
+            del self.f["checkpoint"]
+        self.f.move("checkpoint_new", "checkpoint")
+        self.f.flush()
+
+    def load_checkpoint(self, parameters):
+        # The in-memory file is closed even if the parameters do not match
+        with h5py.File("parameters", "w", driver="core", backing_store=False) as f:
+            write_photon_parameters(f, parameters)
+            validate_parameters(dict((k, force_unicode(v[()]))
+                                     for k, v in self.f["parameters"].items()),
+                                dict((k, force_unicode(v[()]))
+                                     for k, v in f["parameters"].items()))
+        c = self.f["checkpoint"]
+        self.num_cells = int(c.attrs["num_cells"])
+        self.num_photons = int(c.attrs["num_photons"])
+        self.attrs = dict(c.attrs.items())
+        self.chunks = list(c["chunks"][:])
+        self.state = dict((key, value[()]) for key, value in c["state"].items())
+        d = self.f["data"]
+        for key, name in photon_datasets.items():
+            if key == "Energy":
+                d[name].resize((self.num_photons,))
+            else:
+                d[name].resize((self.num_cells,))
+        if "summary" in c:
+            self.summary = PhotonSummary.read(c)
+        else:
+            self.summary = summarize_photon_file(self.f)
+        if "checkpoint_new" in self.f:
+            del self.f["checkpoint_new"]
+        mylog.info("Resuming from the checkpoint in %s, " % self.filename +
+                   "with %d chunks done." % len(set(self.chunks)))
+
+    def merge(self, filenames, block_size=1048576):
+        """
+        Append the photons in the files *filenames*, written by other
+        instances of this class, in blocks of at most *block_size* elements,
+        and remove the files.
+        """
+        for fn in filenames:
+            f = h5py.File(fn, "r")
+            for key, name in photon_datasets.items():
+                dset = f["data"][name]
+                for start in range(0, dset.shape[0], block_size):
+                    self.append(key, dset[start:start+block_size])
+            self.num_cells += f["data"]["x"].shape[0]
+            self.num_photons += int(f["data"]["num_photons"][:].sum())
+            if "summary" in f:
+                self.summary.add_summary(PhotonSummary.read(f))
+            else:
+                self.summary.add_summary(summarize_photon_file(f, block_size))
+            f.close()
+            os.remove(fn)
+
+    def close(self, complete=True):
+        """
+        Close the file. If it is *complete*, the checkpoint is removed
+        and the summary of the photons is written.
+        """
+        if complete:
+            for group in ["checkpoint", "checkpoint_new"]:
+                if group in self.f:
+                    del self.f[group]
+            self.summary.write(self.f)
+        self.f.close()
+
+class LazyPhotonArray(object):
+    """
+    A photon array backed by the slice [*start*, *end*) of a dataset in an
+    open HDF5 file, which is read in contiguous blocks of *block_size*
+    elements as they are needed. The *max_blocks* blocks which were used
+    last are kept in memory, so that the array never holds more than a few
+    blocks however much of it is read. Indexing returns a :class:`~yt.units.yt_array.YTArray` in *units*, or
+    a NumPy array if there are none, which ``.d`` also gives.
+    """
+    def __init__(self, dset, start, end, units=None, dtype=None,
+                 block_size=1048576, max_blocks=4, blocks=None):
+        self.dset = dset
+        self.start = start
+        self.end = end
+        self.units = units
+        self.dtype = np.dtype(dset.dtype if dtype is None else dtype)
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        if blocks is None:
+            blocks = OrderedDict()
+        self.blocks = blocks
+
+    def __len__(self):
+        return self.end-self.start
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def size(self):
+        return len(self)
+
+    @property
+    def d(self):
+        return LazyPhotonArray(self.dset, self.start, self.end, dtype=self.dtype,
+                               block_size=self.block_size,
+                               max_blocks=self.max_blocks, blocks=self.blocks)
+
+    def _get_block(self, b):
+        if b in self.blocks:
+            # Move the block to the end, as the one which was used last
+            block = self.blocks.pop(b)
         else:
-            photons[key] = YTArray([], photon_units[key])
+            b0 = self.start+b*self.block_size
+            b1 = min(b0+self.block_size, self.end)
+            block = self.dset[b0:b1].astype(self.dtype, copy=False)
+        self.blocks[b] = block
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return block
+
+    def _wrap(self, arr):
+        if self.units is None:
+            return arr
+        return YTArray(arr, self.units)
+
+    def __getitem__(self, idxs):
+        if isinstance(idxs, slice):
+            i0, i1, step = idxs.indices(len(self))
+            if step == 1:
+                # Contiguous ranges are read straight from the file
+                arr = self.dset[self.start+i0:self.start+max(i0, i1)]
+                return self._wrap(arr.astype(self.dtype, copy=False))
+            idxs = np.arange(i0, i1, step)
+        idxs = np.asarray(idxs)
+        if idxs.dtype == bool:
+            idxs = np.where(idxs)[0]
+        scalar = idxs.ndim == 0
+        idxs = np.atleast_1d(idxs).astype("int64")
+        idxs[idxs < 0] += len(self)
+        arr = np.empty(idxs.size, dtype=self.dtype)
+        # Read each block which is needed once, and fill in all of the
+        # elements which fall in it
+        blocks = idxs // self.block_size
+        order = np.argsort(blocks, kind="mergesort")
+        ublocks, starts = np.unique(blocks[order], return_index=True)
+        ends = np.append(starts[1:], order.size)
+        for b, s, e in zip(ublocks, starts, ends):
+            members = order[s:e]
+            arr[members] = self._get_block(b)[idxs[members]-b*self.block_size]
+        if scalar:
+            arr = arr[0]
+        return self._wrap(arr)
+
+    def __array__(self, dtype=None):
+        arr = np.asarray(self[:])
+        if dtype is not None:
+            arr = arr.astype(dtype, copy=False)
+        return arr
+
+    def load(self):
+        """
+        Read the whole array into memory.
+        """
+        return self[:]
+
+    def __repr__(self):
+        return "LazyPhotonArray(%s, [%d:%d])" % (self.dset.name, self.start, self.end)
+
+def load_photon_array(arr):
+    if isinstance(arr, LazyPhotonArray):
+        return arr.load()
+    return arr
 
 class PhotonList(object):
 
@@ -70,35 +913,47 @@ class PhotonList(object):
         self.parameters = parameters
         self.cosmo = cosmo
         self.num_cells = len(photons["x"])
+        self._p_bins = None
+        self._file = None
+
+    @property
+    def p_bins(self):
+        # These are only computed when needed, so that a lazily read photon
+        # list does not read the numbers of photons until it is projected
+        if self._p_bins is None:
+            p_bins = np.cumsum(np.asarray(self.photons["NumberOfPhotons"]), dtype="int64")
+            self._p_bins = np.insert(p_bins, 0, [np.int64(0)])
+        return self._p_bins
+
+    def close(self):
+        """
+        Close the file which the photons of a lazily read photon list are
+        read from. Its photon arrays cannot be used after this. This does
+        nothing for a photon list which is held in memory.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
 
-        p_bins = np.cumsum(photons["NumberOfPhotons"])
-        self.p_bins = np.insert(p_bins, 0, [np.int64(0)])
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def keys(self):
         return self.photons.keys()
 
     def items(self):
-        ret = []
-        for k, v in self.photons.items():
-            if k == "Energy":
-                ret.append((k, self[k]))
-            else:
-                ret.append((k,v))
-        return ret
+        return [(k, self[k]) for k in self.photons]
 
     def values(self):
-        ret = []
-        for k, v in self.photons.items():
-            if k == "Energy":
-                ret.append(self[k])
-            else:
-                ret.append(v)
-        return ret
+        return [self[k] for k in self.photons]
 
     def __getitem__(self, key):
         if key == "Energy":
-            return [self.photons["Energy"][self.p_bins[i]:self.p_bins[i+1]]
-                    for i in range(self.num_cells)]
+            # The energies of the photons in each cell, without copying them
+            return RaggedArray(self.photons["Energy"], self.p_bins)
         else:
             return self.photons[key]
 
@@ -122,79 +977,217 @@ class PhotonList(object):
         for item1, item2 in zip(self.photons.items(), other.photons.items()):
             k1, v1 = item1
             k2, v2 = item2
-            photons[k1] = uconcatenate([v1,v2])
+            photons[k1] = uconcatenate([load_photon_array(v1), load_photon_array(v2)])
         return PhotonList(photons, self.parameters, self.cosmo)
 
     @classmethod
-    def from_file(cls, filename):
+    def from_file(cls, filename, precision=None, lazy=False, region=None, box=None,
+                  emin=None, emax=None, partition="photons"):
         r"""
         Initialize a :class:`~pyxsim.photon_list.PhotonList` from the HDF5 file *filename*.
+        If *precision* is "single" or "double", the photon arrays are cast to
+        single or double precision floats and 32 or 64-bit integers. Otherwise,
+        they are read with the types they were stored with.
+
+        If *lazy* is True, the file is kept open and the photon arrays are
+        :class:`~pyxsim.photon_list.LazyPhotonArray` objects, which are read
+        in blocks as they are used, so that opening the file reads none of
+        them, and :meth:`~pyxsim.photon_list.PhotonList.project_photons` reads
+        only the numbers of photons and the blocks holding the photons it
+        observes. The file is closed by
+        :meth:`~pyxsim.photon_list.PhotonList.close`, or at the end of a
+        ``with`` statement using the photon list.
+
+        Only the cells in a sphere may be read by setting *region* to a
+        (center, radius) tuple, or those in a box by setting *box* to a
+        (left_edge, right_edge) tuple, in the coordinates of the photons
+        (in kpc from the center of the source, if units are not given). If
+        the file was written with a spatial index (see
+        :meth:`~pyxsim.photon_list.PhotonList.write_h5_file`), only the
+        parts of the file around the region are read.
+
+        If *emin* and/or *emax* (in keV, if units are not given) are set,
+        only the photons with energies in that band are read, along with the
+        cells which have any of them. If the file was written with an energy
+        index, the cells which have none are not read at all.
+
+        When running under MPI, each processor reads a contiguous range of
+        the cells. If *partition* is "photons", the ranges are chosen so that
+        the processors have about the same number of photons, which keeps
+        them evenly loaded when the photons are projected. If it is "cells",
+        they have the same number of cells.
         """
+        if partition not in partitions:
+            raise ValueError("partition must be one of %s, not '%s'!" % (partitions, partition))
 
         photons = {}
-        parameters = {}
 
         f = h5py.File(filename, "r")
 
-        p = f["/parameters"]
-        parameters["FiducialExposureTime"] = YTQuantity(p["fid_exp_time"].value, "s")
-        parameters["FiducialArea"] = YTQuantity(p["fid_area"].value, "cm**2")
-        parameters["FiducialRedshift"] = p["fid_redshift"].value
-        parameters["FiducialAngularDiameterDistance"] = YTQuantity(p["fid_d_a"].value, "Mpc")
-        dims = p["dimension"].value
-        if not isinstance(dims, np.ndarray):
-            dims = np.array([dims]*3)
-        parameters["Dimension"] = dims
-        width = p["width"].value
-        if not isinstance(width, np.ndarray):
-            width = np.array([width]*3)
-        parameters["Width"] = YTArray(width, "kpc")
-        parameters["HubbleConstant"] = p["hubble"].value
-        parameters["OmegaMatter"] = p["omega_matter"].value
-        parameters["OmegaLambda"] = p["omega_lambda"].value
-        if "data_type" in p:
-            parameters["DataType"] = force_unicode(p["data_type"].value)
-        else:
-            parameters["DataType"] = "cells"
+        parameters = read_photon_parameters(f)
 
         d = f["/data"]
 
-        num_cells = d["x"][:].shape[0]
-        start_c = comm.rank*num_cells//comm.size
-        end_c = (comm.rank+1)*num_cells//comm.size
-
-        photons["x"] = YTArray(d["x"][start_c:end_c], "kpc")
-        photons["y"] = YTArray(d["y"][start_c:end_c], "kpc")
-        photons["z"] = YTArray(d["z"][start_c:end_c], "kpc")
-        photons["dx"] = YTArray(d["dx"][start_c:end_c], "kpc")
-        photons["vx"] = YTArray(d["vx"][start_c:end_c], "km/s")
-        photons["vy"] = YTArray(d["vy"][start_c:end_c], "km/s")
-        photons["vz"] = YTArray(d["vz"][start_c:end_c], "km/s")
-
-        n_ph = d["num_photons"][:]
+        if emin is not None:
+            emin = parse_value(emin, "keV").v
+        if emax is not None:
+            emax = parse_value(emax, "keV").v
+        band = emin is not None or emax is not None
+        if lazy and (band or region is not None or box is not None):
+            raise RuntimeError("The photons in a region or energy band cannot be read lazily!")
+
+        num_cells = d["x"].shape[0]
+        if region is None and box is None:
+            weights = d["num_photons"] if partition == "photons" else None
+            start_c, end_c = get_rank_range(num_cells, weights)
+
+        if lazy:
+            if comm.size == 1:
+                start_e, end_e = 0, d["energy"].shape[0]
+            else:
+                n_ph = d["num_photons"][:end_c]
+                start_e = n_ph[:start_c].sum(dtype="int64")
+                end_e = start_e + n_ph[start_c:].sum(dtype="int64")
+            for key, name in photon_datasets.items():
+                if key == "Energy":
+                    start, end = start_e, end_e
+                else:
+                    start, end = start_c, end_c
+                if precision is None:
+                    dtype = None
+                else:
+                    dtype = get_photon_dtype(key, precision)
+                photons[key] = LazyPhotonArray(d[name], start, end, dtype=dtype,
+                                               units=photon_units.get(key, None))
+
+        elif region is not None or box is not None:
+            if region is not None:
+                center = parse_array(region[0], "kpc").d
+                radius = parse_value(region[1], "kpc").v
+                le, re = center-radius, center+radius
+            else:
+                le = parse_array(box[0], "kpc").d
+                re = parse_array(box[1], "kpc").d
+            data = read_photons_in_box(f, le, re)
+            pos = [data[ax].astype("float64") for ax in "xyz"]
+            if region is not None:
+                r2 = sum((pos[i]-center[i])**2 for i in range(3))
+                inside = r2 <= radius*radius
+            else:
+                inside = np.all([(pos[i] >= le[i]) & (pos[i] <= re[i])
+                                 for i in range(3)], axis=0)
+            select_cells(data, inside)
+            if band:
+                select_energy_band(data, emin, emax,
+                                   sorted_energies="energy_min" in d)
+            # The cells which are read are split between the processors
+            n_ph = data["NumberOfPhotons"]
+            weights = n_ph if partition == "photons" else None
+            start_c, end_c = get_rank_range(n_ph.size, weights)
+            start_e = n_ph[:start_c].sum(dtype="int64")
+            end_e = start_e + n_ph[start_c:end_c].sum(dtype="int64")
+            for key in data:
+                if key == "Energy":
+                    photons[key] = data[key][start_e:end_e]
+                else:
+                    photons[key] = data[key][start_c:end_c]
 
-        if comm.rank == 0:
-            start_e = np.int64(0)
         else:
-            start_e = n_ph[:start_c].sum()
-        end_e = start_e + np.int64(n_ph[start_c:end_c].sum())
-
-        photons["NumberOfPhotons"] = n_ph[start_c:end_c]
-        photons["Energy"] = YTArray(d["energy"][start_e:end_e], "keV")
+            n_ph = d["num_photons"][:end_c].astype("int64")
+            p_bins = np.insert(np.cumsum(n_ph), 0, 0)
+            if band and "energy_min" in d:
+                # Cells whose photons all lie outside of the band are not read
+                e_lo = d["energy_min"][start_c:end_c]
+                e_hi = d["energy_max"][start_c:end_c]
+                keep = n_ph[start_c:end_c] > 0
+                if emin is not None:
+                    keep &= e_hi >= emin
+                if emax is not None:
+                    keep &= e_lo <= emax
+                ranges = get_cell_runs(keep, start_c, p_bins)
+            else:
+                ranges = [[start_c, end_c, p_bins[start_c], p_bins[end_c]]]
+            photons = read_photon_ranges(d, ranges)
+            if band:
+                select_energy_band(photons, emin, emax,
+                                   sorted_energies="energy_min" in d)
 
-        f.close()
+        if not lazy:
+            f.close()
+            for key in photons:
+                if key in photon_units:
+                    photons[key] = YTArray(photons[key], photon_units[key])
+            set_precision(photons, precision)
 
         cosmo = Cosmology(hubble_constant=parameters["HubbleConstant"],
                           omega_matter=parameters["OmegaMatter"],
                           omega_lambda=parameters["OmegaLambda"])
 
-        return cls(photons, parameters, cosmo)
+        photon_list = cls(photons, parameters, cosmo)
+        if lazy:
+            photon_list._file = f
+        return photon_list
+
+    @staticmethod
+    def info(filename):
+        r"""
+        Return a dict summarizing the photons in the photon file *filename*,
+        read from the summary stored with them (see
+        :meth:`~pyxsim.photon_list.PhotonList.write_h5_file`), so that none
+        of the photons are read. For files without one, it is computed by
+        reading through the photons. The dict has:
+
+        * "parameters": The parameters of the photons.
+        * "num_cells", "num_photons": The numbers of cells and photons.
+        * "left_edge", "right_edge": The smallest and largest positions of
+          the cells along each axis.
+        * "energy_min", "energy_max": The smallest and largest energies of
+          the photons, or None if there are none.
+        * "spectrum_bins", "spectrum": The numbers of photons in logarithmic
+          energy bins between 0.01 and 100 keV, with those outside of them
+          in the first or last bin.
+        * "image_width", "images": The numbers of photons projected along
+          each axis, in a dict of 64x64 images keyed by "x", "y" and "z",
+          which span *image_width* around the center of the source. The
+          other two axes are in order, so the image for "y" is (x, z).
+
+        Examples
+        --------
+        >>> info = PhotonList.info("my_photons.h5")
+        >>> print(info["num_photons"], info["energy_min"], info["energy_max"])
+        """
+        f = h5py.File(filename, "r")
+        parameters = read_photon_parameters(f)
+        if "summary" in f:
+            summary = PhotonSummary.read(f)
+        else:
+            mylog.info("%s has no summary, so reading its photons to make one." % filename)
+            summary = summarize_photon_file(f)
+        f.close()
+        info = {"parameters": parameters,
+                "num_cells": summary.num_cells,
+                "num_photons": summary.num_photons,
+                "left_edge": YTArray(summary.left_edge, "kpc"),
+                "right_edge": YTArray(summary.right_edge, "kpc"),
+                "energy_min": None,
+                "energy_max": None,
+                "spectrum_bins": YTArray(summary.spectrum_bins, "keV"),
+                "spectrum": summary.spectrum,
+                "image_width": YTArray(summary.image_width, "kpc"),
+                "images": dict(zip("xyz", summary.images))}
+        if summary.num_photons > 0:
+            info["energy_min"] = YTQuantity(summary.energy_min, "keV")
+            info["energy_max"] = YTQuantity(summary.energy_max, "keV")
+        return info
 
     @classmethod
     def from_data_source(cls, data_source, redshift, area,
                          exp_time, source_model, parameters=None,
                          center=None, dist=None, cosmology=None,
-                         velocity_fields=None):
+                         velocity_fields=None, nthreads=1, nprocs=1,
+                         prefetch=0, photon_file=None, checkpoint_interval=None,
+                         resume=False, cache=None, precision="double",
+                         schedule="static"):
         r"""
         Initialize a :class:`~pyxsim.photon_list.PhotonList` from a yt data source.
         The redshift, collecting area, exposure time, and cosmology are stored in the
@@ -233,6 +1226,73 @@ class PhotonList(object):
             be assumed:
             ['velocity_x', 'velocity_y', 'velocity_z'] for grid datasets
             ['particle_velocity_x', 'particle_velocity_y', 'particle_velocity_z'] for particle datasets
+        nthreads : integer, optional
+            The number of threads used to generate the photons from the chunks of
+            the data source. The chunks are read by the calling thread and handed
+            off to the pool, so this is most useful when generating the photons is
+            more expensive than reading the data. Each chunk draws from its own
+            stream, so the photons do not depend on the number of threads; a
+            legacy :class:`~numpy.random.RandomState` seeds a new one for each
+            chunk. This may be combined with MPI. Default: 1
+        nprocs : integer, optional
+            The number of worker processes used to read the chunks of the data
+            source and generate the photons from them. Each process reopens the
+            dataset from disk, so any derived fields that the source model uses
+            must be available when the dataset is loaded (e.g., defined with
+            :func:`~yt.add_field`). Cannot be combined with *nthreads*. This may
+            be combined with MPI. Default: 1
+        prefetch : integer, optional
+            The number of chunks to read ahead in a background thread while the
+            photons are generated from the current one, which hides the time
+            spent waiting on the disk. If *nprocs* > 1, each worker process reads
+            ahead. Default: 0
+        photon_file : string, optional
+            If set, the photons of each chunk are written to this HDF5 file as
+            they are generated, in the layout of
+            :meth:`~pyxsim.photon_list.PhotonList.write_h5_file`, rather than
+            being held in memory until all of the chunks are done, and the
+            returned :class:`~pyxsim.photon_list.PhotonList` reads its photons
+            from it lazily (see :meth:`~pyxsim.photon_list.PhotonList.from_file`),
+            so it should be closed when it is no longer needed. Under MPI, each processor writes its own file, which are merged
+            into *photon_file* at the end. An existing file will be overwritten,
+            unless *resume* is True.
+        checkpoint_interval : float, optional
+            If set, the chunks which are done and the state of the random number
+            generator are recorded in *photon_file*, which is flushed to disk, at
+            least this many seconds apart, so that the run can be resumed if it
+            is interrupted. Requires *photon_file*. Default: None
+        resume : boolean, optional
+            If True and *photon_file* holds a checkpoint from an interrupted run
+            with the same parameters, the photons from the chunks which are done
+            are kept and only the remaining chunks are generated. The run must use
+            the same data source, source model, and number of MPI processors, and
+            the photons will be the same as those of an uninterrupted run if the
+            source model uses an integer seed, a :class:`~numpy.random.Generator`,
+            or a :class:`~pyxsim.rng.CellKeyedPRNG`. Requires *photon_file*.
+            Default: False
+        cache : :class:`~pyxsim.photon_cache.PhotonCache` or string, optional
+            A cache of photon lists, or the directory of one. If photons have
+            already been generated with the same dataset, data source, source
+            model state (including its random number generator), numbers of
+            threads and processes, and other arguments, they are read from the
+            cache (and copied to *photon_file*, if it is set). Otherwise, the
+            photons which are generated are stored in it.
+            Default: None
+        precision : string, optional
+            The precision of the photon arrays, either "double" for 64-bit
+            floats and integers or "single" for 32-bit floats and integers,
+            which takes up half of the memory and disk space. The positions are
+            computed in double precision relative to the *center* before they
+            are stored. Default: "double"
+        schedule : string, optional
+            How the chunks of the data source are assigned to the processors
+            when running in parallel with MPI. "static" hands them out in turn.
+            "cost" estimates the cost of each chunk from the fields of the source
+            model in a quick pass over the data source, and balances the chunks
+            between the processors by their costs. "dynamic" lets each processor
+            take the next chunk which has not been taken as soon as it is done
+            with its last one, which requires MPI-3. The processes of *nprocs*
+            always use "static". Default: "static"
 
         Examples
         --------
@@ -248,57 +1308,44 @@ class PhotonList(object):
 
         if parameters is None:
              parameters = {}
-        if cosmology is None:
-            if hasattr(ds, 'cosmology'):
-                cosmo = ds.cosmology
-            else:
-                cosmo = Cosmology()
-        else:
-            cosmo = cosmology
-        mylog.info("Cosmology: h = %g, omega_matter = %g, omega_lambda = %g" %
-                   (cosmo.hubble_constant, cosmo.omega_matter, cosmo.omega_lambda))
-        if dist is None:
-            if redshift <= 0.0:
-                msg = "If redshift <= 0.0, you must specify a distance to the source using the 'dist' argument!"
-                mylog.error(msg)
-                raise ValueError(msg)
-            D_A = cosmo.angular_diameter_distance(0.0, redshift).in_units("Mpc")
-        else:
-            D_A = parse_value(dist, "Mpc")
-            if redshift > 0.0:
-                mylog.warning("Redshift must be zero for nearby sources. Resetting redshift to 0.0.")
-                redshift = 0.0
-
-        if center == "center" or center == "c":
-            parameters["center"] = ds.domain_center
-        elif center == "max" or center == "m":
-            parameters["center"] = ds.find_max("density")[-1]
-        elif iterable(center):
-            if isinstance(center, YTArray):
-                parameters["center"] = center.in_units("code_length")
-            elif isinstance(center, tuple):
-                if center[0] == "min":
-                    parameters["center"] = ds.find_min(center[1])[-1]
-                elif center[0] == "max":
-                    parameters["center"] = ds.find_max(center[1])[-1]
-                else:
-                    raise RuntimeError
-            else:
-                parameters["center"] = ds.arr(center, "code_length")
-        elif center is None:
-            parameters["center"] = data_source.get_field_parameter("center")
-
-        parameters["FiducialExposureTime"] = parse_value(exp_time, "s")
-        parameters["FiducialArea"] = parse_value(area, "cm**2")
-        parameters["FiducialRedshift"] = redshift
-        parameters["FiducialAngularDiameterDistance"] = D_A
-        parameters["HubbleConstant"] = cosmo.hubble_constant
-        parameters["OmegaMatter"] = cosmo.omega_matter
-        parameters["OmegaLambda"] = cosmo.omega_lambda
-
-        D_A = parameters["FiducialAngularDiameterDistance"].in_cgs()
-        dist_fac = 1.0/(4.*np.pi*D_A.value*D_A.value*(1.+redshift)**2)
-        spectral_norm = parameters["FiducialArea"].v*parameters["FiducialExposureTime"].v*dist_fac
+        cosmo = get_cosmology(ds, cosmology)
+        D_A, redshift = get_distance(cosmo, redshift, dist)
+
+        if cache is not None:
+            if isinstance(cache, string_types):
+                cache = PhotonCache(cache)
+            ds_id = (ds.unique_identifier, os.path.join(ds.fullpath, ds.basename),
+                     str(ds), ds.current_time)
+            ds_args = [getattr(data_source, arg) for arg in data_source._con_args]
+            # The mean molecular weight may be set by the setup of a thermal
+            # model, from the other field parameters
+            field_params = dict((key, value) for key, value
+                                in data_source.field_parameters.items()
+                                if key != "mean_molecular_weight")
+            cosmo_params = [cosmo.hubble_constant, cosmo.omega_matter,
+                            cosmo.omega_lambda, cosmo.omega_curvature]
+            # The model is hashed in the state it is in before it is set up
+            model_key = cache.get_model_key(source_model)
+            cache_key = cache.get_key(ds_id, data_source._type_name, ds_args,
+                                      field_params, model_key,
+                                      redshift, area, exp_time, parameters, center,
+                                      D_A, cosmo_params, velocity_fields, precision,
+                                      nthreads, nprocs)
+            cached_file = cache.get(cache_key)
+            if cached_file is not None:
+                mylog.info("Reading the photons from the cache file %s." % cached_file)
+                cache.update_model_key(source_model, model_key)
+                if photon_file is None:
+                    return cls.from_file(cached_file)
+                if comm.rank == 0:
+                    shutil.copyfile(cached_file, photon_file)
+                comm.barrier()
+                return cls.from_file(photon_file, lazy=True)
+
+        parameters["center"] = determine_center(ds, data_source, center)
+
+        spectral_norm = set_fiducial_parameters(parameters, area, exp_time,
+                                                redshift, D_A, cosmo)
 
         source_model.setup_model(data_source, redshift, spectral_norm)
 
@@ -312,71 +1359,356 @@ class PhotonList(object):
         else:
             parameters["DataType"] = "particles"
 
-        if hasattr(data_source, "left_edge"):
-            # Region or grid
-            le = data_source.left_edge
-            re = data_source.right_edge
-        elif hasattr(data_source, "radius") and not hasattr(data_source, "height"):
-            # Sphere
-            le = -data_source.radius+data_source.center
-            re = data_source.radius+data_source.center
-        else:
-            # Compute rough boundaries of the object
-            # DOES NOT WORK for objects straddling periodic
-            # boundaries yet
-            if sum(ds.periodicity) > 0:
-                mylog.warning("You are using a region that is not currently "
-                              "supported for straddling periodic boundaries. "
-                              "Check to make sure that this is not the case.")
-            le = ds.arr(np.zeros(3), "code_length")
-            re = ds.arr(np.zeros(3), "code_length")
-            for i, ax in enumerate(p_fields):
-                le[i], re[i] = data_source.quantities.extrema(ax)
-
-        dds_min = get_smallest_dds(ds, parameters["DataType"])
-        le = np.rint((le-ds.domain_left_edge)/dds_min)*dds_min+ds.domain_left_edge
-        re = ds.domain_right_edge-np.rint((ds.domain_right_edge-re)/dds_min)*dds_min
-        width = re-le
-        parameters["Dimension"] = np.rint(width/dds_min).astype("int")
-        parameters["Width"] = parameters["Dimension"]*dds_min.in_units("kpc")
-
-        citer = data_source.chunks([], "io")
+        le, re = get_source_edges(data_source, p_fields, parameters)
+
+        # If the source model uses a keyed generator, the random numbers for
+        # each cell or particle are keyed by its ID, so we need to hand the
+        # IDs of each chunk to the model. If it uses a Generator, each chunk
+        # gets its own child stream, which depends only on the index of the
+        # chunk and not on the processor which handles it.
+        prng = source_model.prng
+        id_field = None
+        if isinstance(prng, CellKeyedPRNG) and parameters["DataType"] == "particles":
+            if (source_model.source_type, "particle_index") in ds.field_list:
+                id_field = (source_model.source_type, "particle_index")
+        chunk_prng = ChunkStreams(prng, p_fields, id_field)
+
+        if nthreads > 1 and nprocs > 1:
+            raise RuntimeError("Only one of nthreads and nprocs may be greater than 1!")
+
+        # Check the precision and schedule before generating anything
+        get_photon_dtype("x", precision)
+        if schedule not in schedules:
+            raise ValueError("schedule must be one of %s, not '%s'!" % (schedules, schedule))
+        if nprocs > 1 and schedule != "static":
+            mylog.warning("The chunks are always assigned statically when nprocs > 1.")
+            schedule = "static"
+
+        if (checkpoint_interval is not None or resume) and photon_file is None:
+            raise RuntimeError("Checkpointing and resuming require a photon_file!")
+
+        model_fields = source_model.get_fields()
+        if (nthreads > 1 or prefetch > 0) and model_fields is None:
+            mylog.warning("The source model does not report the fields it uses, "
+                          "so the chunks will not be read ahead, and the photons "
+                          "will be generated with one thread.")
+            nthreads = 1
+            prefetch = 0
+
+        # These are the fields which must be read from each chunk if it is
+        # to be handled after the next chunk has been reached
+        if model_fields is None:
+            chunk_fields = None
+        else:
+            chunk_fields = model_fields + p_fields + v_fields
+            for field in [w_field, id_field]:
+                if field is not None:
+                    chunk_fields.append(field)
+
+        done = set()
+        if photon_file is None:
+            writer = None
+        else:
+            if comm.rank == 0:
+                filename = photon_file
+            else:
+                filename = "%s.%d" % (photon_file, comm.rank)
+            writer = PhotonWriter(filename, parameters, resume=resume,
+                                  precision=precision, transform=lambda photons:
+                                  translate_photons(photons, ds, le, re,
+                                                    parameters["center"]))
+            if writer.state is not None:
+                if writer.attrs["comm_size"] != comm.size:
+                    raise RuntimeError("The checkpoint in %s was written by " % filename +
+                                       "%d processors, " % writer.attrs["comm_size"] +
+                                       "but this run has %d!" % comm.size)
+                chunk_prng.set_state(writer.state)
+                done.update(writer.chunks)
+            # Unless the chunks are assigned statically, another processor
+            # may have done some of the chunks this one is given
+            done = set(comm.par_combine_object(list(done), datatype="list", op="cat"))
+        last_checkpoint = [time.time()]
+
+        def write_photons(chunk_ids):
+            if writer is None:
+                return
+            writer.write(photons, chunk_ids)
+            if checkpoint_interval is not None and \
+                time.time()-last_checkpoint[0] >= checkpoint_interval:
+                writer.checkpoint(chunk_prng.get_state(), comm_size=comm.size)
+                last_checkpoint[0] = time.time()
+
+        chunks = schedule_chunks(data_source, source_model, schedule)
+        if len(done) > 0:
+            chunks = ((i, chunk) for i, chunk in chunks if i not in done)
+        if nthreads > 1 or prefetch > 0:
+            chunks = read_chunks(chunks, chunk_fields)
+        if prefetch > 0:
+            chunks = prefetch_chunks(chunks, prefetch)
 
         photons = defaultdict(list)
 
-        for chunk in parallel_objects(citer):
-
-            chunk_data = source_model(chunk)
-
-            if chunk_data is not None:
-                number_of_photons, idxs, energies = chunk_data
-                photons["NumberOfPhotons"].append(number_of_photons)
-                photons["Energy"].append(ds.arr(energies, "keV"))
-                photons["x"].append(chunk[p_fields[0]][idxs].in_units("kpc"))
-                photons["y"].append(chunk[p_fields[1]][idxs].in_units("kpc"))
-                photons["z"].append(chunk[p_fields[2]][idxs].in_units("kpc"))
-                photons["vx"].append(chunk[v_fields[0]][idxs].in_units("km/s"))
-                photons["vy"].append(chunk[v_fields[1]][idxs].in_units("km/s"))
-                photons["vz"].append(chunk[v_fields[2]][idxs].in_units("km/s"))
-                if w_field is None:
-                    photons["dx"].append(ds.arr(np.zeros(len(idxs)), "kpc"))
-                else:
-                    photons["dx"].append(chunk[w_field][idxs].in_units("kpc"))
+        try:
+            if nprocs > 1:
+
+                from pyxsim.process_pool import generate_photons_in_processes
+                # The processes cannot share a stream, and the model is pickled
+                # without one since each chunk is given its own
+                chunk_prng.seed_chunks()
+                source_model.prng = None
+                generate_photons_in_processes(photons, data_source, source_model,
+                                              chunk_prng, (p_fields, v_fields, w_field),
+                                              nprocs, rank=comm.rank, size=comm.size,
+                                              chunk_fields=chunk_fields,
+                                              prefetch=prefetch, skip=done,
+                                              callback=write_photons,
+                                              precision=precision)
+
+            elif nthreads > 1:
+
+                # The threads cannot share a legacy stream, or the photons
+                # would depend on the order in which they draw from it
+                chunk_prng.seed_chunks()
+                thread_prng = ThreadLocalPRNG()
+                source_model.prng = thread_prng
+
+                def generate_photons(i, chunk):
+                    thread_prng.set_prng(chunk_prng(i, chunk))
+                    return source_model(chunk)
+
+                pool = ThreadPool(nthreads)
+                pending = deque()
+                try:
+                    for i, chunk in chunks:
+                        pending.append((i, chunk, pool.apply_async(generate_photons, (i, chunk))))
+                        # Bound the number of chunks held in memory, and add the
+                        # photons in the order of the chunks
+                        while len(pending) > 2*nthreads:
+                            i, chunk, result = pending.popleft()
+                            add_chunk_photons(photons, chunk, result.get(),
+                                              p_fields, v_fields, w_field,
+                                              precision=precision)
+                            write_photons([i])
+                    while len(pending) > 0:
+                        i, chunk, result = pending.popleft()
+                        add_chunk_photons(photons, chunk, result.get(),
+                                          p_fields, v_fields, w_field,
+                                          precision=precision)
+                        write_photons([i])
+                finally:
+                    pool.close()
+                    pool.join()
+
+            else:
 
+                for i, chunk in chunks:
+                    source_model.prng = chunk_prng(i, chunk)
+                    add_chunk_photons(photons, chunk, source_model(chunk),
+                                      p_fields, v_fields, w_field,
+                                      precision=precision)
+                    write_photons([i])
+        except BaseException:
+            source_model.prng = prng
+            # Keep the photons written so far, so that the run may be resumed
+            if writer is not None:
+                writer.close(complete=False)
+            raise
+
+        source_model.prng = prng
         source_model.cleanup_model()
 
+        if writer is not None:
+            if comm.rank > 0:
+                writer.close()
+            comm.barrier()
+            if comm.rank == 0:
+                writer.merge(["%s.%d" % (photon_file, rank)
+                              for rank in range(1, comm.size)])
+                writer.close()
+                mylog.info("Finished generating photons.")
+                mylog.info("Number of photons generated: %d" % writer.num_photons)
+                mylog.info("Number of cells with photons: %d" % writer.num_cells)
+            comm.barrier()
+            photon_list = cls.from_file(photon_file, lazy=True)
+            if cache is not None:
+                cache.store(cache_key, photon_list, photon_file=photon_file)
+                cache.update_model_key(source_model, model_key)
+            return photon_list
+
         concatenate_photons(photons)
 
         # Translate photon coordinates to the source center
         # Fix photon coordinates for regions crossing a periodic boundary
-        dw = ds.domain_width.to("kpc")
+        translate_photons(photons, ds, le, re, parameters["center"])
+        set_precision(photons, precision, keys=["x", "y", "z"])
+
+        for key in photons:
+            if key in photon_units:
+                photons[key] = YTArray(photons[key], photon_units[key])
+
+        mylog.info("Finished generating photons.")
+        mylog.info("Number of photons generated: %d" % int(np.sum(photons["NumberOfPhotons"])))
+        mylog.info("Number of cells with photons: %d" % len(photons["x"]))
+
+        photon_list = cls(photons, parameters, cosmo)
+        if cache is not None:
+            cache.store(cache_key, photon_list)
+            cache.update_model_key(source_model, model_key)
+        return photon_list
+
+    @classmethod
+    def from_arrays(cls, fields, positions, redshift, area, exp_time,
+                    source_model, velocities=None, widths=None, parameters=None,
+                    center=None, dist=None, cosmology=None, chunk_size=1000000,
+                    precision="double"):
+        r"""
+        Initialize a :class:`~pyxsim.photon_list.PhotonList` from arrays of
+        cell or particle data which are already in memory, without going
+        through a yt dataset. The arrays are split into chunks of
+        *chunk_size* elements which are handed straight to the *source_model*.
+
+        Parameters
+        ----------
+        fields : dict of :class:`~yt.units.yt_array.YTArray`
+            The fields which the *source_model* uses, keyed by the names it
+            is set up with (e.g., ("gas", "temperature") and
+            ("gas", "emission_measure") for a
+            :class:`~pyxsim.source_models.ThermalSourceModel`), with units.
+        positions : array_like of shape (N, 3)
+            The positions of the cells or particles. If units are not given,
+            they are assumed to be in kpc.
+        redshift : float
+            The cosmological redshift for the photons.
+        area : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`.
+            The collecting area to determine the number of photons. If units are
+            not specified, it is assumed to be in cm^2.
+        exp_time : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`.
+            The exposure time to determine the number of photons. If units are
+            not specified, it is assumed to be in seconds.
+        source_model : :class:`~pyxsim.source_models.SourceModel`
+            A source model used to generate the photons.
+        velocities : array_like of shape (N, 3), optional
+            The velocities of the cells or particles. If units are not given,
+            they are assumed to be in km/s. If not specified, they are zero.
+        widths : array_like of shape (N,), optional
+            The widths of the cells, or the smoothing lengths of the particles.
+            If units are not given, they are assumed to be in kpc. If not
+            specified, the photons are emitted from points.
+        parameters : dict, optional
+            A dictionary of parameters to be passed for the source model to use, if necessary.
+        center : array_like, optional
+            The origin of the photon spatial coordinates. If units are not given,
+            it is assumed to be in kpc. If not specified, the center of the box
+            around the positions is used.
+        dist : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            The angular diameter distance, used for nearby sources. This may be
+            optionally supplied instead of it being determined from the *redshift*
+            and given *cosmology*. If units are not specified, it is assumed to be
+            in Mpc. To use this, the redshift must be set to zero.
+        cosmology : :class:`~yt.utilities.cosmology.Cosmology`, optional
+            Cosmological information. If not supplied, LCDM with the default yt
+            parameters is assumed.
+        chunk_size : integer, optional
+            The number of cells or particles handed to the source model at a
+            time, which bounds the memory used while generating the photons.
+            Under MPI, the chunks are split between the processors.
+            Default: 1000000
+        precision : string, optional
+            The precision of the photon arrays, either "double" or "single".
+            Default: "double"
+
+        Examples
+        --------
+        >>> fields = {("gas", "temperature"): YTArray(T, "K"),
+        ...           ("gas", "emission_measure"): YTArray(EM, "cm**-3")}
+        >>> thermal_model = ThermalSourceModel(apec_model, Zmet=0.3)
+        >>> photons = PhotonList.from_arrays(fields, YTArray(pos, "kpc"), 0.05,
+        ...                                  6000.0, 2.0e5, thermal_model,
+        ...                                  velocities=YTArray(vel, "km/s"),
+        ...                                  widths=YTArray(dx, "kpc"))
+        """
+        positions = parse_array(positions, "kpc")
+        num_cells = positions.shape[0]
+        if velocities is None:
+            velocities = YTArray(np.zeros((num_cells, 3)), "km/s")
+        else:
+            velocities = parse_array(velocities, "km/s")
+        for name, arr in [("velocities", velocities)]+list(fields.items()):
+            if len(arr) != num_cells:
+                raise RuntimeError("The %s have %d elements, but there are %d positions!" %
+                                   (name, len(arr), num_cells))
+        if widths is not None:
+            widths = parse_array(widths, "kpc")
+        get_photon_dtype("x", precision)
+
+        if parameters is None:
+            parameters = {}
+        cosmo = get_cosmology(None, cosmology)
+        D_A, redshift = get_distance(cosmo, redshift, dist)
+        spectral_norm = set_fiducial_parameters(parameters, area, exp_time,
+                                                redshift, D_A, cosmo)
+
+        le = positions.min(axis=0)
+        re = positions.max(axis=0)
+        if widths is None:
+            parameters["DataType"] = "particles"
+        else:
+            parameters["DataType"] = "cells"
+            le -= 0.5*widths.max()
+            re += 0.5*widths.max()
+        if center is None:
+            parameters["center"] = 0.5*(le+re)
+        else:
+            parameters["center"] = parse_array(center, "kpc")
+        # The resolution of the image is set by the smallest width, or the
+        # whole box if there are no widths
+        width = re-le
+        if widths is not None and np.any(widths.d > 0.0):
+            dds_min = widths.d[widths.d > 0.0].min()
+        else:
+            dds_min = width.d.max()
+        parameters["Dimension"] = np.maximum(np.rint(width.d/dds_min), 1).astype("int")
+        parameters["Width"] = YTArray(parameters["Dimension"]*dds_min, "kpc")
+
+        source_model.setup_model(fields, redshift, spectral_norm)
+
+        p_fields = ["x", "y", "z"]
+        v_fields = ["vx", "vy", "vz"]
+        w_field = None if widths is None else "dx"
+        prng = source_model.prng
+        chunk_prng = ChunkStreams(prng, p_fields)
+
+        photons = defaultdict(list)
+        starts = range(0, num_cells, chunk_size)
+
+        try:
+            for i, start in parallel_objects(enumerate(starts)):
+                end = min(start+chunk_size, num_cells)
+                chunk = dict((field, arr[start:end]) for field, arr in fields.items())
+                for j, ax in enumerate("xyz"):
+                    chunk[ax] = positions[start:end,j]
+                    chunk["v"+ax] = velocities[start:end,j]
+                if widths is not None:
+                    chunk["dx"] = widths[start:end]
+                source_model.prng = chunk_prng(i, chunk)
+                add_chunk_photons(photons, chunk, source_model(chunk),
+                                  p_fields, v_fields, w_field,
+                                  precision=precision)
+        finally:
+            source_model.prng = prng
+
+        source_model.cleanup_model()
+
+        concatenate_photons(photons)
+        c = parameters["center"].d
         for i, ax in enumerate("xyz"):
-            if ds.periodicity[i] and len(photons[ax]) > 0:
-                tfl = photons[ax] < le[i].to('kpc')
-                tfr = photons[ax] > re[i].to('kpc')
-                photons[ax][tfl] += dw[i]
-                photons[ax][tfr] -= dw[i]
-            photons[ax] -= parameters["center"][i].in_units("kpc")
+            if len(photons[ax]) > 0:
+                photons[ax] -= c[i]
+        set_precision(photons, precision, keys=["x", "y", "z"])
+
+        for key in photons:
+            if key in photon_units:
+                photons[key] = YTArray(photons[key], photon_units[key])
 
         mylog.info("Finished generating photons.")
         mylog.info("Number of photons generated: %d" % int(np.sum(photons["NumberOfPhotons"])))
@@ -384,122 +1716,595 @@ class PhotonList(object):
 
         return cls(photons, parameters, cosmo)
 
-    def write_h5_file(self, photonfile):
-        """
-        Write the :class:`~pyxsim.photon_list.PhotonList` to the HDF5 file *photonfile*.
+    @classmethod
+    def from_data_sources(cls, data_sources, redshift, area, exp_time,
+                          source_model, parameters=None, centers=None,
+                          dist=None, cosmology=None, velocity_fields=None,
+                          precision="double"):
+        r"""
+        Initialize a :class:`~pyxsim.photon_list.PhotonList` for each of a
+        number of yt data sources from the same dataset, such as the halos
+        of a cosmological simulation, in a single pass over the data. The
+        source model is set up once for all of the sources, only the chunks
+        of the boxes which enclose them are read, each once, and the photons
+        of each cell are handed to each of the sources which contain it.
+
+        The cells (or particles) of a source are those whose positions it
+        contains, and their fields are read from the enclosing boxes, so
+        field parameters set on the individual sources (other than their
+        centers) are not used. Sources which overlap share the photons of
+        the cells they have in common, so they are not independent.
+
+        Parameters
+        ----------
+        data_sources : list of :class:`~yt.data_objects.data_containers.YTSelectionContainer`
+            The data sources from which the photons will be generated, which
+            must all come from the same dataset.
+        redshift : float
+            The cosmological redshift for the photons.
+        area : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`.
+            The collecting area to determine the number of photons. If units are
+            not specified, it is assumed to be in cm^2.
+        exp_time : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`.
+            The exposure time to determine the number of photons. If units are
+            not specified, it is assumed to be in seconds.
+        source_model : :class:`~pyxsim.source_models.SourceModel`
+            A source model used to generate the photons, which must report
+            the fields it uses with
+            :meth:`~pyxsim.source_models.SourceModel.get_fields`.
+        parameters : dict, optional
+            A dictionary of parameters to be passed for the source model to use,
+            if necessary. Each photon list gets its own copy.
+        centers : list, string, or array_like, optional
+            The origin of the photon spatial coordinates for each of the sources,
+            or one which is used for all of them. Accepts "c", "max", or a
+            coordinate. If not specified, pyxsim attempts to use the "center"
+            field parameter of each data source.
+        dist : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            The angular diameter distance, used for nearby sources. This may be
+            optionally supplied instead of it being determined from the *redshift*
+            and given *cosmology*. If units are not specified, it is assumed to be
+            in Mpc. To use this, the redshift must be set to zero.
+        cosmology : :class:`~yt.utilities.cosmology.Cosmology`, optional
+            Cosmological information. If not supplied, we try to get
+            the cosmology from the dataset. Otherwise, LCDM with
+            the default yt parameters is assumed.
+        velocity_fields : list of fields
+            The yt fields to use for the velocity. If not specified, the following will
+            be assumed:
+            ['velocity_x', 'velocity_y', 'velocity_z'] for grid datasets
+            ['particle_velocity_x', 'particle_velocity_y', 'particle_velocity_z'] for particle datasets
+        precision : string, optional
+            The precision of the photon arrays, either "double" or "single".
+            Default: "double"
+
+        Returns
+        -------
+        A list of :class:`~pyxsim.photon_list.PhotonList`, one for each of
+        the *data_sources*, in the same order.
+
+        Examples
+        --------
+        >>> thermal_model = ThermalSourceModel(apec_model, Zmet=0.3)
+        >>> halos = [ds.sphere(c, (r, "kpc")) for c, r in zip(centers, radii)]
+        >>> photon_lists = PhotonList.from_data_sources(halos, 0.05, 6000.0,
+        ...                                             2.0e5, thermal_model)
         """
+        if len(data_sources) == 0:
+            return []
+        ds = data_sources[0].ds
+        if any(data_source.ds is not ds for data_source in data_sources):
+            raise RuntimeError("All of the data sources must come from the same dataset!")
 
-        if parallel_capable:
+        if parameters is None:
+            parameters = {}
+        if centers is None or isinstance(centers, string_types + (tuple,)) or \
+            (np.ndim(centers) == 1 and not isinstance(centers[0], string_types)):
+            centers = [centers]*len(data_sources)
+        if len(centers) != len(data_sources):
+            raise RuntimeError("There must be one center for each data source!")
+        get_photon_dtype("x", precision)
+
+        cosmo = get_cosmology(ds, cosmology)
+        D_A, redshift = get_distance(cosmo, redshift, dist)
+        spectral_norm = set_fiducial_parameters(parameters, area, exp_time,
+                                                redshift, D_A, cosmo)
+
+        # The type of the source is only known once the model has been set
+        # up, so the edges of the regions which are read are found from the
+        # positions of all particles
+        all_fields = determine_fields(ds, "all")[0]
+        if all_fields[0] == ("index", "x"):
+            parameters["DataType"] = "cells"
+        else:
+            parameters["DataType"] = "particles"
+        all_edges = [get_source_edges(data_source, all_fields, parameters.copy())
+                     for data_source in data_sources]
+
+        # The sources are grouped into boxes which enclose them, padded by
+        # a cell to make sure that none are lost to the snapping of their
+        # edges, so that only the chunks which they touch are read
+        dds_min = get_smallest_dds(ds, parameters["DataType"]).to("code_length").d
+        dle = ds.domain_left_edge.to("code_length").d
+        dre = ds.domain_right_edge.to("code_length").d
+        groups = group_source_boxes([(le.to("code_length").d-dds_min,
+                                      re.to("code_length").d+dds_min)
+                                     for le, re in all_edges])
+
+        setup_source = ds.all_data()
+        source_model.setup_model(setup_source, redshift, spectral_norm)
+
+        boxes = []
+        for group_le, group_re, members in groups:
+            wide = group_re-group_le >= dre-dle
+            group_le[wide] = dle[wide]
+            group_re[wide] = dre[wide]
+            box = ds.box(ds.arr(group_le, "code_length"), ds.arr(group_re, "code_length"))
+            # Any field parameters set up by the model apply to every box
+            for name, value in setup_source.field_parameters.items():
+                box.set_field_parameter(name, value)
+            boxes.append((box, members))
 
-            mpi_long = get_mpi_type("int64")
-            mpi_double = get_mpi_type("float64")
+        p_fields, v_fields, w_field = determine_fields(ds, source_model.source_type)
+        if velocity_fields is not None:
+            v_fields = velocity_fields
 
-            local_num_cells = len(self.photons["x"])
-            sizes_c = comm.comm.gather(local_num_cells, root=0)
+        # The parameters and extent of each source
+        source_params = []
+        edges = []
+        for data_source, center in zip(data_sources, centers):
+            params = parameters.copy()
+            params["center"] = determine_center(ds, data_source, center)
+            le, re = get_source_edges(data_source, p_fields, params)
+            source_params.append(params)
+            edges.append((le.to("code_length").d, re.to("code_length").d))
+        # Sources which cross a periodic boundary are checked against every chunk
+        straddles = [np.any(le < dle) or np.any(re > dre) for le, re in edges]
+
+        model_fields = source_model.get_fields()
+        if model_fields is None:
+            raise RuntimeError("Generating photons for many data sources at once "
+                               "requires a source model which reports the fields "
+                               "it uses!")
+
+        prng = source_model.prng
+        id_field = None
+        if isinstance(prng, CellKeyedPRNG) and parameters["DataType"] == "particles":
+            if (source_model.source_type, "particle_index") in ds.field_list:
+                id_field = (source_model.source_type, "particle_index")
+        chunk_prng = ChunkStreams(prng, p_fields, id_field)
+
+        chunk_fields = model_fields + p_fields + v_fields
+        for field in [w_field, id_field]:
+            if field is not None:
+                chunk_fields.append(field)
+
+        all_photons = [dict((key, []) for key in photon_datasets)
+                       for data_source in data_sources]
+
+        def group_chunks():
+            for box, members in boxes:
+                for chunk in box.chunks([], "io"):
+                    yield chunk, members
+
+        try:
+            for i, (chunk, members) in parallel_objects(enumerate(group_chunks())):
+                pos = [chunk[field].in_units("code_length").d for field in p_fields]
+                if len(pos[0]) == 0:
+                    continue
+                cmin = np.array([p.min() for p in pos])
+                cmax = np.array([p.max() for p in pos])
+                masks = {}
+                for k in members:
+                    le, re = edges[k]
+                    if not straddles[k] and (np.any(le > cmax) or np.any(re < cmin)):
+                        continue
+                    mask = data_sources[k].selector.select_points(pos[0], pos[1], pos[2], 0.0)
+                    if mask is not None and mask.any():
+                        masks[k] = mask
+                if len(masks) == 0:
+                    continue
+                # Only the cells in at least one of the sources are handed
+                # to the model
+                keep = np.logical_or.reduce(list(masks.values()))
+                sub_chunk = dict((field, chunk[field][keep]) for field in chunk_fields)
+                source_model.prng = chunk_prng(i, sub_chunk)
+                chunk_data = source_model(sub_chunk)
+                if chunk_data is None:
+                    continue
+                n_ph, idxs, energies = chunk_data
+                # Some models return a mask of the cells with photons
+                # instead of their indices
+                if idxs.dtype == bool:
+                    idxs = np.where(idxs)[0]
+                for k, mask in masks.items():
+                    in_source = mask[keep][idxs]
+                    if not in_source.any():
+                        continue
+                    add_chunk_photons(all_photons[k], sub_chunk,
+                                      (n_ph[in_source], idxs[in_source],
+                                       energies[np.repeat(in_source, n_ph)]),
+                                      p_fields, v_fields, w_field,
+                                      precision=precision)
+        finally:
+            source_model.prng = prng
 
-            local_num_photons = np.sum(self.photons["NumberOfPhotons"])
-            sizes_p = comm.comm.gather(local_num_photons, root=0)
+        source_model.cleanup_model()
 
-            if comm.rank == 0:
-                num_cells = sum(sizes_c)
-                num_photons = sum(sizes_p)
-                disps_c = [sum(sizes_c[:i]) for i in range(len(sizes_c))]
-                disps_p = [sum(sizes_p[:i]) for i in range(len(sizes_p))]
-                x = np.zeros(num_cells)
-                y = np.zeros(num_cells)
-                z = np.zeros(num_cells)
-                vx = np.zeros(num_cells)
-                vy = np.zeros(num_cells)
-                vz = np.zeros(num_cells)
-                dx = np.zeros(num_cells)
-                n_ph = np.zeros(num_cells, dtype="int64")
-                e = np.zeros(num_photons)
-            else:
-                sizes_c = []
-                sizes_p = []
-                disps_c = []
-                disps_p = []
-                x = np.empty([])
-                y = np.empty([])
-                z = np.empty([])
-                vx = np.empty([])
-                vy = np.empty([])
-                vz = np.empty([])
-                dx = np.empty([])
-                n_ph = np.empty([])
-                e = np.empty([])
-
-            comm.comm.Gatherv([self.photons["x"].d, local_num_cells, mpi_double],
-                              [x, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["y"].d, local_num_cells, mpi_double],
-                              [y, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["z"].d, local_num_cells, mpi_double],
-                              [z, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["vx"].d, local_num_cells, mpi_double],
-                              [vx, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["vy"].d, local_num_cells, mpi_double],
-                              [vy, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["vz"].d, local_num_cells, mpi_double],
-                              [vz, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["dx"].d, local_num_cells, mpi_double],
-                              [dx, (sizes_c, disps_c), mpi_double], root=0)
-            comm.comm.Gatherv([self.photons["NumberOfPhotons"], local_num_cells, mpi_long],
-                              [n_ph, (sizes_c, disps_c), mpi_long], root=0)
-            comm.comm.Gatherv([self.photons["Energy"].d, local_num_photons, mpi_double],
-                              [e, (sizes_p, disps_p), mpi_double], root=0)
-
-        else:
-
-            x = self.photons["x"].d
-            y = self.photons["y"].d
-            z = self.photons["z"].d
-            vx = self.photons["vx"].d
-            vy = self.photons["vy"].d
-            vz = self.photons["vz"].d
-            dx = self.photons["dx"].d
-            n_ph = self.photons["NumberOfPhotons"]
-            e = self.photons["Energy"].d
+        photon_lists = []
+        for k, photons in enumerate(all_photons):
+            params = source_params[k]
+            le, re = edges[k]
+            concatenate_photons(photons)
+            translate_photons(photons, ds, ds.arr(le, "code_length"),
+                              ds.arr(re, "code_length"), params["center"])
+            set_precision(photons, precision, keys=["x", "y", "z"])
+            for key in photons:
+                if key in photon_units:
+                    photons[key] = YTArray(photons[key], photon_units[key])
+            photon_lists.append(cls(photons, params, cosmo))
+
+        mylog.info("Finished generating photons for %d sources." % len(data_sources))
+        mylog.info("Number of photons generated: %d" %
+                   sum(int(np.sum(p["NumberOfPhotons"])) for p in photon_lists))
+
+        return photon_lists
 
-        if comm.rank == 0:
+    @classmethod
+    def from_dataset_series(cls, ts, redshift, area, exp_time, source_model,
+                            photon_files, data_source=None, njobs=1, **kwargs):
+        r"""
+        Generate the photons from each output of a time series with
+        :meth:`~pyxsim.photon_list.PhotonList.from_data_source`, writing
+        those of each output to its own photon file. The spectra of the
+        source model are prepared once and reused for all of the outputs,
+        and the outputs may be handled concurrently by a pool of processes.
 
-            f = h5py.File(photonfile, "w")
+        Each output gets its own stream of random numbers from the
+        *prng* of the source model, which depends only on its position in
+        the series, so the photons are the same however many processes are
+        used.
 
-            # Parameters
+        Parameters
+        ----------
+        ts : :class:`~yt.data_objects.time_series.DatasetSeries` or list of strings
+            The time series, or the filenames of its outputs.
+        redshift : float
+            The cosmological redshift for the photons, which is the same for
+            all of the outputs.
+        area : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`.
+            The collecting area to determine the number of photons. If units are
+            not specified, it is assumed to be in cm^2.
+        exp_time : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`.
+            The exposure time to determine the number of photons. If units are
+            not specified, it is assumed to be in seconds.
+        source_model : :class:`~pyxsim.source_models.SourceModel`
+            A source model used to generate the photons.
+        photon_files : string or list of strings
+            The HDF5 files to write the photons of each output to, or a
+            pattern which is formatted with the index of each output, e.g.
+            "photons_%04d.h5".
+        data_source : function, optional
+            A function which takes a dataset and returns the data source to
+            generate the photons from, e.g. a sphere around its densest point.
+            If *njobs* > 1, this must be a function defined at the top level
+            of a module, so that it can be sent to the worker processes. If not
+            specified, all of the data in each output is used.
+        njobs : integer, optional
+            The number of outputs to generate the photons from at the same
+            time, each in its own worker process, which loads the output from
+            disk. Cannot be used with MPI. Default: 1
+
+        Any other keyword arguments (e.g., *center*, *dist*, or *precision*)
+        are passed to :meth:`~pyxsim.photon_list.PhotonList.from_data_source`.
+
+        Returns
+        -------
+        The list of photon files, one for each output.
 
-            p = f.create_group("parameters")
-            p.create_dataset("fid_area", data=float(self.parameters["FiducialArea"]))
-            p.create_dataset("fid_exp_time", data=float(self.parameters["FiducialExposureTime"]))
-            p.create_dataset("fid_redshift", data=self.parameters["FiducialRedshift"])
-            p.create_dataset("hubble", data=self.parameters["HubbleConstant"])
-            p.create_dataset("omega_matter", data=self.parameters["OmegaMatter"])
-            p.create_dataset("omega_lambda", data=self.parameters["OmegaLambda"])
-            p.create_dataset("fid_d_a", data=float(self.parameters["FiducialAngularDiameterDistance"]))
-            p.create_dataset("dimension", data=self.parameters["Dimension"])
-            p.create_dataset("width", data=self.parameters["Width"].v)
-            p.create_dataset("data_type", data=self.parameters["DataType"])
+        Examples
+        --------
+        >>> def get_sphere(ds):
+        ...     return ds.sphere("max", (500., "kpc"))
+        >>> ts = yt.load("DD????/DD????")
+        >>> thermal_model = ThermalSourceModel(apec_model, Zmet=0.3, prng=24)
+        >>> photon_files = PhotonList.from_dataset_series(ts, 0.05, 3000.0, 1.0e5,
+        ...                                               thermal_model,
+        ...                                               "photons_%04d.h5",
+        ...                                               data_source=get_sphere)
+        """
+        filenames = get_series_filenames(ts)
+        if isinstance(photon_files, string_types):
+            photon_files = [photon_files % i for i in range(len(filenames))]
+        if len(photon_files) != len(filenames):
+            raise RuntimeError("There must be one photon file for each output!")
+        if njobs > 1 and comm.size > 1:
+            raise RuntimeError("The outputs of a time series cannot be handled "
+                               "by multiple processes when running under MPI!")
+
+        # The spectra are prepared once here, and are kept by the model
+        # (and sent along with it to the worker processes) for every output
+        spectral_model = getattr(source_model, "spectral_model", None)
+        if spectral_model is not None:
+            if kwargs.get("dist", None) is not None:
+                redshift = 0.0
+            spectral_model.prepare_spectrum(redshift)
+            spectral_model.keep_spectrum = True
+
+        # Each output gets its own stream of random numbers, as each chunk
+        # of a data source does
+        prng = source_model.prng
+        if isinstance(prng, CellKeyedPRNG):
+            prngs = [prng]*len(filenames)
+        else:
+            series_prng = ChunkStreams(prng, None)
+            series_prng.seed_chunks()
+            prngs = [series_prng(i, None) for i in range(len(filenames))]
+
+        try:
+            if njobs > 1:
+                from pyxsim.process_pool import generate_series_in_processes
+                source_model.prng = None
+                generate_series_in_processes(filenames, photon_files, prngs,
+                                             source_model, data_source, njobs,
+                                             (redshift, area, exp_time), kwargs)
+            else:
+                for i, ds in enumerate(ts):
+                    if isinstance(ds, string_types):
+                        ds = load(ds)
+                    mylog.info("Generating photons from %s (%d of %d)." %
+                               (ds, i+1, len(filenames)))
+                    source_model.prng = prngs[i]
+                    source = ds.all_data() if data_source is None else data_source(ds)
+                    # The photons are only written to the file, so the lazily
+                    # read photon list is closed without reading any of them
+                    cls.from_data_source(source, redshift, area, exp_time, source_model,
+                                         photon_file=photon_files[i], **kwargs).close()
+        finally:
+            source_model.prng = prng
+            if spectral_model is not None:
+                spectral_model.keep_spectrum = False
+                spectral_model.cleanup_spectrum()
+        return photon_files
+
+    def write_h5_file(self, photonfile, precision=None, parallel_io="auto",
+                      spatial_index=False, index_level=6, energy_index=False,
+                      io_options=None, mode="w"):
+        """
+        Write the :class:`~pyxsim.photon_list.PhotonList` to the HDF5 file *photonfile*.
+        If *precision* is "single" or "double", the photon arrays are written as
+        single or double precision floats and 32 or 64-bit integers. Otherwise,
+        they are written with the types they have in memory.
+
+        When running under MPI, *parallel_io* decides how the photons of the
+        processors are written:
+
+        * "mpio": All of the processors write their own slices of the file at
+          once, using the MPI-IO driver of h5py, which must be built with
+          parallel HDF5.
+        * "virtual": Each processor writes its photons to its own file,
+          *photonfile*.<rank>, and *photonfile* joins them together with
+          virtual datasets, which requires HDF5 1.10. The files of the
+          processors must be kept in the same directory as *photonfile*.
+        * "gather": The photons are gathered onto the root processor, which
+          writes them, so it must have the memory to hold all of them.
+        * "auto": "mpio" if it is available, then "virtual", then "gather".
+
+        If *spatial_index* is True, the cells are sorted along a Morton (Z-order)
+        curve through a grid of 2**\ *index_level* blocks on a side around them,
+        and the offsets of the cells and photons of each block are stored, so
+        that :meth:`~pyxsim.photon_list.PhotonList.from_file` can read only the
+        cells in a given *region* or *box*. Under MPI, this sorts the photons on
+        the root processor, so they are always gathered there.
+
+        If *energy_index* is True, the energies of the photons in each cell
+        are sorted, and the smallest and largest of them are stored, so that
+        :meth:`~pyxsim.photon_list.PhotonList.from_file` can skip the cells
+        with no photons in a given energy band, and find the photons in the
+        band in each of the others by a binary search. The photon list
+        itself is not changed.
+
+        The datasets are chunked and compressed as set by *io_options*, an
+        :class:`~pyxsim.utils.HDF5Options` object, or by its defaults if it
+        is not given. Its *precision* applies to the floating-point arrays
+        after *precision*. Writing with "mpio" does not compress the datasets,
+        since HDF5 can only apply filters to collective writes.
+
+        If *mode* is "a" and *photonfile* exists, the photons are appended to
+        it instead, which requires that its datasets can be extended, as they
+        can be for files written by this method with chunked datasets. The
+        parameters of the photons must match those of the file, other than
+        the width and dimensions, which are enlarged to cover both. Only the
+        appended photons are written, with the options and types of the
+        file, and the energies of their cells are sorted and their smallest
+        and largest stored if the file has an energy index. A spatial index of the file is
+        removed. Under MPI, the photons are gathered onto the root processor
+        to append them.
+
+        The file also stores a summary of the photons, with their totals,
+        extents, and a coarse spectrum and images, which
+        :meth:`~pyxsim.photon_list.PhotonList.info` reads without reading
+        the photons. It is updated when photons are appended.
+        """
 
-            # Data
+        if mode not in ("w", "a"):
+            raise ValueError("mode must be 'w' or 'a', not '%s'!" % mode)
+        append = mode == "a" and os.path.exists(photonfile)
+        if append:
+            if spatial_index:
+                raise ValueError("The photons appended to a file cannot be "
+                                 "sorted with a spatial index!")
+            with h5py.File(photonfile, "r") as f:
+                energy_index = "energy_min" in f["data"]
 
+        if io_options is None:
+            io_options = HDF5Options()
+
+        photons = {}
+        for key in photon_datasets:
+            photons[key] = np.asarray(self.photons[key])
+        set_precision(photons, precision)
+        for key in photons:
+            photons[key] = io_options.cast(photons[key])
+
+        datasets = photon_datasets.copy()
+        if energy_index:
+            photons["EnergyMin"], photons["EnergyMax"] = sort_energies(photons)
+            datasets.update(energy_index_datasets)
+
+        if not append:
+            summary = PhotonSummary(self.parameters["Width"].d)
+            summary.add(photons)
+
+        if not parallel_capable:
+            if append:
+                with h5py.File(photonfile, "r+") as f:
+                    append_photons(f, self.parameters, photons, datasets)
+                return
+            if spatial_index:
+                photons, index = sort_photons(photons, index_level)
+            f = h5py.File(photonfile, "w")
+            write_photon_parameters(f, self.parameters)
+            d = f.create_group("data")
+            for key, name in datasets.items():
+                io_options.create_dataset(d, name, photons[key], resizable=True)
+            if spatial_index:
+                write_spatial_index(f, index)
+            summary.write(f)
+            f.close()
+            return
+
+        parallel_io = get_parallel_io(parallel_io)
+        if spatial_index and parallel_io != "gather":
+            mylog.info("Gathering the photons onto the root processor to sort them.")
+            parallel_io = "gather"
+        if append and parallel_io != "gather":
+            mylog.info("Gathering the photons onto the root processor to append them.")
+            parallel_io = "gather"
+
+        # Every processor must write the same types
+        for key in sorted(photons):
+            dtypes = comm.comm.allgather(photons[key].dtype.str)
+            photons[key] = photons[key].astype(np.result_type(*dtypes), copy=False)
+
+        local_num_cells = len(photons["x"])
+        local_num_photons = np.sum(photons["NumberOfPhotons"], dtype="int64")
+        sizes_c = comm.comm.allgather(local_num_cells)
+        sizes_p = comm.comm.allgather(local_num_photons)
+        num_cells = sum(sizes_c)
+        num_photons = sum(sizes_p)
+        disps_c = [sum(sizes_c[:i]) for i in range(len(sizes_c))]
+        disps_p = [sum(sizes_p[:i]) for i in range(len(sizes_p))]
+        if not append:
+            summary.reduce(comm)
+
+        if parallel_io == "mpio":
+
+            f = h5py.File(photonfile, "w", driver="mpio", comm=comm.comm)
+            write_photon_parameters(f, self.parameters)
             d = f.create_group("data")
-            d.create_dataset("x", data=x)
-            d.create_dataset("y", data=y)
-            d.create_dataset("z", data=z)
-            d.create_dataset("vx", data=vx)
-            d.create_dataset("vy", data=vy)
-            d.create_dataset("vz", data=vz)
-            d.create_dataset("dx", data=dx)
-            d.create_dataset("num_photons", data=n_ph)
-            d.create_dataset("energy", data=e)
+            # Creating the datasets is collective, so it must happen in the
+            # same order on every processor
+            for key in sorted(datasets):
+                arr = photons[key]
+                if key == "Energy":
+                    size, start = num_photons, disps_p[comm.rank]
+                else:
+                    size, start = num_cells, disps_c[comm.rank]
+                dset = d.create_dataset(datasets[key], (size,), dtype=arr.dtype,
+                                        **io_options.get_dataset_kwargs(size, filters=False,
+                                                                        resizable=True))
+                if arr.size > 0:
+                    dset[start:start+arr.size] = arr
+            summary.write(f)
+            f.close()
+
+        elif parallel_io == "virtual":
 
+            shards = ["%s.%d" % (photonfile, rank) for rank in range(comm.size)]
+            f = h5py.File(shards[comm.rank], "w")
+            d = f.create_group("data")
+            for key, name in datasets.items():
+                io_options.create_dataset(d, name, photons[key])
             f.close()
+            comm.barrier()
+            if comm.rank == 0:
+                f = h5py.File(photonfile, "w")
+                write_photon_parameters(f, self.parameters)
+                d = f.create_group("data")
+                for key, name in datasets.items():
+                    if key == "Energy":
+                        sizes, disps = sizes_p, disps_p
+                    else:
+                        sizes, disps = sizes_c, disps_c
+                    write_virtual_dataset(d, name, photons[key].dtype, shards,
+                                          sizes, disps)
+                summary.write(f)
+                f.close()
+
+        else:
+
+            if comm.rank > 0:
+                sizes_c = []
+                sizes_p = []
+                disps_c = []
+                disps_p = []
+
+            data = {}
+            for key, arr in photons.items():
+                mpi_type = get_mpi_type(arr.dtype.name)
+                if key == "Energy":
+                    local_num, sizes, disps = local_num_photons, sizes_p, disps_p
+                else:
+                    local_num, sizes, disps = local_num_cells, sizes_c, disps_c
+                if comm.rank == 0:
+                    data[key] = np.zeros(num_photons if key == "Energy" else num_cells,
+                                         dtype=arr.dtype)
+                else:
+                    data[key] = np.empty([], dtype=arr.dtype)
+                comm.comm.Gatherv([arr, local_num, mpi_type],
+                                  [data[key], (sizes, disps), mpi_type], root=0)
+
+            if comm.rank == 0 and append:
+                with h5py.File(photonfile, "r+") as f:
+                    append_photons(f, self.parameters, data, datasets)
+            elif comm.rank == 0:
+                if spatial_index:
+                    data, index = sort_photons(data, index_level)
+                f = h5py.File(photonfile, "w")
+                write_photon_parameters(f, self.parameters)
+                d = f.create_group("data")
+                for key, name in datasets.items():
+                    io_options.create_dataset(d, name, data[key], resizable=True)
+                if spatial_index:
+                    write_spatial_index(f, index)
+                summary.write(f)
+                f.close()
 
         comm.barrier()
 
+    def append_to_file(self, photonfile, precision=None, io_options=None):
+        """
+        Append the photons to the photon file *photonfile*, or write it if
+        it does not exist. This is the same as
+        :meth:`~pyxsim.photon_list.PhotonList.write_h5_file` with *mode*="a".
+
+        Examples
+        --------
+        >>> for i, sp in enumerate(spheres):
+        ...     photons = PhotonList.from_data_source(sp, redshift, area,
+        ...                                           exp_time, source_model,
+        ...                                           center=center)
+        ...     photons.append_to_file("all_photons.h5")
+        """
+        self.write_h5_file(photonfile, precision=precision, io_options=io_options,
+                           mode="a")
+
     def project_photons(self, normal, area_new=None, exp_time_new=None,
                         redshift_new=None, dist_new=None,
                         absorb_model=None, sky_center=None,
                         no_shifting=False, north_vector=None,
-                        prng=None):
+                        prng=None, emin=None, emax=None):
         r"""
         Projects photons onto an image plane given a line of sight.
         Returns a new :class:`~pyxsim.event_list.EventList`.
@@ -534,10 +2339,21 @@ class PhotonList(object):
             the plane of projection. If not set, an arbitrary grid-aligned north_vector
             is chosen. Ignored in the case where a particular axis (e.g., "x", "y", or
             "z") is explicitly specified.
-        prng : :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
-            A pseudo-random number generator. Typically will only be specified
+        prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
+            A pseudo-random number generator, or a seed for a new
+            :class:`~numpy.random.Generator`. Typically will only be specified
             if you have a reason to generate the same set of random numbers, such as for a
-            test. Default is the :mod:`numpy.random` module.
+            test. Default is the :mod:`numpy.random` module. If a
+            :class:`~numpy.random.Generator` is used in parallel, each processor
+            draws from its own independent stream spawned from it.
+        emin : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            The lower edge of the band of observed energies. The photons observed
+            below it are dropped before their positions are computed. If units
+            are not specified, it is assumed to be in keV.
+        emax : float, (value, unit) tuple, or :class:`~yt.units.yt_array.YTQuantity`, optional
+            The upper edge of the band of observed energies. The photons observed
+            above it are dropped before their positions are computed. If units
+            are not specified, it is assumed to be in keV.
 
         Examples
         --------
@@ -546,13 +2362,21 @@ class PhotonList(object):
         ...                                     redshift_new=0.05)
         """
 
-        if prng is None:
-            prng = np.random
+        prng = parse_prng(prng)
+        if comm.size > 1:
+            seed_seq = get_stream_seed(prng)
+            if seed_seq is not None:
+                prng = spawn_prng(seed_seq, comm.rank)
 
         if redshift_new is not None and dist_new is not None:
             mylog.error("You may specify a new redshift or distance, "+
                         "but not both!")
 
+        if emin is not None:
+            emin = parse_value(emin, "keV").v
+        if emax is not None:
+            emax = parse_value(emax, "keV").v
+
         if sky_center is None:
             sky_center = YTArray([30.,45.], "degree")
         else:
@@ -570,6 +2394,7 @@ class PhotonList(object):
             ax_idx = np.argmax(self.parameters["Width"])
         nx = self.parameters["Dimension"][ax_idx]
         dx_min = (self.parameters["Width"]/self.parameters["Dimension"])[ax_idx]
+        dx_min_kpc = dx_min.in_units("kpc").v
 
         if not isinstance(normal, string_types):
             L = np.array(normal)
@@ -578,8 +2403,7 @@ class PhotonList(object):
             y_hat = orient.unit_vectors[1]
             z_hat = orient.unit_vectors[2]
 
-        n_ph = self.photons["NumberOfPhotons"]
-        n_ph_tot = n_ph.sum()
+        n_ph_tot = self.p_bins[-1]
 
         parameters = {}
 
@@ -656,6 +2480,34 @@ class PhotonList(object):
                     del(idtm)
             # idxs = prng.permutation(n_ph_tot)[:my_n_obs].astype("int64")
         obs_cells = np.searchsorted(self.p_bins, idxs, side='right')-1
+
+        if not no_shifting:
+            if isinstance(normal, string_types):
+                vz = self.photons["v%s" % normal].d[obs_cells]
+            else:
+                vz = self.photons["vx"].d[obs_cells]*z_hat[0] + \
+                     self.photons["vy"].d[obs_cells]*z_hat[1] + \
+                     self.photons["vz"].d[obs_cells]*z_hat[2]
+
+        eobs = self.photons["Energy"].d[idxs]
+        if not no_shifting:
+            shift = -vz/ckms
+            shift = np.sqrt((1.-shift)/(1.+shift))
+            eobs *= shift
+            del(shift)
+        eobs *= scale_factor
+
+        if emin is not None or emax is not None:
+            in_band = np.ones(eobs.size, dtype="bool")
+            if emin is not None:
+                in_band &= eobs >= emin
+            if emax is not None:
+                in_band &= eobs <= emax
+            obs_cells = obs_cells[in_band]
+            eobs = eobs[in_band]
+            my_n_obs = obs_cells.size
+            del(in_band)
+
         delta = dx[obs_cells]
 
         if isinstance(normal, string_types):
@@ -671,9 +2523,6 @@ class PhotonList(object):
             xsky += self.photons[axes_lookup[normal][0]].d[obs_cells]
             ysky += self.photons[axes_lookup[normal][1]].d[obs_cells]
 
-            if not no_shifting:
-                vz = self.photons["v%s" % normal]
-
         else:
 
             if self.parameters["DataType"] == "cells":
@@ -685,11 +2534,6 @@ class PhotonList(object):
                 y = prng.normal(loc=0.0, scale=1.0, size=my_n_obs)
                 z = prng.normal(loc=0.0, scale=1.0, size=my_n_obs)
 
-            if not no_shifting:
-                vz = self.photons["vx"]*z_hat[0] + \
-                     self.photons["vy"]*z_hat[1] + \
-                     self.photons["vz"]*z_hat[2]
-
             x *= delta
             y *= delta
             z *= delta
@@ -701,18 +2545,6 @@ class PhotonList(object):
             ysky = x*y_hat[0] + y*y_hat[1] + z*y_hat[2]
 
         del(delta)
-        if no_shifting:
-            eobs = self.photons["Energy"][idxs]
-        else:
-            # shift = -vz.in_cgs()/clight
-            # shift = np.sqrt((1.-shift)/(1.+shift))
-            # eobs = self.photons["Energy"][idxs]*shift[obs_cells]
-            shift = -vz[obs_cells].in_cgs()/clight
-            shift = np.sqrt((1.-shift)/(1.+shift))
-            eobs = self.photons["Energy"][idxs]
-            eobs *= shift
-            del(shift)
-        eobs *= scale_factor
 
         if absorb_model is None:
             detected = np.ones(eobs.shape, dtype='bool')
@@ -723,9 +2555,9 @@ class PhotonList(object):
 
         dtheta = YTQuantity(np.rad2deg(dx_min/D_A), "degree")
 
-        events["xpix"] = xsky[detected]/dx_min.v + 0.5*(nx+1)
-        events["ypix"] = ysky[detected]/dx_min.v + 0.5*(nx+1)
-        events["eobs"] = eobs[detected]
+        events["xpix"] = xsky[detected]/dx_min_kpc + 0.5*(nx+1)
+        events["ypix"] = ysky[detected]/dx_min_kpc + 0.5*(nx+1)
+        events["eobs"] = YTArray(eobs[detected], "keV")
 
         events = comm.par_combine_object(events, datatype="dict", op="cat")
 
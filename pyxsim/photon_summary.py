@@ -0,0 +1,159 @@
+"""
+Summaries of the photons in photon files, which can be read without
+reading the photons
+"""
+import numpy as np
+
+# The energy bins of the coarse spectrum are the same for every file, so
+# that the spectra of files can be added together
+spectrum_bins = np.logspace(-2, 2, 81)
+image_size = 64
+
+class PhotonSummary(object):
+    """
+    The totals, extents, a coarse spectrum and coarse images of a set of
+    photons, which are added to it as they are written. The images are
+    projections along each axis of the numbers of photons in *image_size*
+    pixels on a side, across the *width* (in kpc) around the center of the
+    source. Photons outside of them are not in the images. The spectrum is
+    the number of photons in logarithmic energy bins between 0.01 and 100
+    keV, with those outside of them in the first or last bin.
+    """
+    def __init__(self, width):
+        self.num_cells = 0
+        self.num_photons = 0
+        self.left_edge = np.full(3, np.inf)
+        self.right_edge = np.full(3, -np.inf)
+        self.energy_min = np.inf
+        self.energy_max = -np.inf
+        self.spectrum_bins = spectrum_bins.copy()
+        self.spectrum = np.zeros(self.spectrum_bins.size-1, dtype="int64")
+        self.image_width = np.asarray(width, dtype="float64")*np.ones(3)
+        self.images = np.zeros((3, image_size, image_size), dtype="int64")
+
+    def add_cells(self, pos, num_photons):
+        """
+        Add the cells with positions *pos* (three arrays in kpc) and numbers
+        of photons *num_photons*.
+        """
+        num_photons = np.asarray(num_photons)
+        if num_photons.size == 0:
+            return
+        pos = [np.asarray(p, dtype="float64") for p in pos]
+        self.num_cells += num_photons.size
+        self.num_photons += int(num_photons.sum(dtype="int64"))
+        self.left_edge = np.minimum(self.left_edge, [p.min() for p in pos])
+        self.right_edge = np.maximum(self.right_edge, [p.max() for p in pos])
+        hw = 0.5*self.image_width
+        for i in range(3):
+            j, k = [ax for ax in range(3) if ax != i]
+            image = np.histogram2d(pos[j], pos[k], bins=image_size,
+                                   range=[[-hw[j], hw[j]], [-hw[k], hw[k]]],
+                                   weights=num_photons)[0]
+            self.images[i] += np.rint(image).astype("int64")
+
+    def add_energies(self, energy):
+        """
+        Add the photons with energies *energy* (in keV) to the spectrum.
+        """
+        energy = np.asarray(energy, dtype="float64")
+        if energy.size == 0:
+            return
+        self.energy_min = min(self.energy_min, energy.min())
+        self.energy_max = max(self.energy_max, energy.max())
+        energy = np.clip(energy, self.spectrum_bins[0], self.spectrum_bins[-1])
+        self.spectrum += np.histogram(energy, self.spectrum_bins)[0]
+
+    def add(self, photons):
+        """
+        Add the *photons*, a dict of photon arrays.
+        """
+        self.add_cells([photons[ax] for ax in "xyz"], photons["NumberOfPhotons"])
+        self.add_energies(photons["Energy"])
+
+    def add_summary(self, other):
+        """
+        Add the photons of another summary *other*, which must have images
+        of the same width.
+        """
+        if not np.allclose(self.image_width, other.image_width):
+            raise ValueError("Summaries with images of different widths "
+                             "cannot be added together!")
+        self.num_cells += other.num_cells
+        self.num_photons += other.num_photons
+        self.left_edge = np.minimum(self.left_edge, other.left_edge)
+        self.right_edge = np.maximum(self.right_edge, other.right_edge)
+        self.energy_min = min(self.energy_min, other.energy_min)
+        self.energy_max = max(self.energy_max, other.energy_max)
+        self.spectrum += other.spectrum
+        self.images += other.images
+
+    def reduce(self, comm):
+        """
+        Combine the summaries of all of the processors of the communicator
+        *comm*, so that each of them has the summary of all of the photons.
+        """
+        self.num_cells = comm.mpi_allreduce(self.num_cells, op="sum")
+        self.num_photons = comm.mpi_allreduce(self.num_photons, op="sum")
+        self.left_edge = comm.mpi_allreduce(self.left_edge, op="min")
+        self.right_edge = comm.mpi_allreduce(self.right_edge, op="max")
+        self.energy_min = comm.mpi_allreduce(self.energy_min, op="min")
+        self.energy_max = comm.mpi_allreduce(self.energy_max, op="max")
+        self.spectrum = comm.mpi_allreduce(self.spectrum, op="sum")
+        self.images = comm.mpi_allreduce(self.images, op="sum")
+
+    def write(self, f):
+        """
+        Write the summary to the "summary" group of the open HDF5 file or
+        group *f*, replacing any which is there.
+        """
+        if "summary" in f:
+            del f["summary"]
+        g = f.create_group("summary")
+        g.attrs["num_cells"] = self.num_cells
+        g.attrs["num_photons"] = self.num_photons
+        g.attrs["left_edge"] = self.left_edge
+        g.attrs["right_edge"] = self.right_edge
+        g.attrs["energy_min"] = self.energy_min
+        g.attrs["energy_max"] = self.energy_max
+        g.attrs["image_width"] = self.image_width
+        g.create_dataset("spectrum_bins", data=self.spectrum_bins)
+        g.create_dataset("spectrum", data=self.spectrum)
+        g.create_dataset("images", data=self.images)
+
+    @classmethod
+    def read(cls, f):
+        """
+        Read the summary in the "summary" group of the open HDF5 file or
+        group *f*.
+        """
+        g = f["summary"]
+        summary = cls(g.attrs["image_width"])
+        summary.num_cells = int(g.attrs["num_cells"])
+        summary.num_photons = int(g.attrs["num_photons"])
+        summary.left_edge = g.attrs["left_edge"]
+        summary.right_edge = g.attrs["right_edge"]
+        summary.energy_min = float(g.attrs["energy_min"])
+        summary.energy_max = float(g.attrs["energy_max"])
+        summary.spectrum_bins = g["spectrum_bins"][:]
+        summary.spectrum = g["spectrum"][:]
+        summary.images = g["images"][:]
+        return summary
+
+def summarize_photon_file(f, block_size=1048576):
+    """
+    Compute the summary of the photons in the open photon file *f*,
+    reading them *block_size* elements at a time.
+    """
+    d = f["data"]
+    width = f["parameters"]["width"][()]
+    summary = PhotonSummary(width)
+    num_cells = d["x"].shape[0]
+    for start in range(0, num_cells, block_size):
+        end = min(start+block_size, num_cells)
+        summary.add_cells([d[ax][start:end] for ax in "xyz"],
+                          d["num_photons"][start:end])
+    num_photons = d["energy"].shape[0]
+    for start in range(0, num_photons, block_size):
+        summary.add_energies(d["energy"][start:start+block_size])
+    return summary
@@ -0,0 +1,286 @@
+"""
+Generating photons with a pool of worker processes
+"""
+import os
+import itertools
+import multiprocessing
+from collections import defaultdict
+import numpy as np
+from yt.convenience import load
+from yt.units.yt_array import YTArray
+from pyxsim.utils import mylog
+from pyxsim.photon_list import add_chunk_photons, concatenate_photons, \
+    read_chunks, prefetch_chunks
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+class ArrayDescription(object):
+    """
+    A picklable description of a unitful array, which is recreated with
+    the unit registry of the reopened dataset.
+    """
+    def __init__(self, arr):
+        self.value = arr.d
+        self.units = str(arr.units)
+
+    def load(self, ds):
+        if np.ndim(self.value) == 0:
+            return ds.quan(self.value, self.units)
+        return ds.arr(self.value, self.units)
+
+class DataSourceDescription(object):
+    """
+    A picklable description of a yt data source, given by the path to
+    its dataset, the type of the data container and its arguments, and
+    its field parameters, from which the data source can be recreated
+    in another process.
+    """
+    def __init__(self, data_source):
+        ds = data_source.ds
+        self.filename = os.path.join(ds.fullpath, ds.basename)
+        if not os.path.exists(self.filename):
+            raise RuntimeError("Generating photons with multiple processes requires "
+                               "a dataset which can be reopened from disk, but "
+                               "%s does not exist!" % self.filename)
+        self.type_name = data_source._type_name
+        self.args = [self._describe(getattr(data_source, arg))
+                     for arg in data_source._con_args]
+        self.field_parameters = dict((key, self._describe(value)) for key, value
+                                     in data_source.field_parameters.items())
+
+    def _describe(self, value):
+        if isinstance(value, YTArray):
+            return ArrayDescription(value)
+        elif hasattr(value, "_con_args"):
+            return DataSourceDescription(value)
+        return value
+
+    def _load(self, value, ds):
+        if isinstance(value, (ArrayDescription, DataSourceDescription)):
+            return value.load(ds)
+        return value
+
+    def load(self, ds=None):
+        if ds is None:
+            ds = load(self.filename)
+        args = [self._load(arg, ds) for arg in self.args]
+        data_source = getattr(ds, self.type_name)(*args)
+        for key, value in self.field_parameters.items():
+            data_source.set_field_parameter(key, self._load(value, ds))
+        return data_source
+
+def pack_arrays(arrays):
+    """
+    Copy a dict of 1D *arrays* into a new block of shared memory, and
+    return its name and layout. If shared memory is not available, the
+    arrays are returned to be pickled instead.
+
+    The block is handed over to the process which calls :func:`unpack_arrays`,
+    which tracks and unlinks it, so it is not tracked by this one.
+    """
+    if shared_memory is None:
+        return None, arrays
+    nbytes = sum(arr.nbytes for arr in arrays.values())
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    layout = []
+    offset = 0
+    for key, arr in arrays.items():
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf, offset=offset)[:] = arr
+        layout.append((key, arr.dtype.str, arr.size, offset))
+        offset += arr.nbytes
+    shm.close()
+    # Otherwise, the resource tracker of this process would warn that the
+    # block leaked, and unlink it, when this process exits, even if the
+    # block has not been read yet
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm.name, layout
+
+def unpack_arrays(name, layout):
+    """
+    Copy the arrays written by :func:`pack_arrays` out of shared memory,
+    and release it. Attaching to the block tracks it in this process, and
+    unlinking it stops tracking it.
+    """
+    if name is None:
+        return layout
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for key, dtype, size, offset in layout:
+        arrays[key] = np.ndarray((size,), dtype=dtype, buffer=shm.buf,
+                                 offset=offset).copy()
+    shm.close()
+    shm.unlink()
+    return arrays
+
+# The state of each worker process, which is set up once by init_worker
+# rather than sent with every task
+worker = {}
+
+def init_worker(description, source_model, chunk_prng, fields,
+                chunk_fields, prefetch, skip, precision):
+    # If the initializer raises, the pool replaces the worker over and
+    # over, so the error is raised by the first task instead
+    try:
+        data_source = description.load()
+        source_model.setup_fields(data_source.ds)
+    except Exception as e:
+        worker["error"] = e
+        return
+    worker["data_source"] = data_source
+    worker["source_model"] = source_model
+    worker["chunk_prng"] = chunk_prng
+    worker["fields"] = fields
+    worker["chunk_fields"] = chunk_fields
+    worker["prefetch"] = prefetch
+    worker["skip"] = skip
+    worker["precision"] = precision
+
+def generate_photons(task):
+    """
+    Generate the photons from the chunks with indices *i* for which
+    i % ntasks == task_id, and send them back through shared memory.
+    Chunks which are to be skipped are sent back with no cells.
+    """
+    if "error" in worker:
+        raise worker["error"]
+    task_id, ntasks = task
+    source_model = worker["source_model"]
+    chunk_prng = worker["chunk_prng"]
+    p_fields, v_fields, w_field = worker["fields"]
+    photons = defaultdict(list)
+    chunk_ids = []
+    chunk_cells = []
+    citer = worker["data_source"].chunks([], "io")
+    skipped = []
+
+    def task_chunks():
+        for i, chunk in enumerate(citer):
+            if i % ntasks != task_id:
+                continue
+            if i in worker["skip"]:
+                skipped.append(i)
+            else:
+                yield i, chunk
+
+    chunks = task_chunks()
+    if worker["prefetch"] > 0:
+        chunks = prefetch_chunks(read_chunks(chunks, worker["chunk_fields"]),
+                                 worker["prefetch"])
+    for i, chunk in chunks:
+        source_model.prng = chunk_prng(i, chunk)
+        chunk_data = source_model(chunk)
+        chunk_ids.append(i)
+        if chunk_data is None:
+            chunk_cells.append(0)
+        else:
+            chunk_cells.append(len(chunk_data[0]))
+            add_chunk_photons(photons, chunk, chunk_data,
+                              p_fields, v_fields, w_field,
+                              precision=worker["precision"])
+    chunk_ids += skipped
+    chunk_cells += [0]*len(skipped)
+    concatenate_photons(photons)
+    return chunk_ids, chunk_cells, pack_arrays(dict(photons))
+
+def generate_photons_in_processes(photons, data_source, source_model, chunk_prng,
+                                  fields, nprocs, rank=0, size=1, chunk_fields=None,
+                                  prefetch=0, skip=(), callback=None,
+                                  precision="double"):
+    """
+    Generate the photons from *data_source* with a pool of *nprocs* worker
+    processes, each of which reopens the dataset, and append them to
+    *photons* in the order of the chunks. If running under MPI, the chunks
+    are split between the *size* processors, of which this is *rank*. If
+    *prefetch* > 0, each worker reads that many of its chunks ahead. The
+    chunks with indices in *skip* are not generated. If *callback* is
+    given, it is called with the indices of the chunks each time more of
+    them have been appended to *photons*, which happens as soon as all of
+    the chunks before them are done.
+    """
+    description = DataSourceDescription(data_source)
+    # A few tasks per worker balances the load between them while only
+    # opening the dataset once in each
+    ntasks = 4*nprocs
+    tasks = [(rank*ntasks+i, size*ntasks) for i in range(ntasks)]
+    chunks = {}
+    # The indices of the chunks handled by this processor, in order
+    stride = size*ntasks
+    my_chunks = (j*stride+k for j in itertools.count()
+                 for k in range(rank*ntasks, (rank+1)*ntasks))
+    next_chunk = next(my_chunks)
+    pool = multiprocessing.Pool(nprocs, initializer=init_worker,
+                                initargs=(description, source_model,
+                                          chunk_prng, fields, chunk_fields,
+                                          prefetch, set(skip), precision))
+    try:
+        for chunk_ids, chunk_cells, packed in pool.imap_unordered(generate_photons, tasks):
+            arrays = unpack_arrays(*packed)
+            # Split the photons of this task back up into its chunks
+            c_bins = np.cumsum([0]+chunk_cells)
+            p_bins = np.cumsum(np.insert(arrays.get("NumberOfPhotons", []), 0, 0))
+            for j, i in enumerate(chunk_ids):
+                c0, c1 = c_bins[j], c_bins[j+1]
+                e0, e1 = p_bins[c0], p_bins[c1]
+                chunks[i] = dict((key, arr[e0:e1] if key == "Energy" else arr[c0:c1])
+                                 for key, arr in arrays.items())
+            appended = []
+            while next_chunk in chunks:
+                for key, arr in chunks.pop(next_chunk).items():
+                    photons[key].append(arr)
+                appended.append(next_chunk)
+                next_chunk = next(my_chunks)
+            if len(appended) > 0 and callback is not None:
+                callback(appended)
+        mylog.info("Finished generating photons in %d processes." % nprocs)
+    finally:
+        pool.close()
+        pool.join()
+
+def init_series_worker(source_model, data_source, args, kwargs):
+    worker["source_model"] = source_model
+    worker["data_source"] = data_source
+    worker["args"] = args
+    worker["kwargs"] = kwargs
+
+def generate_series_photons(task):
+    """
+    Generate the photons from one output of a time series, given its
+    filename, the stream of random numbers it is to use, and the file to
+    write its photons to.
+    """
+    from pyxsim.photon_list import PhotonList
+    filename, prng, photon_file = task
+    source_model = worker["source_model"]
+    ds = load(filename)
+    source_model.setup_fields(ds)
+    if worker["data_source"] is None:
+        data_source = ds.all_data()
+    else:
+        data_source = worker["data_source"](ds)
+    source_model.prng = prng
+    PhotonList.from_data_source(data_source, *worker["args"], source_model=source_model,
+                                photon_file=photon_file, **worker["kwargs"]).close()
+    return photon_file
+
+def generate_series_in_processes(filenames, photon_files, prngs, source_model,
+                                 data_source, njobs, args, kwargs):
+    """
+    Generate the photons from the outputs of a time series with the
+    given *filenames* in a pool of *njobs* worker processes, each of which
+    is sent the source model once, along with its prepared spectra.
+    """
+    tasks = list(zip(filenames, prngs, photon_files))
+    pool = multiprocessing.Pool(njobs, initializer=init_series_worker,
+                                initargs=(source_model, data_source, args, kwargs))
+    try:
+        for photon_file in pool.imap_unordered(generate_series_photons, tasks):
+            mylog.info("Wrote the photons to %s." % photon_file)
+        mylog.info("Finished generating photons from %d outputs in %d processes." %
+                   (len(filenames), njobs))
+    finally:
+        pool.close()
+        pool.join()
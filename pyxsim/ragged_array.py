@@ -0,0 +1,194 @@
+"""
+A container for arrays with a different number of elements in each row
+"""
+import numpy as np
+from yt.units.yt_array import YTArray
+from pyxsim.rng import segment_offsets
+
+class RaggedArray(object):
+    r"""
+    A sequence of 1D arrays of different lengths, such as the energies of
+    the photons in each cell of a :class:`~pyxsim.photon_list.PhotonList`,
+    stored as one flat array of their elements laid end to end, *data*,
+    and the *offsets* of the rows in it, which begin with 0 and end with
+    the number of elements.
+
+    Indexing with an integer returns the elements of a row as a view of
+    *data*, and indexing with a slice returns a :class:`RaggedArray` of
+    those rows whose data is a view of *data*. Indexing with an array of
+    integers or booleans returns a :class:`RaggedArray` of copies of the
+    rows. Iterating over it gives the rows in turn, so it may be passed to
+    functions which take a sequence of arrays, but the per-row reductions
+    are much faster than doing the same in a loop over the rows.
+
+    Parameters
+    ----------
+    data : array-like
+        The elements of all of the rows, laid end to end. Units are kept
+        if it is a :class:`~yt.units.yt_array.YTArray`.
+    offsets : array-like of integers
+        The offset of the first element of each row in *data*, followed by
+        the number of elements.
+
+    Examples
+    --------
+    >>> energy = photons["Energy"]
+    >>> print(energy[10])
+    >>> total_energy = energy.sum()
+    """
+    def __init__(self, data, offsets):
+        offsets = np.asarray(offsets, dtype="int64")
+        if offsets.ndim != 1 or offsets.size == 0 or offsets[0] != 0:
+            raise ValueError("The offsets must be a 1D array beginning with 0!")
+        if offsets[-1] != len(data):
+            raise ValueError("The offsets end at %d, but there are %d elements!" %
+                             (offsets[-1], len(data)))
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_counts(cls, data, counts):
+        """
+        Create a :class:`RaggedArray` from the elements of all of the rows,
+        *data*, and the number of elements in each row, *counts*.
+        """
+        offsets = np.insert(np.cumsum(counts, dtype="int64"), 0, [np.int64(0)])
+        return cls(data, offsets)
+
+    @property
+    def counts(self):
+        """
+        The number of elements in each row.
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def units(self):
+        return getattr(self.data, "units", None)
+
+    def __len__(self):
+        return self.offsets.size-1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.data[self.offsets[i]:self.offsets[i+1]]
+
+    def __repr__(self):
+        return "RaggedArray(%d rows, %d elements)" % (len(self), self.offsets[-1])
+
+    def __getitem__(self, idxs):
+        n = len(self)
+        if isinstance(idxs, (int, np.integer)):
+            i = idxs+n if idxs < 0 else idxs
+            if i < 0 or i >= n:
+                raise IndexError("Row %d is out of bounds for %d rows!" % (idxs, n))
+            return self.data[self.offsets[i]:self.offsets[i+1]]
+        if isinstance(idxs, slice):
+            i0, i1, step = idxs.indices(n)
+            if step == 1:
+                i1 = max(i0, i1)
+                e0 = self.offsets[i0]
+                return RaggedArray(self.data[e0:self.offsets[i1]],
+                                   self.offsets[i0:i1+1]-e0)
+            idxs = np.arange(i0, i1, step)
+        idxs = np.asarray(idxs)
+        if idxs.dtype == bool:
+            idxs = np.where(idxs)[0]
+        idxs = idxs.astype("int64")
+        idxs[idxs < 0] += n
+        counts = self.counts[idxs]
+        e_idxs = np.repeat(self.offsets[idxs], counts) + segment_offsets(counts)
+        return RaggedArray.from_counts(self.data[e_idxs], counts)
+
+    def sort(self):
+        """
+        Sort the elements of each row in place.
+        """
+        data = np.asarray(self.data)
+        rows = np.repeat(np.arange(len(self)), self.counts)
+        data[:] = data[np.lexsort((data, rows))]
+
+    def searchsorted(self, values, side="left"):
+        """
+        Find the positions in each row, which must be sorted, at which
+        *values* (one for each row, or one for all of them) would be
+        inserted to keep it sorted, as :func:`~numpy.searchsorted` does
+        for a single row. The positions are returned as indices into
+        *data*, from the beginning to the end of each row.
+        """
+        if side not in ("left", "right"):
+            raise ValueError("side must be 'left' or 'right', not '%s'!" % side)
+        data = np.asarray(self.data)
+        values = np.broadcast_to(np.asarray(values), (len(self),))
+        lo = self.offsets[:-1].copy()
+        hi = self.offsets[1:].copy()
+        # A binary search in all of the rows at once, which is done once
+        # the longest row has been searched
+        rows = np.where(lo < hi)[0]
+        while rows.size > 0:
+            mid = (lo[rows]+hi[rows]) // 2
+            if side == "left":
+                above = data[mid] < values[rows]
+            else:
+                above = data[mid] <= values[rows]
+            lo[rows[above]] = mid[above]+1
+            hi[rows[~above]] = mid[~above]
+            rows = rows[lo[rows] < hi[rows]]
+        return lo
+
+    def _reduce(self, ufunc, fill):
+        data = np.asarray(self.data)
+        counts = self.counts
+        has_data = counts > 0
+        if ufunc is np.add:
+            # Sums of small integers are accumulated as larger ones
+            dtype = np.add.reduce(data[:0]).dtype
+        else:
+            dtype = data.dtype
+        ret = np.empty(len(self), dtype=np.result_type(dtype, np.min_scalar_type(fill)))
+        ret[~has_data] = fill
+        if data.size > 0:
+            # Rows with no elements are left out, so that each of the others
+            # ends where the next one begins
+            ret[has_data] = ufunc.reduceat(data, self.offsets[:-1][has_data],
+                                           dtype=dtype)
+        if self.units is not None:
+            ret = YTArray(ret, self.units)
+        return ret
+
+    def sum(self):
+        """
+        Return the sum of the elements of each row, which is 0 for rows with
+        no elements.
+        """
+        return self._reduce(np.add, 0)
+
+    def count(self):
+        """
+        Return the number of elements in each row.
+        """
+        return self.counts
+
+    def min(self, fill=np.nan):
+        """
+        Return the smallest element of each row, which is *fill* for rows
+        with no elements.
+        """
+        return self._reduce(np.minimum, fill)
+
+    def max(self, fill=np.nan):
+        """
+        Return the largest element of each row, which is *fill* for rows
+        with no elements.
+        """
+        return self._reduce(np.maximum, fill)
+
+    def mean(self):
+        """
+        Return the mean of the elements of each row, which is NaN for rows
+        with no elements.
+        """
+        counts = self.counts
+        ret = self.sum()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return ret/np.where(counts > 0, counts, np.nan)
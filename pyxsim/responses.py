@@ -6,7 +6,8 @@ by the end-user, but will be employed by methods of InstrumentSimulators.
 import numpy as np
 from yt.utilities.on_demand_imports import _astropy
 from yt.units.yt_array import YTArray
-from pyxsim.utils import mylog, check_file_location
+from pyxsim.utils import mylog, check_file_location, parse_value
+from pyxsim.rng import parse_prng
 
 class AuxiliaryResponseFile(object):
     r"""
@@ -60,15 +61,15 @@ class AuxiliaryResponseFile(object):
         area : float, tuple, or YTQuantity
             The collecting area associated with the event energies. If a floating-point
             number, is assumed to be in cm^2.
-        prng : :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
+        prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
             A pseudo-random number generator. Typically will only be specified
             if you have a reason to generate the same set of random numbers, such as for a
             test. Default is the :mod:`~numpy.random` module.
         """
-        if prng is None:
-            prng = np.random
-        earea = np.interp(energy, self.emid, self.eff_area, left=0.0, right=0.0)
-        randvec = area.v*prng.uniform(size=energy.shape)
+        prng = parse_prng(prng)
+        area = parse_value(area, "cm**2").v
+        earea = np.interp(energy, self.emid.d, self.eff_area.d, left=0.0, right=0.0)
+        randvec = area*prng.uniform(size=energy.shape)
         return randvec < earea
 
     @property
@@ -79,7 +80,7 @@ class AuxiliaryResponseFile(object):
         """
         Interpolate the effective area to the energies provided by the supplied *energy* array.
         """
-        earea = np.interp(energy, self.emid, self.eff_area, left=0.0, right=0.0)
+        earea = np.interp(energy, self.emid.d, self.eff_area.d, left=0.0, right=0.0)
         return YTArray(earea, "cm**2")
 
 class RedistributionMatrixFile(object):
@@ -0,0 +1,406 @@
+"""
+Counter-based pseudo-random number generation keyed by cell or particle ID
+"""
+import numpy as np
+from numbers import Integral
+import threading
+
+M32 = np.uint64(0xFFFFFFFF)
+S32 = np.uint64(32)
+S11 = np.uint64(11)
+
+# Philox4x64 multipliers and Weyl constants, from Salmon et al. (2011)
+philox_m = (np.uint64(0xD2E7470EE14C6C93), np.uint64(0xCA5A826395121157))
+philox_w = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xBB67AE8584CAA73B))
+
+# An arbitrary key used to hash cell positions into cell IDs
+hash_key = (np.uint64(0x5851F42D4C957F2D), np.uint64(0x14057B7EF767814F))
+
+def mulhilo(a, b):
+    b_lo = b & M32
+    b_hi = b >> S32
+    a_lo = a & M32
+    a_hi = a >> S32
+    p0 = a_lo*b_lo
+    p1 = a_lo*b_hi
+    p2 = a_hi*b_lo
+    p3 = a_hi*b_hi
+    mid = (p0 >> S32) + (p1 & M32) + (p2 & M32)
+    hi = p3 + (p1 >> S32) + (p2 >> S32) + (mid >> S32)
+    return hi, a*b
+
+def philox4x64(ctr, key, rounds=10):
+    r"""
+    The Philox4x64 counter-based random number generator of Salmon et al.
+    (2011), vectorized over arrays of counters. This produces the same
+    output as :class:`~numpy.random.Philox`.
+
+    Parameters
+    ----------
+    ctr : tuple of four uint64 NumPy arrays
+        The words of the 256-bit counters.
+    key : tuple of two uint64 NumPy arrays or scalars
+        The words of the 128-bit keys.
+    rounds : integer, optional
+        The number of rounds. Default: 10
+
+    Returns
+    -------
+    A tuple of four uint64 NumPy arrays of random bits.
+    """
+    c0, c1, c2, c3 = [np.asarray(c, dtype="uint64") for c in ctr]
+    k0, k1 = [np.asarray(k, dtype="uint64") for k in key]
+    with np.errstate(over="ignore"):
+        for i in range(rounds):
+            if i > 0:
+                k0 = k0 + philox_w[0]
+                k1 = k1 + philox_w[1]
+            hi0, lo0 = mulhilo(c0, philox_m[0])
+            hi1, lo1 = mulhilo(c2, philox_m[1])
+            c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+    return c0, c1, c2, c3
+
+def segment_offsets(counts):
+    """
+    Return the position of each element within its segment, for
+    segments of the given *counts* laid end to end.
+    """
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if ends.size > 0 else 0) - \
+        np.repeat(ends-counts, counts)
+
+class CellKeyedPRNG(object):
+    r"""
+    A counter-based pseudo-random number generator for generating photons
+    which do not depend on the order in which cells or particles are
+    processed.
+
+    Every random number used to generate the photons of a cell or particle
+    is a function only of the global *seed*, the ID of the cell or particle,
+    and the stage of the generation (e.g., the number of photons or their
+    energies) that it is used for. As a result, the photons generated for
+    a given cell or particle are identical no matter how the data source is
+    chunked or how many processors are used to generate them, so parallel
+    runs can be checked against serial ones.
+
+    Cell IDs are computed by hashing the cell positions, and particle IDs
+    are taken from the "particle_index" field if it exists (otherwise the
+    positions are hashed).
+
+    Random numbers which are not associated with cells (e.g., when
+    projecting photons) are drawn sequentially from a
+    :class:`~numpy.random.Generator` using a Philox bit generator keyed by
+    the seed, so this object may also be used anywhere else a *prng* is
+    accepted.
+
+    Parameters
+    ----------
+    seed : integer
+        The global seed, in [0, 2**64).
+
+    Examples
+    --------
+    >>> prng = CellKeyedPRNG(24)
+    >>> thermal_model = ThermalSourceModel(apec_model, Zmet=0.3, prng=prng)
+    """
+    def __init__(self, seed):
+        self.seed = np.uint64(seed)
+        self.cell_ids = None
+        self._generator = None
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        if self._generator is None:
+            self._generator = np.random.Generator(
+                np.random.Philox(key=int(self.seed)))
+        return getattr(self._generator, attr)
+
+    def bind(self, cell_ids):
+        """
+        Return a copy of this generator which draws random numbers for the
+        cells or particles of a chunk with the IDs *cell_ids*.
+        """
+        prng = CellKeyedPRNG(self.seed)
+        prng.cell_ids = cell_ids
+        prng._generator = self._generator
+        return prng
+
+    def get_cell_ids(self, chunk, position_fields, id_field=None):
+        """
+        Compute the IDs of the cells or particles in a *chunk*, either from
+        the *id_field* or by hashing the *position_fields*.
+        """
+        if id_field is not None:
+            return chunk[id_field].d.astype("uint64")
+        pos = [np.ascontiguousarray(chunk[field].d, dtype="float64").view("uint64")
+               for field in position_fields]
+        return philox4x64((pos[0], pos[1], pos[2], np.zeros_like(pos[0])),
+                          hash_key)[0]
+
+    def random_bits(self, cell_ids, start, counts, stage):
+        """
+        Return the random 64-bit words with indices *start* through
+        *start*+*counts*-1 of the streams of the cells with IDs *cell_ids*
+        for a given *stage*, laid end to end. *start* must be a multiple
+        of 4.
+        """
+        counts = np.asarray(counts, dtype="int64")
+        start = np.broadcast_to(np.asarray(start, dtype="int64"), counts.shape)
+        nblocks = (counts+3)//4
+        block_ids = np.repeat(cell_ids, nblocks)
+        block_ctr = segment_offsets(nblocks)+np.repeat(start//4, nblocks)+1
+        zeros = np.zeros(block_ids.size, dtype="uint64")
+        words = philox4x64((block_ctr.astype("uint64"), block_ids, zeros, zeros),
+                           (self.seed, np.uint64(stage)))
+        words = np.column_stack(words).ravel()
+        keep = segment_offsets(4*nblocks) < np.repeat(counts, 4*nblocks)
+        return words[keep]
+
+    def keyed_uniform(self, cell_ids, counts, stage, start=0):
+        """
+        Draw *counts* uniform deviates in [0, 1) for each of the cells
+        with IDs *cell_ids*, for a given *stage*. The deviates of each cell
+        are the same as those drawn from a :class:`~numpy.random.Generator`
+        using a :class:`~numpy.random.Philox` bit generator with key
+        (seed, stage) and counter (0, ID, 0, 0).
+        """
+        bits = self.random_bits(cell_ids, start, counts, stage)
+        return (bits >> S11).astype("float64")*(1.0/9007199254740992.0)
+
+    def keyed_normal(self, cell_ids, counts, stage):
+        """
+        Draw *counts* standard normal deviates for each of the cells with
+        IDs *cell_ids*, for a given *stage*, using the Box-Muller transform.
+        """
+        counts = np.asarray(counts, dtype="int64")
+        u = self.keyed_uniform(cell_ids, 2*counts, stage)
+        return np.sqrt(-2.0*np.log1p(-u[::2]))*np.cos(2.0*np.pi*u[1::2])
+
+    def keyed_poisson(self, cell_ids, lam, stage):
+        """
+        Draw a Poisson deviate with mean *lam* for each of the cells with
+        IDs *cell_ids*, for a given *stage*.
+
+        The deviate is the number of arrivals of a unit-rate Poisson
+        process within an interval of length *lam*. The exponential waiting
+        times are drawn in rounds whose sizes depend only on *lam*, and are
+        summed separately for each cell, so that the result does not depend
+        on which other cells are drawn alongside it.
+        """
+        lam = np.asarray(lam, dtype="float64")
+        cell_ids = np.asarray(cell_ids, dtype="uint64")
+        n = np.zeros(lam.size, dtype="int64")
+        t = np.zeros(lam.size)
+        start = np.zeros(lam.size, dtype="int64")
+        active = np.where(lam > 0.0)[0]
+        while active.size > 0:
+            rem = lam[active]-t[active]
+            # Draw enough waiting times to exceed the remaining interval with
+            # high probability. Rounding up to a power of two (at least one
+            # Philox block) keeps the number of distinct sizes small.
+            m = np.ceil(rem+4.0*np.sqrt(rem)+4.0)
+            m = (2**np.ceil(np.log2(m))).astype("int64")
+            done = np.zeros(active.size, dtype="bool")
+            for size in np.unique(m):
+                in_group = np.where(m == size)[0]
+                cells = active[in_group]
+                u = self.keyed_uniform(cell_ids[cells], np.repeat(size, cells.size),
+                                       stage, start=start[cells])
+                arrivals = np.cumsum(-np.log1p(-u).reshape(cells.size, size), axis=1)
+                k = (arrivals <= rem[in_group,np.newaxis]).sum(axis=1)
+                n[cells] += k
+                t[cells] += arrivals[:,-1]
+                start[cells] += size
+                done[in_group] = k < size
+            active = active[~done]
+        return n
+
+class ThreadLocalPRNG(object):
+    """
+    A stand-in for a pseudo-random number generator which forwards to
+    a generator set separately by each thread, so that a source model
+    shared by a pool of threads draws from a different stream in each.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def set_prng(self, prng):
+        self._local.prng = prng
+
+    def get_prng(self):
+        return self._local.prng
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self._local.prng, attr)
+
+def parse_prng(prng):
+    """
+    Return a pseudo-random number generator from the *prng* argument
+    accepted throughout pyXSIM, which may be None (the :mod:`numpy.random`
+    module), an integer seed or a :class:`~numpy.random.SeedSequence`
+    (either of which is used to seed a :class:`~numpy.random.Generator`
+    using the PCG64 bit generator), or an existing generator such as a
+    :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState`,
+    or :class:`~pyxsim.rng.CellKeyedPRNG`.
+    """
+    if prng is None:
+        return np.random
+    if isinstance(prng, Integral):
+        return np.random.Generator(np.random.PCG64(prng))
+    if hasattr(np.random, "SeedSequence") and \
+        isinstance(prng, np.random.SeedSequence):
+        return np.random.Generator(np.random.PCG64(prng))
+    return prng
+
+def get_stream_seed(prng):
+    """
+    If *prng* is a :class:`~numpy.random.Generator`, draw a
+    :class:`~numpy.random.SeedSequence` from it from which independent
+    child streams can be spawned with :func:`spawn_prng`. Otherwise,
+    return None, since the legacy generators cannot be spawned.
+    """
+    if hasattr(np.random, "Generator") and \
+        isinstance(prng, np.random.Generator):
+        return np.random.SeedSequence(prng.integers(0, 2**32, size=4,
+                                                    dtype="uint64"))
+    return None
+
+def spawn_prng(seed_seq, *key):
+    """
+    Return the child :class:`~numpy.random.Generator` of *seed_seq* with
+    the spawn key *key*. The stream depends only on *seed_seq* and *key*,
+    so, e.g., the stream of a chunk is the same no matter which processor
+    or thread it is handled by.
+    """
+    child = np.random.SeedSequence(seed_seq.entropy, pool_size=seed_seq.pool_size,
+                                   spawn_key=seed_seq.spawn_key+key)
+    return np.random.Generator(np.random.PCG64(child))
+
+class ChunkStreams(object):
+    """
+    Hands out the pseudo-random number generator for each chunk of a
+    data source, given the index of the chunk and its fields.
+
+    A :class:`~pyxsim.rng.CellKeyedPRNG` is bound to the IDs of the cells
+    in the chunk, and a :class:`~numpy.random.Generator` spawns a child
+    stream for each chunk. Legacy generators are shared by all of the
+    chunks, unless :meth:`seed_chunks` is called.
+    """
+    def __init__(self, prng, position_fields, id_field=None):
+        self.prng = prng
+        self.position_fields = position_fields
+        self.id_field = id_field
+        self.seed_seq = get_stream_seed(prng)
+        self.base_seed = None
+
+    def __call__(self, i, chunk):
+        if isinstance(self.prng, CellKeyedPRNG):
+            cell_ids = self.prng.get_cell_ids(chunk, self.position_fields,
+                                              self.id_field)
+            return self.prng.bind(cell_ids)
+        elif self.seed_seq is not None:
+            return spawn_prng(self.seed_seq, i)
+        elif self.base_seed is not None:
+            return np.random.RandomState([self.base_seed, i])
+        else:
+            return self.prng
+
+    def seed_chunks(self):
+        """
+        Give each chunk its own :class:`~numpy.random.RandomState`, seeded
+        from the legacy generator, for when the chunks are handled by
+        separate processes which cannot share a single stream.
+        """
+        if self.seed_seq is None and self.base_seed is None and \
+            not isinstance(self.prng, CellKeyedPRNG):
+            self.base_seed = self.prng.randint(0, 2**31)
+            self.prng = None
+
+    def get_state(self):
+        """
+        Return the state from which the same generators are handed out to
+        the chunks, as a dict of arrays, for restoring with :meth:`set_state`.
+        A :class:`~pyxsim.rng.CellKeyedPRNG` has no state to save, since its
+        streams depend only on its seed and the IDs of the cells.
+        """
+        state = {}
+        if self.seed_seq is not None:
+            state["entropy"] = np.array(self.seed_seq.entropy, dtype="uint64")
+        elif self.base_seed is not None:
+            state["base_seed"] = np.int64(self.base_seed)
+        elif not isinstance(self.prng, CellKeyedPRNG):
+            # The legacy generators share one stream, so its state is saved
+            _, keys, pos, has_gauss, cached_gaussian = self.prng.get_state()
+            state["mt19937_keys"] = keys
+            state["mt19937_pos"] = np.int64(pos)
+            state["mt19937_gauss"] = np.array([has_gauss, cached_gaussian])
+        return state
+
+    def set_state(self, state):
+        """
+        Restore the *state* returned by :meth:`get_state`.
+        """
+        if "entropy" in state:
+            self.seed_seq = np.random.SeedSequence(
+                [int(e) for e in state["entropy"]])
+        elif "base_seed" in state:
+            self.base_seed = int(state["base_seed"])
+            self.prng = None
+        elif "mt19937_keys" in state:
+            has_gauss, cached_gaussian = state["mt19937_gauss"]
+            self.prng.set_state(("MT19937", state["mt19937_keys"],
+                                 int(state["mt19937_pos"]), int(has_gauss),
+                                 float(cached_gaussian)))
+
+def draw_poisson(prng, lam, cells, stage):
+    """
+    Draw the number of photons for each cell, using the keyed streams of
+    the cells with chunk indices *cells* if *prng* is a
+    :class:`~pyxsim.rng.CellKeyedPRNG`.
+    """
+    if isinstance(prng, ThreadLocalPRNG):
+        prng = prng.get_prng()
+    if isinstance(prng, CellKeyedPRNG):
+        return prng.keyed_poisson(prng.cell_ids[cells], lam, stage)
+    return prng.poisson(lam=lam)
+
+def draw_uniform(prng, counts, cells, stage):
+    """
+    Draw *counts* uniform deviates for each cell, using the keyed streams
+    of the cells with chunk indices *cells* if *prng* is a
+    :class:`~pyxsim.rng.CellKeyedPRNG`.
+    """
+    if isinstance(prng, ThreadLocalPRNG):
+        prng = prng.get_prng()
+    if isinstance(prng, CellKeyedPRNG):
+        return prng.keyed_uniform(prng.cell_ids[cells], counts, stage)
+    return prng.uniform(size=np.sum(counts))
+
+def draw_choice(prng, n, size, p, cells, stage):
+    """
+    Draw *size* integers in [0, *n*) with the probabilities *p*, using the
+    keyed streams of the cells with chunk indices *cells* if *prng* is a
+    :class:`~pyxsim.rng.CellKeyedPRNG`.
+    """
+    if isinstance(prng, ThreadLocalPRNG):
+        prng = prng.get_prng()
+    if isinstance(prng, CellKeyedPRNG):
+        u = prng.keyed_uniform(prng.cell_ids[cells], [size], stage)
+        idxs = np.searchsorted(np.cumsum(p), u, side="right")
+        return np.minimum(idxs, n-1)
+    return prng.choice(n, size=size, p=p)
+
+def draw_normal(prng, counts, cells, stage):
+    """
+    Draw *counts* standard normal deviates for each cell, using the keyed
+    streams of the cells with chunk indices *cells* if *prng* is a
+    :class:`~pyxsim.rng.CellKeyedPRNG`.
+    """
+    if isinstance(prng, ThreadLocalPRNG):
+        prng = prng.get_prng()
+    if isinstance(prng, CellKeyedPRNG):
+        return prng.keyed_normal(prng.cell_ids[cells], counts, stage)
+    return prng.normal(size=np.sum(counts))
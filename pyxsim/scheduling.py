@@ -0,0 +1,143 @@
+"""
+Assigning the chunks of a data source, or the cells of a photon list,
+to MPI processors
+"""
+import heapq
+import numpy as np
+from yt.utilities.parallel_tools.parallel_analysis_interface import \
+    communication_system, parallel_objects
+from pyxsim.utils import mylog
+
+comm = communication_system.communicators[-1]
+
+schedules = ["static", "cost", "dynamic"]
+partitions = ["photons", "cells"]
+
+def estimate_chunk_costs(data_source, source_model):
+    """
+    Estimate the cost of generating the photons from each chunk of
+    *data_source* with *source_model*, splitting the estimates between
+    the processors, and return them to all of them as an array.
+    Chunks whose cost the model cannot estimate are given a cost of 1.
+    """
+    costs = {}
+    for i, chunk in enumerate(data_source.chunks([], "io")):
+        if i % comm.size != comm.rank:
+            continue
+        cost = source_model.estimate_cost(chunk)
+        costs[i] = 1.0 if cost is None else float(cost)
+    costs = comm.par_combine_object(costs, datatype="dict", op="join")
+    return np.array([costs[i] for i in range(len(costs))])
+
+def lpt_schedule(costs, size):
+    """
+    Assign tasks with the given *costs* to *size* processors, by giving
+    each task in order of decreasing cost to the processor with the least
+    work so far, and return the processor of each task.
+    """
+    owners = np.empty(len(costs), dtype="int64")
+    loads = [(0.0, rank) for rank in range(size)]
+    for i in np.argsort(-np.asarray(costs), kind="mergesort"):
+        load, rank = heapq.heappop(loads)
+        owners[i] = rank
+        heapq.heappush(loads, (load+costs[i], rank))
+    return owners
+
+def dynamic_chunks(chunks):
+    """
+    Hand out the (index, chunk) pairs of *chunks* to the processors as
+    they ask for them, by atomically incrementing a counter held by the
+    root processor, which also takes chunks. Each processor takes the
+    chunk with the index it gets from the counter, so the chunks which
+    a processor handles are still in increasing order.
+    """
+    from mpi4py import MPI
+    itemsize = MPI.INT64_T.Get_size()
+    win = MPI.Win.Allocate(itemsize if comm.rank == 0 else 0, itemsize,
+                           comm=comm.comm)
+    if comm.rank == 0:
+        win.Lock(0)
+        win.Put(np.zeros(1, dtype="int64"), 0)
+        win.Unlock(0)
+    comm.comm.Barrier()
+    one = np.ones(1, dtype="int64")
+    counter = np.zeros(1, dtype="int64")
+
+    def next_chunk():
+        win.Lock(0)
+        win.Fetch_and_op(one, counter, 0)
+        win.Unlock(0)
+        return int(counter[0])
+
+    try:
+        target = next_chunk()
+        for i, chunk in chunks:
+            if i == target:
+                yield i, chunk
+                target = next_chunk()
+    finally:
+        comm.comm.Barrier()
+        win.Free()
+
+def schedule_chunks(data_source, source_model, schedule="static"):
+    """
+    Iterate over the (index, chunk) pairs of *data_source* which this
+    processor is to generate photons from, assigned by *schedule*:
+
+    * "static": Round-robin, as by :func:`~yt.parallel_objects`.
+    * "cost": The cost of each chunk is estimated by the source model in a
+      quick pass over the data source, and the chunks are balanced between
+      the processors by their costs.
+    * "dynamic": Each processor takes the next chunk which no other
+      processor has taken as soon as it is done with its last one.
+    """
+    if schedule not in schedules:
+        raise ValueError("schedule must be one of %s, not '%s'!" % (schedules, schedule))
+    citer = enumerate(data_source.chunks([], "io"))
+    if comm.size == 1 or schedule == "static":
+        return parallel_objects(citer)
+    elif schedule == "cost":
+        costs = estimate_chunk_costs(data_source, source_model)
+        owners = lpt_schedule(costs, comm.size)
+        my_cost = costs[owners == comm.rank].sum()
+        mylog.info("Assigned %d chunks with %.1f%% of the estimated cost to processor %d." %
+                   ((owners == comm.rank).sum(), 100.*my_cost/max(costs.sum(), 1.0e-300),
+                    comm.rank))
+        return ((i, chunk) for i, chunk in citer if owners[i] == comm.rank)
+    else:
+        return dynamic_chunks(citer)
+
+def partition_offsets(weights, size):
+    """
+    Split a sequence of items with the given *weights*, such as the numbers
+    of photons in the cells of a photon list, into *size* contiguous ranges
+    with roughly equal total weights, and return the offsets of the ranges,
+    the i-th of which is offsets[i]:offsets[i+1]. Each item goes into the
+    range which holds the middle of its weight. If the weights are all
+    zero, the ranges have equal numbers of items.
+    """
+    weights = np.asarray(weights)
+    num_items = weights.size
+    offsets = np.arange(size+1, dtype="int64")*num_items//size
+    cumsum = np.cumsum(weights, dtype="int64")
+    if num_items == 0 or cumsum[-1] == 0:
+        return offsets
+    targets = cumsum[-1]*np.arange(1, size, dtype="float64")/size
+    offsets[1:-1] = np.searchsorted(cumsum-0.5*weights, targets, side="left")
+    return offsets
+
+def get_rank_range(num_items, weights=None):
+    """
+    Return the start and end of the range of *num_items* items which this
+    processor handles. If *weights* (an array or HDF5 dataset, which is
+    only read when running in parallel) are given, the ranges of the
+    processors have roughly equal total weights, and otherwise equal
+    numbers of items.
+    """
+    if comm.size == 1:
+        return 0, num_items
+    if weights is None:
+        offsets = np.arange(comm.size+1, dtype="int64")*num_items//comm.size
+    else:
+        offsets = partition_offsets(weights[:], comm.size)
+    return offsets[comm.rank], offsets[comm.rank+1]
@@ -2,32 +2,156 @@
 Classes for specific source models
 """
 import numpy as np
+from threading import Lock
 from yt.funcs import get_pbar, ensure_numpy_array
 from pyxsim.utils import mylog
 from yt.units.yt_array import YTQuantity
 from yt.utilities.physical_constants import mp, clight, kboltz
-from pyxsim.utils import parse_value
+from pyxsim.utils import parse_value, get_conversion_factor
+from pyxsim.rng import draw_poisson, draw_uniform, draw_normal, draw_choice, \
+    parse_prng
+from pyxsim.ragged_array import RaggedArray
 from yt.utilities.exceptions import YTUnitConversionError
 
 sqrt_two = np.sqrt(2.)
+thermal_methods = ["invert_cdf", "accept_reject", "mixture"]
+ckms = clight.in_units("km/s").v
+
+def stack_cdfs(spec):
+    r"""
+    Construct the normalized cumulative distribution functions of a set
+    of tabulated spectra, stacked into a single monotonic table for use
+    with :func:`invert_cdfs`.
+
+    Parameters
+    ----------
+    spec : 2D NumPy array of shape (n_rows, nchan)
+        The spectra, one per row.
+
+    Returns
+    -------
+    The stacked CDFs as a flat array of size n_rows*(nchan+1), and the
+    total of each spectrum.
+    """
+    n_rows, nchan = spec.shape
+    tot = spec.sum(axis=1)
+    cdfs = np.zeros((n_rows, nchan+1))
+    np.cumsum(spec, axis=1, out=cdfs[:,1:])
+    nz = tot > 0.0
+    cdfs[nz] /= tot[nz,np.newaxis]
+    # Rows with no emission are never sampled, but they must still be
+    # monotonic for the stacking to work
+    cdfs[~nz] = np.linspace(0.0, 1.0, nchan+1)
+    # Offsetting each row by its index makes the whole table monotonic,
+    # so one searchsorted call can find the bin of every photon no matter
+    # which row it is drawn from
+    cdfs += np.arange(n_rows)[:,np.newaxis]
+    return cdfs.ravel(), tot
+
+def invert_cdfs(u, rows, cdfs, ebins):
+    r"""
+    Draw photon energies by inverting stacked cumulative distribution
+    functions, vectorized over all of the photons at once.
+
+    Parameters
+    ----------
+    u : NumPy array
+        Uniform deviates in [0, 1), one per photon.
+    rows : NumPy integer array
+        The row (spectrum) of *cdfs* to draw each photon from.
+    cdfs : NumPy array
+        The stacked CDFs, as returned by :func:`stack_cdfs`.
+    ebins : NumPy array
+        The energy bin edges of the spectra.
+    """
+    n_edges = ebins.size
+    start = rows*n_edges
+    x = u + rows
+    j = np.searchsorted(cdfs, x, side="right")-1
+    j = np.clip(j, start, start+n_edges-2)
+    c0 = cdfs[j]
+    dc = cdfs[j+1]-c0
+    k = j-start
+    frac = np.zeros(x.size)
+    nz = dc > 0.0
+    frac[nz] = (x[nz]-c0[nz])/dc[nz]
+    return ebins[k] + frac*(ebins[k+1]-ebins[k])
+
+def get_field_units(data_source, field):
+    """
+    Return the units of *field* in *data_source*, which may also be a
+    dict of arrays, as given to :meth:`~pyxsim.photon_list.PhotonList.from_arrays`.
+    """
+    if isinstance(data_source, dict):
+        return str(data_source[field].units)
+    return str(data_source.ds._get_field_info(field).units)
+
+def get_source_type(data_source, field):
+    """
+    Return the type of the cells or particles that *field* belongs to.
+    Arrays which are not keyed by (ftype, fname) are taken to be gas.
+    """
+    if isinstance(data_source, dict):
+        return field[0] if isinstance(field, tuple) else "gas"
+    return data_source.ds._get_field_info(field).name[0]
+
+def get_field_list(data_source, derived=False):
+    if isinstance(data_source, dict):
+        return list(data_source.keys())
+    elif derived:
+        return data_source.ds.derived_field_list
+    return data_source.ds.field_list
 
 class SourceModel(object):
 
     def __init__(self, prng=None):
         self.spectral_norm = None
         self.redshift = None
-        if prng is None:
-            self.prng = np.random
-        else:
-            self.prng = prng
+        self.prng = parse_prng(prng)
 
     def __call__(self, chunk):
+        """
+        Generate the photons from *chunk*, and return the number of photons
+        in each cell or particle which has any, the indices of those cells
+        or particles in the chunk, and the energies of all of the photons,
+        laid end to end in the same order. The numbers and energies are
+        the counts and data of a :class:`~pyxsim.ragged_array.RaggedArray`,
+        which is kept flat until it is added to a photon list. None means
+        the chunk has no photons.
+        """
         pass
 
     def setup_model(self, data_source, redshift, spectral_norm):
         self.spectral_norm = spectral_norm
         self.redshift = redshift
 
+    def setup_fields(self, ds):
+        """
+        Add any derived fields which the model needs to the dataset *ds*.
+        This is called again on the dataset reopened by each worker process,
+        since the fields added to the original dataset are not pickled.
+        """
+        pass
+
+    def get_fields(self):
+        """
+        Return the list of fields which the model reads from each chunk,
+        once the model has been set up. Models which can be run on chunks
+        that have been read ahead of time (e.g., by a pool of threads) must
+        implement this. None means the fields are not known.
+        """
+        return None
+
+    def estimate_cost(self, chunk):
+        """
+        Return an estimate of the cost of generating the photons from a
+        *chunk*, relative to the other chunks, once the model has been set
+        up. This is used to balance the chunks between processors, so it
+        should be much cheaper than generating the photons. None means the
+        cost is not known.
+        """
+        return None
+
     def cleanup_model(self):
         self.spectral_norm = None
         self.redshift = None
@@ -71,11 +195,27 @@ class ThermalSourceModel(SourceModel):
         The method used to generate the photon energies from the spectrum:
         "invert_cdf": Invert the cumulative distribution function of the spectrum.
         "accept_reject": Acceptance-rejection method using the spectrum. 
+        "mixture": Draw each photon from the cosmic or the metal spectrum in
+        proportion to its share of the emission of the cell, and invert the
+        cumulative distribution functions of the photons of all of the cells
+        in a temperature bin at once. The energies of the photons in each cell
+        are sorted.
         The first method should be sufficient for most cases. 
-    prng : :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
-        A pseudo-random number generator. Typically will only be specified
+    prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
+        A pseudo-random number generator, or a seed for a new
+        :class:`~numpy.random.Generator`. Typically will only be specified
         if you have a reason to generate the same set of random numbers, such as for a
-        test. Default is the :mod:`numpy.random` module.
+        test. Default is the :mod:`numpy.random` module. If a
+        :class:`~numpy.random.Generator` is used, independent streams are
+        spawned from it for each chunk of the data source. If a
+        :class:`~pyxsim.rng.CellKeyedPRNG` is supplied, the photons generated
+        for each cell or particle do not depend on how the data is chunked.
+
+    Notes
+    -----
+    The "mixture" method is much faster for cells with many photons. Its
+    photons have the same distribution as those of "invert_cdf", but not
+    the same values for a given *prng*.
 
     Examples
     --------
@@ -89,11 +229,11 @@ class ThermalSourceModel(SourceModel):
         self.temperature_field = temperature_field
         self.Zmet = Zmet
         self.spectral_model = spectral_model
+        if method not in thermal_methods:
+            raise ValueError("method must be one of %s, not '%s'!" %
+                             (thermal_methods, method))
         self.method = method
-        if prng is None:
-            self.prng = np.random
-        else:
-            self.prng = prng
+        self.prng = parse_prng(prng)
         self.kT_min = kT_min
         self.kT_max = kT_max
         self.kT_scale = kT_scale
@@ -104,13 +244,52 @@ class ThermalSourceModel(SourceModel):
         self.kT_bins = None
         self.dkT = None
         self.emission_measure_field = emission_measure_field
+        self.em_density_field = None
         self.Zconvert = 1.0
 
+    def __getstate__(self):
+        # The progress bar and its lock cannot be pickled, so copies of the
+        # model in worker processes do not report progress
+        state = self.__dict__.copy()
+        state["pbar"] = None
+        state.pop("pbar_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pbar_lock = Lock()
+
+    def setup_fields(self, ds):
+        if self.em_density_field is None:
+            return
+        ptype = self.em_density_field[0]
+        if (ptype, 'emission_measure') in ds.field_info:
+            return
+        dens_field = self.em_density_field
+        def _emission_measure(field, data):
+            nenh = data[dens_field]*data['particle_mass']
+            nenh /= mp*mp
+            nenh.convert_to_units("cm**-3")
+            if data.has_field_parameter("X_H"):
+                X_H = data.get_field_parameter("X_H")
+            else:
+                X_H = 0.76
+            if (ptype, 'ElectronAbundance') in ds.field_list:
+                nenh *= X_H * data[ptype, 'ElectronAbundance']
+                nenh *= X_H * (1.-data[ptype, 'NeutralHydrogenAbundance'])
+            else:
+                nenh *= 0.5*(1.+X_H)*X_H
+            return nenh
+        ds.add_field((ptype, 'emission_measure'),
+                     function=_emission_measure,
+                     particle_type=True,
+                     units="cm**-3")
+
     def setup_model(self, data_source, redshift, spectral_norm):
         self.redshift = redshift
         ptype = None
         if not isinstance(self.Zmet, float):
-            Z_units = str(data_source.ds._get_field_info(self.Zmet).units)
+            Z_units = get_field_units(data_source, self.Zmet)
             if Z_units in ["dimensionless", "", "code_metallicity"]:
                 self.Zconvert = 1.0/0.019
             elif Z_units == "Zsun":
@@ -118,40 +297,27 @@ class ThermalSourceModel(SourceModel):
             else:
                 raise RuntimeError("I don't understand metallicity units of %s!" % Z_units)
         if self.emission_measure_field is None:
-            found_dfield = [fd for fd in particle_dens_fields if fd in data_source.ds.field_list]
-            if len(found_dfield) > 0:
+            found_dfield = [fd for fd in particle_dens_fields if fd in get_field_list(data_source)]
+            # The emission measure of particles is a derived field, so it
+            # must be among the arrays if they are given directly
+            if len(found_dfield) > 0 and not isinstance(data_source, dict):
                 ptype = found_dfield[0][0]
-                def _emission_measure(field, data):
-                    nenh = data[found_dfield[0]]*data['particle_mass']
-                    nenh /= mp*mp
-                    nenh.convert_to_units("cm**-3")
-                    if data.has_field_parameter("X_H"):
-                        X_H = data.get_field_parameter("X_H")
-                    else:
-                        X_H = 0.76
-                    if (ptype, 'ElectronAbundance') in data_source.ds.field_list:
-                        nenh *= X_H * data[ptype, 'ElectronAbundance']
-                        nenh *= X_H * (1.-data[ptype, 'NeutralHydrogenAbundance'])
-                    else:
-                        nenh *= 0.5*(1.+X_H)*X_H
-                    return nenh
-                data_source.ds.add_field((ptype, 'emission_measure'),
-                                         function=_emission_measure,
-                                         particle_type=True,
-                                         units="cm**-3")
+                self.em_density_field = found_dfield[0]
+                self.setup_fields(data_source.ds)
                 self.emission_measure_field = (ptype, 'emission_measure')
             else:
                 self.emission_measure_field = ('gas', 'emission_measure')
         mylog.info("Using emission measure field '(%s, %s)'." % self.emission_measure_field)
         if self.temperature_field is None:
-            found_tfield = [fd for fd in particle_temp_fields if fd in data_source.ds.derived_field_list]
+            found_tfield = [fd for fd in particle_temp_fields
+                            if fd in get_field_list(data_source, derived=True)]
             if len(found_tfield) > 0:
                 self.temperature_field = found_tfield[0]
                 # What we have to do here is make sure that the temperature is set correctly
                 # for SPH datasets that don't have the temperature field defined. What this
                 # means is that we must set the mean molecular weight to the value for a
                 # fully ionized gas if the ionization fraction is not available in the dataset.
-                if self.temperature_field not in data_source.ds.field_list and ptype is not None:
+                if ptype is not None and self.temperature_field not in data_source.ds.field_list:
                     if (ptype, 'ElectronAbundance') not in data_source.ds.field_list:
                         if data_source.has_field_parameter("X_H"):
                             X_H = data_source.get_field_parameter("X_H")
@@ -169,22 +335,40 @@ class ThermalSourceModel(SourceModel):
             self.kT_bins = np.logspace(np.log10(self.kT_min), np.log10(self.kT_max), 
                                        num=self.n_kT+1)
         self.dkT = np.diff(self.kT_bins)
-        kT = (kboltz*data_source[self.temperature_field]).in_units("keV").v
+        kT = self._get_kT(data_source)
         num_cells = np.logical_and(kT > self.kT_min, kT < self.kT_max).sum()
-        self.source_type = data_source.ds._get_field_info(self.emission_measure_field).name[0]
+        self.source_type = get_source_type(data_source, self.emission_measure_field)
         self.pbar = get_pbar("Generating photons ", num_cells)
+        self.pbar_count = 0
+        self.pbar_lock = Lock()
+
+    def get_fields(self):
+        fields = [self.temperature_field, self.emission_measure_field]
+        if not isinstance(self.Zmet, float):
+            fields.append(self.Zmet)
+        return fields
+
+    def estimate_cost(self, chunk):
+        # The number of photons goes roughly as the emission measure of
+        # the cells within the temperature range
+        kT = self._get_kT(chunk)
+        EM = chunk[self.emission_measure_field].d
+        return EM[(kT > self.kT_min) & (kT < self.kT_max)].sum()
+
+    def _get_kT(self, chunk):
+        T = chunk[self.temperature_field]
+        return T.d*float((kboltz*T.uq).in_units("keV"))
 
     def __call__(self, chunk):
 
-        num_photons_max = 10000000
-        emid = self.spectral_model.emid
-        ebins = self.spectral_model.ebins
+        emid = self.spectral_model.emid.d
+        ebins = self.spectral_model.ebins.d
         nchan = len(emid)
 
-        kT = (kboltz*chunk[self.temperature_field]).in_units("keV").v
+        kT = self._get_kT(chunk)
         if len(kT) == 0:
             return
-        EM = chunk[self.emission_measure_field].v
+        EM = chunk[self.emission_measure_field].d
 
         idxs = np.argsort(kT)
 
@@ -213,13 +397,10 @@ class ThermalSourceModel(SourceModel):
         if isinstance(self.Zmet, float):
             metalZ = self.Zmet*np.ones(num_cells)
         else:
-            metalZ = chunk[self.Zmet].v[idxs]*self.Zconvert
+            metalZ = chunk[self.Zmet].d[idxs]*self.Zconvert
 
         number_of_photons = np.zeros(num_cells, dtype="int64")
-        energies = np.zeros(num_photons_max)
-
-        start_e = 0
-        end_e = 0
+        energies = []
 
         for ibegin, iend, ikT in zip(bcell, ecell, kT_idxs):
 
@@ -227,30 +408,33 @@ class ThermalSourceModel(SourceModel):
 
             cem = cell_em[ibegin:iend]
 
-            cspec, mspec = self.spectral_model.get_spectrum(kT)
+            cspec, mspec = self.spectral_model._get_spectrum(kT)
 
-            tot_ph_c = cspec.d.sum()
-            tot_ph_m = mspec.d.sum()
+            tot_ph_c = cspec.sum()
+            tot_ph_m = mspec.sum()
 
             cell_norm_c = tot_ph_c*cem
             cell_norm_m = tot_ph_m*metalZ[ibegin:iend]*cem
             cell_norm = cell_norm_c + cell_norm_m
 
-            cell_n = ensure_numpy_array(self.prng.poisson(lam=cell_norm))
+            cells = idxs[ibegin:iend]
+            cell_n = ensure_numpy_array(draw_poisson(self.prng, cell_norm, cells, 0))
 
             number_of_photons[ibegin:iend] = cell_n
 
-            end_e += int(cell_n.sum())
+            if self.method == "mixture":
+                if cell_n.sum() > 0:
+                    energies.append(self._draw_mixture(cspec, mspec, cell_n, cells,
+                                                       cell_norm_m, cell_norm, ebins))
+                continue
 
             if self.method == "invert_cdf":
-                cumspec_c = np.cumsum(cspec.d)
-                cumspec_m = np.cumsum(mspec.d)
+                cumspec_c = np.cumsum(cspec)
+                cumspec_m = np.cumsum(mspec)
                 cumspec_c = np.insert(cumspec_c, 0, 0.0)
                 cumspec_m = np.insert(cumspec_m, 0, 0.0)
 
-            ei = start_e
-            for cn, Z in zip(number_of_photons[ibegin:iend], metalZ[ibegin:iend]):
-                self.pbar.update()
+            for i, (cn, Z) in enumerate(zip(cell_n, metalZ[ibegin:iend])):
                 if cn == 0:
                     continue
                 # The rather verbose form of the few next statements is a
@@ -263,34 +447,58 @@ class ThermalSourceModel(SourceModel):
                     cumspec += Z * cumspec_m
                     norm_factor = 1.0 / cumspec[-1]
                     cumspec *= norm_factor
-                    randvec = self.prng.uniform(size=cn)
+                    randvec = draw_uniform(self.prng, [cn], cells[i:i+1], 2)
                     randvec.sort()
                     cell_e = np.interp(randvec, cumspec, ebins)
                 elif self.method == "accept_reject":
-                    tot_spec = cspec.d
-                    tot_spec += Z * mspec.d
+                    tot_spec = cspec
+                    tot_spec += Z * mspec
                     norm_factor = 1.0 / tot_spec.sum()
                     tot_spec *= norm_factor
-                    eidxs = self.prng.choice(nchan, size=cn, p=tot_spec)
+                    eidxs = draw_choice(self.prng, nchan, cn, tot_spec, cells[i:i+1], 2)
                     cell_e = emid[eidxs]
-                while ei+cn > num_photons_max:
-                    num_photons_max *= 2
-                if num_photons_max > energies.size:
-                    energies.resize(num_photons_max, refcheck=False)
-                energies[ei:ei+cn] = cell_e
-                ei += cn
+                energies.append(cell_e)
 
-            start_e = end_e
+        if self.pbar is not None:
+            with self.pbar_lock:
+                self.pbar_count += num_cells
+                self.pbar.update(self.pbar_count)
 
         active_cells = number_of_photons > 0
         idxs = idxs[active_cells]
 
-        return number_of_photons[active_cells], idxs, energies[:end_e].copy()
+        if len(energies) > 0:
+            energies = np.concatenate(energies)
+        else:
+            energies = np.zeros(0)
+
+        return number_of_photons[active_cells], idxs, energies
+
+    def _draw_mixture(self, cspec, mspec, cell_n, cells, cell_norm_m, cell_norm, ebins):
+        # The spectrum of each cell is the sum of the cosmic and the metal
+        # spectra, so each photon is drawn from one or the other with a
+        # probability proportional to its share of the emission in that
+        # cell. This lets us sample all of the photons in a temperature bin
+        # at once instead of building a new spectrum for each cell.
+        cdfs = stack_cdfs(np.array([cspec, mspec]))[0]
+        has_ph = cell_n > 0
+        cells = cells[has_ph]
+        p_metal = cell_norm_m[has_ph]/cell_norm[has_ph]
+        p_metal = np.repeat(p_metal, cell_n[has_ph])
+        u = draw_uniform(self.prng, cell_n[has_ph], cells, 1)
+        rows = (u < p_metal).astype("int64")
+        randvec = draw_uniform(self.prng, cell_n[has_ph], cells, 2)
+        cell_e = invert_cdfs(randvec, rows, cdfs, ebins)
+        # The energies of each cell are sorted, as they are when each cell's
+        # CDF is inverted with sorted deviates
+        RaggedArray.from_counts(cell_e, cell_n[has_ph]).sort()
+        return cell_e
 
     def cleanup_model(self):
         self.pbar.finish()
         self.redshift = None
-        self.spectral_model.cleanup_spectrum()
+        if not self.spectral_model.keep_spectrum:
+            self.spectral_model.cleanup_spectrum()
         self.pbar = None
         self.spectral_norm = None
         self.kT_bins = None
@@ -318,10 +526,15 @@ class PowerLawSourceModel(SourceModel):
     index : float, string, or (ftype, fname) tuple
         The power-law index of the spectrum. Either a float for a single power law or
         the name of a field that corresponds to the power law.
-    prng : :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
-        A pseudo-random number generator. Typically will only be specified
+    prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
+        A pseudo-random number generator, or a seed for a new
+        :class:`~numpy.random.Generator`. Typically will only be specified
         if you have a reason to generate the same set of random numbers, such as for a
-        test. Default is the :mod:`numpy.random` module.
+        test. Default is the :mod:`numpy.random` module. If a
+        :class:`~numpy.random.Generator` is used, independent streams are
+        spawned from it for each chunk of the data source. If a
+        :class:`~pyxsim.rng.CellKeyedPRNG` is supplied, the photons generated
+        for each cell or particle do not depend on how the data is chunked.
 
     Examples
     --------
@@ -336,55 +549,64 @@ class PowerLawSourceModel(SourceModel):
         self.emax = parse_value(emax, "keV")
         self.emission_field = emission_field
         self.alpha = alpha
-        if prng is None:
-            self.prng = np.random
-        else:
-            self.prng = prng
+        self.prng = parse_prng(prng)
         self.spectral_norm = None
         self.redshift = None
 
     def setup_model(self, data_source, redshift, spectral_norm):
         self.spectral_norm = spectral_norm
         self.redshift = redshift
-        self.source_type = data_source.ds._get_field_info(self.emission_field).name[0]
+        self.source_type = get_source_type(data_source, self.emission_field)
         self.scale_factor = 1.0 / (1.0 + self.redshift)
 
+    def get_fields(self):
+        fields = [self.emission_field]
+        if not isinstance(self.alpha, float):
+            fields.append(self.alpha)
+        return fields
+
+    def estimate_cost(self, chunk):
+        return chunk[self.emission_field].d.sum()
+
     def __call__(self, chunk):
 
+        e0 = self.e0.v
+        emin = self.emin.v
+        emax = self.emax.v
+
         num_cells = len(chunk[self.emission_field])
 
         if isinstance(self.alpha, float):
             alpha = self.alpha*np.ones(num_cells)
         else:
-            alpha = chunk[self.alpha].v
+            alpha = chunk[self.alpha].d
 
-        norm_fac = (self.emax.v**(1.-alpha)-self.emin.v**(1.-alpha))
-        norm_fac[alpha == 1] = np.log(self.emax.v/self.emin.v)
-        norm = norm_fac*chunk[self.emission_field].v*self.e0.v**alpha
+        norm_fac = (emax**(1.-alpha)-emin**(1.-alpha))
+        norm_fac[alpha == 1] = np.log(emax/emin)
+        norm = norm_fac*chunk[self.emission_field].d*e0**alpha
         norm[alpha != 1] /= (1.-alpha[alpha != 1])
         norm *= self.spectral_norm*self.scale_factor
 
-        number_of_photons = self.prng.poisson(lam=norm)
+        number_of_photons = draw_poisson(self.prng, norm, slice(None), 0)
 
-        energies = np.zeros(number_of_photons.sum())
+        active_cells = number_of_photons > 0
+        n_active = number_of_photons[active_cells]
 
-        start_e = 0
-        end_e = 0
-        for i in range(num_cells):
-            if number_of_photons[i] > 0:
-                end_e = start_e+number_of_photons[i]
-                u = self.prng.uniform(size=number_of_photons[i])
-                if alpha[i] == 1:
-                    e = self.emin.v*(self.emax.v/self.emin.v)**u
-                else:
-                    e = self.emin.v**(1.-alpha[i]) + u*norm_fac[i]
-                    e **= 1./(1.-alpha[i])
-                energies[start_e:end_e] = e * self.scale_factor
-                start_e = end_e
+        # Drawing all of the uniform deviates at once gives the same
+        # sequence as drawing them cell-by-cell, so this is equivalent
+        # to looping over the cells, but much faster.
+        u = draw_uniform(self.prng, n_active, active_cells, 1)
+        alpha = np.repeat(alpha[active_cells], n_active)
+        norm_fac = np.repeat(norm_fac[active_cells], n_active)
 
-        active_cells = number_of_photons > 0
+        energies = np.zeros(u.size)
+        unity = alpha == 1
+        energies[unity] = emin*(emax/emin)**u[unity]
+        a = 1.-alpha[~unity]
+        energies[~unity] = (emin**a + u[~unity]*norm_fac[~unity])**(1./a)
+        energies *= self.scale_factor
 
-        return number_of_photons[active_cells], active_cells, energies[:end_e].copy()
+        return n_active, active_cells, energies
 
     def cleanup_model(self):
         self.redshift = None
@@ -410,10 +632,15 @@ class LineSourceModel(SourceModel):
         are assumed to be in keV. If set to a field name, the line broadening
         is assumed to be based on this field (in units of velocity or energy).
         If set to None (the default), it is assumed that the line is unbroadened.
-    prng : :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
-        A pseudo-random number generator. Typically will only be specified
+    prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
+        A pseudo-random number generator, or a seed for a new
+        :class:`~numpy.random.Generator`. Typically will only be specified
         if you have a reason to generate the same set of random numbers, such as for a
-        test. Default is the :mod:`numpy.random` module.
+        test. Default is the :mod:`numpy.random` module. If a
+        :class:`~numpy.random.Generator` is used, independent streams are
+        spawned from it for each chunk of the data source. If a
+        :class:`~pyxsim.rng.CellKeyedPRNG` is supplied, the photons generated
+        for each cell or particle do not depend on how the data is chunked.
 
     Examples
     --------
@@ -439,47 +666,179 @@ class LineSourceModel(SourceModel):
             # Either no broadening or a field name
             self.sigma = sigma
         self.emission_field = emission_field
-        if prng is None:
-            self.prng = np.random
-        else:
-            self.prng = prng
+        self.prng = parse_prng(prng)
         self.spectral_norm = None
         self.redshift = None
 
     def setup_model(self, data_source, redshift, spectral_norm):
         self.spectral_norm = spectral_norm
         self.redshift = redshift
-        self.source_type = data_source.ds._get_field_info(self.emission_field).name[0]
+        self.source_type = get_source_type(data_source, self.emission_field)
         self.scale_factor = 1.0 / (1.0 + self.redshift)
 
-    def __call__(self, chunk):
-        num_cells = len(chunk[self.emission_field])
-        F = chunk[self.emission_field]*self.spectral_norm*self.scale_factor
-        number_of_photons = self.prng.poisson(lam=F.in_cgs().v)
-
-        energies = self.e0*np.ones(number_of_photons.sum())
-
-        if isinstance(self.sigma, YTQuantity):
-            dE = self.prng.normal(loc=0.0, scale=float(self.sigma),
-                                  size=number_of_photons.sum())*self.e0.uq
-            energies += dE
-        elif self.sigma is not None:
-            sigma = (chunk[self.sigma]*self.e0/clight).in_units("keV")
-            start_e = 0
-            for i in range(num_cells):
-                if number_of_photons[i] > 0:
-                    end_e = start_e+number_of_photons[i]
-                    dE = self.prng.normal(loc=0.0, scale=float(sigma[i]),
-                                          size=number_of_photons[i])*self.e0.uq
-                    energies[start_e:end_e] += dE
-                    start_e = end_e
-
-        energies = energies * self.scale_factor
+    def get_fields(self):
+        fields = [self.emission_field]
+        if self.sigma is not None and not isinstance(self.sigma, YTQuantity):
+            fields.append(self.sigma)
+        return fields
 
+    def estimate_cost(self, chunk):
+        return chunk[self.emission_field].d.sum()
+
+    def __call__(self, chunk):
+        e0 = self.e0.v
+        F = chunk[self.emission_field]
+        F = F.d*float(F.uq.in_cgs())*self.spectral_norm*self.scale_factor
+        number_of_photons = draw_poisson(self.prng, F, slice(None), 0)
+        n_ph = number_of_photons.sum()
         active_cells = number_of_photons > 0
 
+        energies = e0*np.ones(n_ph)
+
+        if self.sigma is not None:
+            dE = draw_normal(self.prng, number_of_photons[active_cells],
+                             active_cells, 1)
+            if isinstance(self.sigma, YTQuantity):
+                energies += float(self.sigma)*dE
+            else:
+                sigma = chunk[self.sigma]
+                sigma = sigma.d*get_conversion_factor(sigma, "km/s")*e0/ckms
+                # Scaling the standard deviates by the per-cell widths draws
+                # the same numbers as looping over the cells one at a time.
+                energies += np.repeat(sigma, number_of_photons)*dE
+
+        energies *= self.scale_factor
+
         return number_of_photons[active_cells], active_cells, energies
 
     def cleanup_model(self):
         self.redshift = None
         self.spectral_norm = None
+
+class TableSpectrumSourceModel(SourceModel):
+    r"""
+    Initialize a source model from a table of spectra which depend on a
+    single parameter, such as a spectral index or an ionization parameter.
+    The spectrum of each cell or particle is linearly interpolated in the
+    table from the value of the parameter field.
+
+    Parameters
+    ----------
+    ebins : array-like or :class:`~yt.units.yt_array.YTArray`
+        The edges of the energy bins of the spectra in the table, in the
+        rest frame of the source, of size nchan+1. If units are not given,
+        they are assumed to be in keV.
+    param_values : array-like
+        The values of the parameter for each spectrum in the table, of size
+        n_param. Must be monotonically increasing.
+    table : 2D array-like of shape (n_param, nchan)
+        The spectra for each value of the parameter. Each entry is the photon
+        count rate in the energy bin per unit of the *emission_field*, in the
+        rest frame of the source, so that the table multiplied by the
+        *emission_field* is in counts/s.
+    param_field : string or (ftype, fname) tuple
+        The field corresponding to the parameter, in the same units as
+        *param_values*. Cells or particles with parameter values outside of
+        the range of the table do not emit.
+    emission_field : string or (ftype, fname) tuple
+        The field which normalizes the spectrum of each cell or particle.
+    prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
+        A pseudo-random number generator, or a seed for a new
+        :class:`~numpy.random.Generator`. Typically will only be specified
+        if you have a reason to generate the same set of random numbers, such as for a
+        test. Default is the :mod:`numpy.random` module. If a
+        :class:`~numpy.random.Generator` is used, independent streams are
+        spawned from it for each chunk of the data source. If a
+        :class:`~pyxsim.rng.CellKeyedPRNG` is supplied, the photons generated
+        for each cell or particle do not depend on how the data is chunked.
+
+    Examples
+    --------
+    >>> ebins = np.linspace(0.1, 10.0, 1001)
+    >>> emid = 0.5*(ebins[1:]+ebins[:-1])
+    >>> index = np.linspace(1.0, 3.0, 21)
+    >>> table = np.array([emid**(-alpha)*np.diff(ebins) for alpha in index])
+    >>> table_model = TableSpectrumSourceModel(ebins, index, table,
+    ...                                        ("gas", "spectral_index"),
+    ...                                        ("gas", "nonthermal_emission"))
+    """
+    def __init__(self, ebins, param_values, table, param_field,
+                 emission_field, prng=None):
+        if hasattr(ebins, "units"):
+            ebins = ebins.in_units("keV")
+        self.ebins = np.array(ebins, dtype="float64")
+        self.param_values = np.array(param_values, dtype="float64")
+        self.table = np.array(table, dtype="float64")
+        if self.table.shape != (self.param_values.size, self.ebins.size-1):
+            raise RuntimeError("The shape of the table must be (%d, %d), " %
+                               (self.param_values.size, self.ebins.size-1) +
+                               "but it is %s!" % (self.table.shape,))
+        if np.any(np.diff(self.param_values) <= 0.0):
+            raise RuntimeError("The parameter values must be monotonically increasing!")
+        self.param_field = param_field
+        self.emission_field = emission_field
+        self.prng = parse_prng(prng)
+        # The CDFs only depend on the table, so we build them once
+        self.cdfs, self.tot_ph = stack_cdfs(self.table)
+        self.spectral_norm = None
+        self.redshift = None
+
+    def setup_model(self, data_source, redshift, spectral_norm):
+        self.spectral_norm = spectral_norm
+        self.redshift = redshift
+        self.source_type = get_source_type(data_source, self.emission_field)
+        self.scale_factor = 1.0 / (1.0 + self.redshift)
+
+    def get_fields(self):
+        return [self.param_field, self.emission_field]
+
+    def estimate_cost(self, chunk):
+        param = chunk[self.param_field].d
+        norm = chunk[self.emission_field].d
+        return norm[(param >= self.param_values[0]) &
+                    (param <= self.param_values[-1])].sum()
+
+    def __call__(self, chunk):
+
+        param = chunk[self.param_field].d
+        norm = chunk[self.emission_field].d
+
+        idxs = np.where((param >= self.param_values[0]) &
+                        (param <= self.param_values[-1]))[0]
+        if idxs.size == 0:
+            return
+
+        # Find the bracketing spectra for each cell
+        pidxs = np.searchsorted(self.param_values, param[idxs], side="right")-1
+        pidxs = np.clip(pidxs, 0, self.param_values.size-2)
+        p_l = self.param_values[pidxs]
+        p_r = self.param_values[pidxs+1]
+        t = (param[idxs]-p_l)/(p_r-p_l)
+
+        # The interpolated spectrum is a weighted sum of the two bracketing
+        # spectra, so each photon is drawn from one of them with a probability
+        # given by its share of the emission
+        w_l = (1.-t)*self.tot_ph[pidxs]
+        w_r = t*self.tot_ph[pidxs+1]
+        cell_norm = (w_l+w_r)*norm[idxs]*self.spectral_norm*self.scale_factor
+
+        number_of_photons = draw_poisson(self.prng, cell_norm, idxs, 0)
+
+        active_cells = number_of_photons > 0
+        n_active = number_of_photons[active_cells]
+        cells = idxs[active_cells]
+
+        p_r = w_r[active_cells]/(w_l[active_cells]+w_r[active_cells])
+        p_r = np.repeat(p_r, n_active)
+        rows = np.repeat(pidxs[active_cells], n_active)
+        rows += draw_uniform(self.prng, n_active, cells, 1) < p_r
+
+        u = draw_uniform(self.prng, n_active, cells, 2)
+        energies = invert_cdfs(u, rows, self.cdfs, self.ebins)
+        energies *= self.scale_factor
+
+        return n_active, cells, energies
+
+    def cleanup_model(self):
+        self.redshift = None
+        self.spectral_norm = None
@@ -4,8 +4,10 @@ Photon emission and absoprtion models.
 import numpy as np
 import os
 import h5py
+import threading
 
 from pyxsim.utils import mylog, check_file_location
+from pyxsim.rng import parse_prng
 from yt.units.yt_array import YTArray, YTQuantity
 from yt.utilities.physical_constants import hcgs, clight
 from yt.utilities.physical_ratios import erg_per_keV, amu_grams
@@ -19,6 +21,10 @@ cl = clight.v
 
 class ThermalSpectralModel(object):
 
+    # If True, the prepared spectra are kept when the source model is
+    # cleaned up, e.g. between the outputs of a time series
+    keep_spectrum = False
+
     def __init__(self, emin, emax, nchan):
         self.emin = YTQuantity(emin, "keV")
         self.emax = YTQuantity(emax, "keV")
@@ -34,6 +40,13 @@ class ThermalSpectralModel(object):
         pass
 
     def get_spectrum(self, kT):
+        """
+        Get the thermal emission spectrum given a temperature *kT* in keV.
+        """
+        cosmic_spec, metal_spec = self._get_spectrum(kT)
+        return YTArray(cosmic_spec, "cm**3/s"), YTArray(metal_spec, "cm**3/s")
+
+    def _get_spectrum(self, kT):
         pass
 
 class XSpecThermalModel(ThermalSpectralModel):
@@ -69,12 +82,32 @@ class XSpecThermalModel(ThermalSpectralModel):
         self.thermal_broad = thermal_broad
         if settings is None: settings = {}
         self.settings = settings
+        self.lock = threading.Lock()
+        self.zobs = None
         super(XSpecThermalModel, self).__init__(emin, emax, nchan)
 
+    def __getstate__(self):
+        # The XSPEC model objects cannot be pickled, so they are rebuilt
+        # when the model is unpickled
+        state = self.__dict__.copy()
+        for key in ["lock", "model", "thermal_comp"]:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        if self.zobs is not None:
+            self.prepare_spectrum(self.zobs)
+
     def prepare_spectrum(self, zobs):
         """
         Prepare the thermal model for execution given a redshift *zobs* for the spectrum.
+        The model is kept once it is made, so preparing it again for the same redshift
+        does nothing.
         """
+        if self.zobs == zobs and hasattr(self, "model"):
+            return
         import xspec
         xspec.Xset.chatter = 0
         if self.thermal_broad:
@@ -91,26 +124,28 @@ class XSpecThermalModel(ThermalSpectralModel):
             self.norm = 1.0e-14
         self.thermal_comp.norm = 1.0
         self.thermal_comp.Redshift = zobs
-
-    def get_spectrum(self, kT):
-        """
-        Get the thermal emission spectrum given a temperature *kT* in keV. 
-        """
-        self.thermal_comp.kT = kT
-        self.thermal_comp.Abundanc = 0.0
-        cosmic_spec = np.array(self.model.values(0))
-        if self.model_name == "bremss":
-            metal_spec = np.zeros(self.nchan)
-        else:
-            self.thermal_comp.Abundanc = 1.0
-            metal_spec = np.array(self.model.values(0)) - cosmic_spec
+        self.zobs = zobs
+
+    def _get_spectrum(self, kT):
+        # The XSPEC model is global state, so only one thread may
+        # evaluate it at a time
+        with self.lock:
+            self.thermal_comp.kT = kT
+            self.thermal_comp.Abundanc = 0.0
+            cosmic_spec = np.array(self.model.values(0))
+            if self.model_name == "bremss":
+                metal_spec = np.zeros(self.nchan)
+            else:
+                self.thermal_comp.Abundanc = 1.0
+                metal_spec = np.array(self.model.values(0)) - cosmic_spec
         cosmic_spec *= self.norm
         metal_spec *= self.norm
-        return YTArray(cosmic_spec, "cm**3/s"), YTArray(metal_spec, "cm**3/s")
+        return cosmic_spec, metal_spec
 
     def cleanup_spectrum(self):
         del self.thermal_comp
         del self.model
+        self.zobs = None
 
 class TableApecModel(ThermalSpectralModel):
     r"""
@@ -181,16 +216,35 @@ class TableApecModel(ThermalSpectralModel):
             mylog.error("COCO file %s does not exist" % self.cocofile)
             raise IOError("COCO file %s does not exist" % self.cocofile)
 
-        self.Tvals = self.line_handle[1].data.field("kT")
+        self.Tvals = np.array(self.line_handle[1].data.field("kT"))
         self.nT = len(self.Tvals)
         self.dTvals = np.diff(self.Tvals)
         self.minlam = self.wvbins.min()
         self.maxlam = self.wvbins.max()
+        self.zobs = None
+
+    def __getstate__(self):
+        # Open FITS files cannot be pickled, so they are reopened when
+        # the model is unpickled. Any prepared spectra are kept.
+        state = self.__dict__.copy()
+        state.pop("line_handle")
+        state.pop("coco_handle")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.line_handle = _astropy.pyfits.open(self.linefile)
+        self.coco_handle = _astropy.pyfits.open(self.cocofile)
 
     def prepare_spectrum(self, zobs):
         """
         Prepare the thermal model for execution given a redshift *zobs* for the spectrum.
+        The spectra are kept once they are made, so preparing the model again for the
+        same redshift (e.g., for each output of a time series) does nothing.
         """
+        if getattr(self, "zobs", None) == zobs:
+            return
+
         sfac = 1.0/(1.+zobs)
 
         cosmic_spec = np.zeros((self.nT, self.nchan))
@@ -207,6 +261,7 @@ class TableApecModel(ThermalSpectralModel):
 
         self.cosmic_spec = YTArray(cosmic_spec, "cm**3/s")
         self.metal_spec = YTArray(metal_spec, "cm**3/s")
+        self.zobs = zobs
 
     def _make_spectrum(self, kT, element, line_fields, coco_fields, scale_factor, velocity=0.0):
 
@@ -262,18 +317,15 @@ class TableApecModel(ThermalSpectralModel):
         coco_fields = {el: coco_data.field(el) for el in coco_fields}
         return line_fields, coco_fields
 
-    def get_spectrum(self, kT):
-        """
-        Get the thermal emission spectrum given a temperature *kT* in keV. 
-        """
+    def _get_spectrum(self, kT):
         tindex = np.searchsorted(self.Tvals, kT)-1
         if tindex >= self.Tvals.shape[0]-1 or tindex < 0:
-            return (YTArray(np.zeros(self.nchan), "cm**3/s"),)*2
+            return np.zeros(self.nchan), np.zeros(self.nchan)
         dT = (kT-self.Tvals[tindex])/self.dTvals[tindex]
-        cspec_l = self.cosmic_spec[tindex,:]
-        mspec_l = self.metal_spec[tindex,:]
-        cspec_r = self.cosmic_spec[tindex+1,:]
-        mspec_r = self.metal_spec[tindex+1,:]
+        cspec_l = self.cosmic_spec.d[tindex,:]
+        mspec_l = self.metal_spec.d[tindex,:]
+        cspec_r = self.cosmic_spec.d[tindex+1,:]
+        mspec_r = self.metal_spec.d[tindex+1,:]
         cosmic_spec = cspec_l*(1.-dT)+cspec_r*dT
         metal_spec = mspec_l*(1.-dT)+mspec_r*dT
         return cosmic_spec, metal_spec
@@ -337,13 +389,13 @@ class AbsorptionModel(object):
         """
         Get the absorption spectrum.
         """
-        sigma = np.interp(e, self.emid, self.sigma, left=0.0, right=0.0)
-        return np.exp(-sigma*self.nH)
+        sigma = np.interp(e, self.emid.d, self.sigma.d, left=0.0, right=0.0)
+        return np.exp(-sigma*self.nH.v)
 
     def cleanup_spectrum(self):
         pass
 
-    def absorb_photons(self, eobs, prng=np.random):
+    def absorb_photons(self, eobs, prng=None):
         r"""
         Determine which photons will be absorbed by foreground
         galactic absorption.
@@ -352,12 +404,13 @@ class AbsorptionModel(object):
         ----------
         eobs : array_like
             The energies of the photons in keV.
-        prng : :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
+        prng : integer, :class:`~numpy.random.SeedSequence`, :class:`~numpy.random.Generator`, :class:`~numpy.random.RandomState` object or :mod:`~numpy.random`, optional
             A pseudo-random number generator. Typically will only be specified
             if you have a reason to generate the same set of random numbers, such as for a
             test. Default is the :mod:`numpy.random` module.
         """
         mylog.info("Absorbing.")
+        prng = parse_prng(prng)
         self.prepare_spectrum()
         absorb = self.get_absorb(eobs)
         randvec = prng.uniform(size=eobs.shape)
@@ -496,4 +549,4 @@ class WabsModel(AbsorptionModel):
         e = np.array(e)
         idxs = np.minimum(np.searchsorted(emx, e)-1, 13)
         sigma = (c0[idxs]+c1[idxs]*e+c2[idxs]*e*e)*1.0e-24/e**3
-        return np.exp(-sigma*self.nH)
+        return np.exp(-sigma*self.nH.v)
@@ -0,0 +1,45 @@
+from pyxsim import \
+    PowerLawSourceModel, PhotonList, CellKeyedPRNG
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity
+import numpy as np
+from yt.utilities.physical_constants import mp
+
+def test_cell_keyed_prng():
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    # The cells of the small sphere are a subset of those of the large one,
+    # but are chunked together with different cells in each
+    sp1 = ds.sphere("c", (50., "kpc"))
+    sp2 = ds.sphere("c", (100., "kpc"))
+
+    photons = []
+    for sp in [sp1, sp2]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=CellKeyedPRNG(29))
+        photons.append(PhotonList.from_data_source(sp, redshift, A, exp_time,
+                                                   plaw_model, center="c"))
+
+    cells = []
+    for p in photons:
+        pos = np.array([p["x"].d, p["y"].d, p["z"].d]).T
+        cells.append(dict(zip([tuple(r) for r in pos], p["Energy"])))
+
+    assert len(cells[0]) > 0
+    for key, e in cells[0].items():
+        assert key in cells[1]
+        np.testing.assert_array_equal(e.d, cells[1][key].d)
+
+if __name__ == "__main__":
+    test_cell_keyed_prng()
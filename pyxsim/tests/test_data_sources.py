@@ -0,0 +1,98 @@
+from pyxsim import \
+    PowerLawSourceModel, PhotonList, CellKeyedPRNG
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity
+import numpy as np
+from yt.utilities.physical_constants import mp
+
+def get_cells(photons):
+    pos = np.array([photons["x"].d, photons["y"].d, photons["z"].d]).T
+    return dict(zip([tuple(r) for r in pos], photons["Energy"]))
+
+def test_data_sources():
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    # Two overlapping spheres, whose photons are keyed by cell so that
+    # they are the same however the cells are chunked
+    c = ds.domain_center
+    offset = ds.quan(40., "kpc").in_units("code_length")
+    sp1 = ds.sphere(c, (60., "kpc"))
+    sp2 = ds.sphere(c + offset, (60., "kpc"))
+
+    # The model is fresh, so its source type is only known once it has
+    # been set up on the region which encloses the sources
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=CellKeyedPRNG(23))
+    assert not hasattr(plaw_model, "source_type")
+    photon_lists = PhotonList.from_data_sources([sp1, sp2], redshift, A,
+                                                exp_time, plaw_model,
+                                                centers="c")
+    assert len(photon_lists) == 2
+
+    for sp, photons in zip([sp1, sp2], photon_lists):
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=CellKeyedPRNG(23))
+        single = PhotonList.from_data_source(sp, redshift, A, exp_time,
+                                             plaw_model, center="c")
+        cells = get_cells(photons)
+        single_cells = get_cells(single)
+        assert len(cells) > 0
+        assert set(cells.keys()) == set(single_cells.keys())
+        for key, e in cells.items():
+            np.testing.assert_array_equal(e.d, single_cells[key].d)
+        for key in ["FiducialRedshift", "Dimension", "Width", "DataType"]:
+            np.testing.assert_array_equal(np.asarray(photons.parameters[key]),
+                                          np.asarray(single.parameters[key]))
+
+def test_empty_cells():
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e2, "s")
+    redshift = 0.01
+
+    # Two spheres far enough apart that they are read separately, with
+    # a short exposure so that many of their cells have no photons
+    c = ds.domain_center
+    offset = ds.quan(300., "kpc").in_units("code_length")
+    sp1 = ds.sphere(c, (100., "kpc"))
+    sp2 = ds.sphere(c + offset, (100., "kpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=CellKeyedPRNG(23))
+    photon_lists = PhotonList.from_data_sources([sp1, sp2], redshift, A,
+                                                exp_time, plaw_model,
+                                                centers="c")
+
+    for sp, photons in zip([sp1, sp2], photon_lists):
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=CellKeyedPRNG(23))
+        single = PhotonList.from_data_source(sp, redshift, A, exp_time,
+                                             plaw_model, center="c")
+        cells = get_cells(photons)
+        single_cells = get_cells(single)
+        assert 0 < len(cells) < sp["density"].size
+        assert set(cells.keys()) == set(single_cells.keys())
+        for key, e in cells.items():
+            np.testing.assert_array_equal(e.d, single_cells[key].d)
+
+if __name__ == "__main__":
+    test_data_sources()
+    test_empty_cells()
@@ -0,0 +1,105 @@
+from pyxsim import \
+    TableApecModel, ThermalSourceModel, PhotonList
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.utilities.answer_testing.framework import requires_ds, \
+    data_dir_load
+from numpy.testing import assert_array_equal
+import tempfile
+import os
+import shutil
+
+gslr = "GasSloshingLowRes/sloshing_low_res_hdf5_plt_cnt_0300"
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+def get_sphere(ds):
+    sphere = ds.sphere("c", (0.1, "Mpc"))
+    sphere.set_field_parameter("X_H", 0.75)
+    return sphere
+
+@requires_ds(gslr)
+def test_dataset_series():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    ds = data_dir_load(gslr)
+    A = 2000.
+    exp_time = 1.0e4
+    redshift = 0.1
+
+    apec_model = TableApecModel(0.1, 11.0, 10000)
+
+    # The same output twice, which gets a different stream each time
+    ts = [ds, ds]
+
+    photons = []
+    for njobs in [1, 2]:
+        thermal_model = ThermalSourceModel(apec_model, Zmet=0.3, prng=25)
+        photon_files = PhotonList.from_dataset_series(ts, redshift, A, exp_time,
+                                                      thermal_model,
+                                                      "photons_%d" % njobs + "_%d.h5",
+                                                      data_source=get_sphere,
+                                                      njobs=njobs)
+        assert apec_model.zobs == redshift
+        photons.append([PhotonList.from_file(fn) for fn in photon_files])
+
+    for p1, p2 in zip(*photons):
+        for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+            assert_array_equal(p1[key], p2[key])
+        assert_array_equal(p1.photons["Energy"], p2.photons["Energy"])
+    assert photons[0][0].photons["Energy"].size != photons[0][1].photons["Energy"].size or \
+        (photons[0][0].photons["Energy"] != photons[0][1].photons["Energy"]).any()
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+class ResettingApecModel(TableApecModel):
+    # Forgets its spectra when it is cleaned up, as XSpecThermalModel does
+    num_prepared = 0
+
+    def prepare_spectrum(self, zobs):
+        if self.zobs != zobs:
+            self.num_prepared += 1
+        super(ResettingApecModel, self).prepare_spectrum(zobs)
+
+    def cleanup_spectrum(self):
+        self.zobs = None
+
+def test_keep_spectrum():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    A = 3000.
+    exp_time = 1.0e5
+    redshift = 0.05
+
+    apec_model = ResettingApecModel(0.1, 11.5, 2000)
+    thermal_model = ThermalSourceModel(apec_model, Zmet=0.3, prng=25)
+    photon_files = PhotonList.from_dataset_series([ds, ds], redshift, A, exp_time,
+                                                  thermal_model, "photons_%d.h5",
+                                                  data_source=lambda ds: ds.sphere("c", (0.5, "Mpc")))
+
+    # The spectra are prepared once for all of the outputs, and are only
+    # cleaned up at the end
+    assert apec_model.num_prepared == 1
+    assert apec_model.zobs is None
+    assert not apec_model.keep_spectrum
+    for fn in photon_files:
+        assert os.path.exists(fn)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_dataset_series()
+    test_keep_spectrum()
@@ -0,0 +1,57 @@
+from pyxsim import \
+    PowerLawSourceModel, PhotonList, CellKeyedPRNG
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity, YTArray
+import numpy as np
+from yt.utilities.physical_constants import mp
+
+def test_from_arrays():
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+    fields = {("gas", "hard_emission"): sphere["gas", "hard_emission"]}
+    positions = YTArray([sphere["index", ax].to("kpc").d for ax in "xyz"], "kpc").T
+    velocities = YTArray([sphere["gas", "velocity_%s" % ax].to("km/s").d
+                          for ax in "xyz"], "km/s").T
+    widths = sphere["index", "dx"]
+    center = ds.domain_center.to("kpc")
+
+    photons = []
+    for chunk_size in [1000, 1000000]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, ("gas", "hard_emission"),
+                                         1.1, prng=CellKeyedPRNG(31))
+        photons.append(PhotonList.from_arrays(fields, positions, redshift, A,
+                                              exp_time, plaw_model,
+                                              velocities=velocities,
+                                              widths=widths, center=center,
+                                              chunk_size=chunk_size))
+
+    # The photons of each cell do not depend on how the arrays are chunked
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+        np.testing.assert_array_equal(photons[0][key].d, photons[1][key].d)
+    np.testing.assert_array_equal(photons[0].photons["Energy"].d,
+                                  photons[1].photons["Energy"].d)
+    assert photons[0].parameters["DataType"] == "cells"
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, ("gas", "hard_emission"),
+                                     1.1, prng=32)
+    ds_photons = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                             plaw_model, center="c")
+    n1 = photons[0]["NumberOfPhotons"].sum()
+    n2 = ds_photons["NumberOfPhotons"].sum()
+    assert np.abs(n1-n2) < 5.0*np.sqrt(2.0*n2)
+    assert np.abs(photons[0]["x"].d).max() <= 100.0+widths.to("kpc").d.max()
+
+if __name__ == "__main__":
+    test_from_arrays()
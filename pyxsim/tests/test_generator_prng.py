@@ -0,0 +1,44 @@
+from pyxsim import \
+    PowerLawSourceModel, PhotonList
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity
+import numpy as np
+from numpy.random import SeedSequence
+from yt.utilities.physical_constants import mp
+
+def test_generator_prng():
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    photons = []
+    for prng in [29, SeedSequence(29), 30]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=prng)
+        photons.append(PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                                   plaw_model))
+
+    np.testing.assert_array_equal(photons[0]["NumberOfPhotons"],
+                                  photons[1]["NumberOfPhotons"])
+    np.testing.assert_array_equal(photons[0].photons["Energy"].d,
+                                  photons[1].photons["Energy"].d)
+    assert photons[0].photons["Energy"].size != photons[2].photons["Energy"].size or \
+        np.any(photons[0].photons["Energy"].d != photons[2].photons["Energy"].d)
+
+    events = photons[0].project_photons("z", absorb_model=None, prng=31)
+    events2 = photons[1].project_photons("z", absorb_model=None, prng=31)
+    np.testing.assert_array_equal(events["xpix"], events2["xpix"])
+
+if __name__ == "__main__":
+    test_generator_prng()
@@ -0,0 +1,87 @@
+from pyxsim import \
+    PowerLawSourceModel, PhotonList, PhotonCache
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity
+import numpy as np
+import tempfile
+import os
+import shutil
+import glob
+from yt.utilities.physical_constants import mp
+from numpy.random import RandomState
+
+def test_photon_cache():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    cache = PhotonCache("photon_cache")
+
+    photons = []
+    for redshift in [0.01, 0.01, 0.02]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=41)
+        photons.append(PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                                   plaw_model, cache=cache))
+
+    assert len(glob.glob(os.path.join("photon_cache", "*.h5"))) == 2
+
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+        np.testing.assert_array_equal(np.asarray(photons[0][key]),
+                                      np.asarray(photons[1][key]))
+    np.testing.assert_array_equal(photons[0].photons["Energy"].d,
+                                  photons[1].photons["Energy"].d)
+    assert photons[2].parameters["FiducialRedshift"] == 0.02
+
+    # A model which has just been used to generate photons is keyed by
+    # the state it had before, so generating its photons again reads them
+    # from the cache
+    for prng in [43, RandomState(43)]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=prng)
+        repeats = [PhotonList.from_data_source(sphere, 0.01, A, exp_time,
+                                               plaw_model, cache=cache)
+                   for i in range(2)]
+        for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+            np.testing.assert_array_equal(np.asarray(repeats[0][key]),
+                                          np.asarray(repeats[1][key]))
+        np.testing.assert_array_equal(repeats[0].photons["Energy"].d,
+                                      repeats[1].photons["Energy"].d)
+    assert len(glob.glob(os.path.join("photon_cache", "*.h5"))) == 4
+
+    # A model which is changed after it is created is keyed by its new
+    # state, and the numbers of threads and processes are part of the key
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=43)
+    plaw_model.prng = RandomState(44)
+    PhotonList.from_data_source(sphere, 0.01, A, exp_time, plaw_model, cache=cache)
+    assert len(glob.glob(os.path.join("photon_cache", "*.h5"))) == 5
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=41)
+    PhotonList.from_data_source(sphere, 0.01, A, exp_time, plaw_model,
+                                nthreads=2, cache=cache)
+    assert len(glob.glob(os.path.join("photon_cache", "*.h5"))) == 6
+
+    cache.max_size = 0
+    cache.evict()
+    assert len(glob.glob(os.path.join("photon_cache", "*.h5"))) == 1
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_photon_cache()
@@ -0,0 +1,602 @@
+from pyxsim import \
+    PowerLawSourceModel, PhotonList, EventList, HDF5Options, merge_files, \
+    RaggedArray
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity
+import numpy as np
+import tempfile
+import os
+import shutil
+from yt.utilities.physical_constants import mp
+from numpy.testing import assert_raises
+from pyxsim.photon_list import write_virtual_dataset, LazyPhotonArray
+import h5py
+
+def test_photon_file():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    photons = []
+    for photon_file in [None, "plaw_photons.h5"]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=41)
+        photons.append(PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                                   plaw_model, photon_file=photon_file))
+
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+        np.testing.assert_array_equal(np.asarray(photons[0][key]),
+                                      np.asarray(photons[1][key]))
+    np.testing.assert_array_equal(photons[0].photons["Energy"].d,
+                                  photons[1].photons["Energy"].d)
+    for key in ["FiducialArea", "FiducialExposureTime", "FiducialRedshift"]:
+        assert photons[0].parameters[key] == photons[1].parameters[key]
+
+    # The photons written to the file are read from it lazily
+    assert isinstance(photons[1].photons["x"], LazyPhotonArray)
+    photons[1].close()
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+class InterruptedSourceModel(PowerLawSourceModel):
+    def __init__(self, *args, **kwargs):
+        self.max_chunks = kwargs.pop("max_chunks")
+        self.num_chunks = 0
+        super(InterruptedSourceModel, self).__init__(*args, **kwargs)
+
+    def __call__(self, chunk):
+        self.num_chunks += 1
+        if self.num_chunks > self.max_chunks:
+            raise KeyboardInterrupt
+        return super(InterruptedSourceModel, self).__call__(chunk)
+
+def test_resume():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=41)
+    photons1 = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                           plaw_model)
+
+    plaw_model = InterruptedSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                        1.1, prng=41, max_chunks=5)
+    assert_raises(KeyboardInterrupt, PhotonList.from_data_source, sphere,
+                  redshift, A, exp_time, plaw_model, photon_file="plaw_photons.h5",
+                  checkpoint_interval=0.0)
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=41)
+    photons2 = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                           plaw_model, photon_file="plaw_photons.h5",
+                                           checkpoint_interval=0.0, resume=True)
+
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+        np.testing.assert_array_equal(np.asarray(photons1[key]),
+                                      np.asarray(photons2[key]))
+    np.testing.assert_array_equal(photons1.photons["Energy"].d,
+                                  photons2.photons["Energy"].d)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_lazy_file():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=41)
+    PhotonList.from_data_source(sphere, redshift, A, exp_time, plaw_model,
+                                photon_file="plaw_photons.h5")
+
+    photons = PhotonList.from_file("plaw_photons.h5")
+    with PhotonList.from_file("plaw_photons.h5", lazy=True) as lazy_photons:
+
+        assert isinstance(lazy_photons.photons["x"], LazyPhotonArray)
+        assert len(lazy_photons.photons["x"].blocks) == 0
+        assert lazy_photons.num_cells == photons.num_cells
+
+        for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons", "Energy"]:
+            np.testing.assert_array_equal(np.asarray(photons.photons[key]),
+                                          np.asarray(lazy_photons.photons[key]))
+        np.testing.assert_array_equal(np.asarray(photons["Energy"][100]),
+                                      np.asarray(lazy_photons["Energy"][100]))
+        np.testing.assert_allclose(photons["Energy"].sum().d,
+                                   lazy_photons["Energy"].sum().d)
+
+        events = photons.project_photons("z", exp_time_new=1.0e5, prng=24)
+        lazy_events = lazy_photons.project_photons("z", exp_time_new=1.0e5, prng=24)
+        for key in ["xpix", "ypix", "eobs"]:
+            np.testing.assert_array_equal(np.asarray(events[key]),
+                                          np.asarray(lazy_events[key]))
+
+        # Only the blocks which were used last are kept
+        x = lazy_photons.photons["x"]
+        small_blocks = LazyPhotonArray(x.dset, x.start, x.end, block_size=16,
+                                       max_blocks=2)
+        idxs = np.arange(len(x))[::-1]
+        np.testing.assert_array_equal(small_blocks[idxs],
+                                      photons.photons["x"].d[idxs])
+        assert len(small_blocks.blocks) == 2
+
+    assert not x.dset.id.valid
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_spatial_index():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=41)
+    photons = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                          plaw_model, center="c")
+    photons.write_h5_file("indexed_photons.h5", spatial_index=True, index_level=3)
+
+    def get_cells(p):
+        pos = np.array([p["x"].d, p["y"].d, p["z"].d]).T
+        return dict(zip([tuple(r) for r in pos], p["Energy"]))
+
+    all_cells = get_cells(photons)
+    assert get_cells(PhotonList.from_file("indexed_photons.h5")).keys() == all_cells.keys()
+
+    center = np.array([20.0, -10.0, 5.0])
+    region = PhotonList.from_file("indexed_photons.h5", region=(center, (30., "kpc")))
+    box = PhotonList.from_file("indexed_photons.h5",
+                               box=(center-30.0, center+30.0))
+
+    for p, inside in [(region, lambda pos: ((pos-center)**2).sum() <= 900.0),
+                      (box, lambda pos: np.all(np.abs(pos-center) <= 30.0))]:
+        cells = get_cells(p)
+        expected = [key for key in all_cells if inside(np.array(key))]
+        assert len(expected) > 0
+        assert set(cells.keys()) == set(expected)
+        for key, e in cells.items():
+            np.testing.assert_array_equal(e.d, all_cells[key].d)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_energy_band():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=41)
+    photons = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                          plaw_model, center="c")
+    photons.write_h5_file("photons.h5")
+    photons.write_h5_file("energy_photons.h5", energy_index=True)
+
+    emin, emax = 2.0, 5.0
+
+    def get_cells(p):
+        pos = np.array([p["x"].d, p["y"].d, p["z"].d]).T
+        return dict(zip([tuple(r) for r in pos], p["Energy"]))
+
+    expected = {}
+    for key, e in get_cells(photons).items():
+        e = e.d[(e.d >= emin) & (e.d <= emax)]
+        if e.size > 0:
+            expected[key] = e
+    assert 0 < len(expected) < photons.num_cells
+
+    # The energies of each cell are sorted in a file with an energy
+    # index, and the photon list itself is left as it was
+    energy_photons = PhotonList.from_file("energy_photons.h5")
+    sorted_energy = RaggedArray(photons["Energy"].data.d.copy(),
+                                photons["Energy"].offsets)
+    sorted_energy.sort()
+    np.testing.assert_array_equal(energy_photons["Energy"].data.d,
+                                  sorted_energy.data)
+    assert not np.array_equal(photons["Energy"].data.d, sorted_energy.data)
+
+    for fn in ["photons.h5", "energy_photons.h5"]:
+        band = PhotonList.from_file(fn, emin=emin, emax=emax)
+        cells = get_cells(band)
+        assert set(cells.keys()) == set(expected.keys())
+        for key, e in cells.items():
+            np.testing.assert_array_equal(np.sort(e.d), np.sort(expected[key]))
+        assert_raises(RuntimeError, PhotonList.from_file, fn, lazy=True, emin=emin)
+
+    # Cells of an indexed file are also selected by a region
+    region = PhotonList.from_file("energy_photons.h5", emin=emin, emax=emax,
+                                  region=([0.0, 0.0, 0.0], (50., "kpc")))
+    for key, e in get_cells(region).items():
+        np.testing.assert_array_equal(e.d, np.sort(expected[key]))
+
+    # Energies with units are converted to keV
+    emin_u = YTQuantity(2000., "eV")
+    emax_u = YTQuantity(5.0e-3, "MeV")
+    unit_band = PhotonList.from_file("energy_photons.h5", emin=(2000., "eV"),
+                                     emax=emax_u)
+    kev_band = PhotonList.from_file("energy_photons.h5", emin=emin_u.in_units("keV").v,
+                                    emax=emax_u.in_units("keV").v)
+    np.testing.assert_array_equal(unit_band["Energy"].data.d, kev_band["Energy"].data.d)
+
+    events = photons.project_photons("z", prng=24)
+    band_events = photons.project_photons("z", prng=24, emin=emin, emax=emax)
+    eobs = events["eobs"].d
+    np.testing.assert_array_equal(np.sort(band_events["eobs"].d),
+                                  np.sort(eobs[(eobs >= emin) & (eobs <= emax)]))
+    unit_events = photons.project_photons("z", prng=24, emin=(2000., "eV"),
+                                          emax=emax_u)
+    kev_events = photons.project_photons("z", prng=24, emin=emin_u.in_units("keV").v,
+                                         emax=emax_u.in_units("keV").v)
+    np.testing.assert_array_equal(unit_events["eobs"].d, kev_events["eobs"].d)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_io_options():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                     1.1, prng=41)
+    photons = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                          plaw_model, center="c")
+    events = photons.project_photons("z", prng=24)
+
+    assert_raises(ValueError, HDF5Options, compression="bzip2")
+    assert_raises(ValueError, HDF5Options, chunk_size=None)
+
+    photons.write_h5_file("plain_photons.h5",
+                          io_options=HDF5Options(chunk_size=None, compression=None,
+                                                 shuffle=False))
+    io_options = HDF5Options(chunk_size=1000, compression="gzip", fletcher32=True,
+                             precision="single")
+    photons.write_h5_file("photons.h5", io_options=io_options)
+    events.write_h5_file("events.h5", io_options=io_options)
+    merge_files(["events.h5", "events.h5"], "merged_events.h5",
+                add_exposure_times=True,
+                io_options=HDF5Options(compression="lzf"))
+
+    with h5py.File("plain_photons.h5", "r") as f:
+        assert f["data"]["energy"].chunks is None
+    with h5py.File("photons.h5", "r") as f:
+        dset = f["data"]["energy"]
+        assert dset.chunks == (1000,)
+        assert dset.compression == "gzip"
+        assert dset.shuffle and dset.fletcher32
+        assert dset.dtype == np.float32
+        assert f["data"]["num_photons"].dtype == photons["NumberOfPhotons"].dtype
+    with h5py.File("merged_events.h5", "r") as f:
+        assert f["data"]["eobs"].compression == "lzf"
+        assert f["data"]["eobs"].dtype == np.float32
+
+    new_photons = PhotonList.from_file("photons.h5")
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx"]:
+        np.testing.assert_allclose(new_photons[key].d, photons[key].d, rtol=1.0e-6)
+    np.testing.assert_array_equal(new_photons["NumberOfPhotons"],
+                                  photons["NumberOfPhotons"])
+    np.testing.assert_allclose(new_photons.photons["Energy"].d,
+                               photons.photons["Energy"].d, rtol=1.0e-6)
+
+    new_events = EventList.from_h5_file("events.h5")
+    merged_events = EventList.from_h5_file("merged_events.h5")
+    for key in ["xpix", "ypix", "xsky", "ysky", "eobs"]:
+        np.testing.assert_allclose(new_events[key], events[key], rtol=1.0e-6)
+        np.testing.assert_array_equal(merged_events[key],
+                                      np.concatenate([new_events[key]]*2))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_append_file():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sources = [ds.sphere("c", (50., "kpc")),
+               ds.box([0.1, -0.05, -0.05], [0.2, 0.05, 0.05])]
+
+    photons = []
+    for i, source in enumerate(sources):
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=41+i)
+        photons.append(PhotonList.from_data_source(source, redshift, A, exp_time,
+                                                   plaw_model, center="c"))
+
+    photons[0].write_h5_file("photons.h5", energy_index=True)
+    photons[1].append_to_file("photons.h5")
+    photons[0].write_h5_file("photons.h5", mode="a")
+    all_photons = PhotonList.from_file("photons.h5")
+
+    p_list = [photons[0], photons[1], photons[0]]
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+        np.testing.assert_array_equal(all_photons[key],
+                                      np.concatenate([p[key] for p in p_list]))
+    # The file has an energy index, so the energies of each cell are sorted
+    sorted_energy = RaggedArray.from_counts(
+        np.concatenate([p["Energy"].data.d for p in p_list]),
+        all_photons["NumberOfPhotons"])
+    sorted_energy.sort()
+    np.testing.assert_array_equal(all_photons["Energy"].data.d, sorted_energy.data)
+
+    # The width covers both sources, at the resolution of the finer one
+    width = all_photons.parameters["Width"]
+    dx_min = width/all_photons.parameters["Dimension"]
+    for p in photons:
+        assert (width >= p.parameters["Width"]).all()
+        assert (dx_min <= 1.0001*p.parameters["Width"]/p.parameters["Dimension"]).all()
+
+    with h5py.File("photons.h5", "r") as f:
+        assert f["data"]["energy_min"].shape == f["data"]["x"].shape
+    band = PhotonList.from_file("photons.h5", emin=2.0, emax=5.0)
+    e = all_photons["Energy"].data.d
+    assert band["NumberOfPhotons"].sum() == ((e >= 2.0) & (e <= 5.0)).sum()
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission", 1.1, prng=41)
+    other = PhotonList.from_data_source(sources[0], 0.02, A, exp_time,
+                                        plaw_model, center="c")
+    assert_raises(RuntimeError, other.append_to_file, "photons.h5")
+
+    photons[0].write_h5_file("contiguous_photons.h5",
+                             io_options=HDF5Options(chunk_size=None, compression=None,
+                                                    shuffle=False))
+    assert_raises(IOError, photons[1].append_to_file, "contiguous_photons.h5")
+    assert_raises(ValueError, photons[1].write_h5_file, "photons.h5", mode="r")
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_merge_files():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    photons = []
+    filenames = []
+    for i in range(3):
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=41+i)
+        photons.append(PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                                   plaw_model))
+        filenames.append("photons_%d.h5" % i)
+        photons[-1].write_h5_file(filenames[-1])
+
+    merge_files(filenames, "merged_photons.h5", add_exposure_times=True,
+                block_size=1000)
+    merged = [PhotonList.from_file("merged_photons.h5")]
+    if hasattr(h5py, "VirtualLayout"):
+        merge_files(filenames, "virtual_photons.h5", add_exposure_times=True,
+                    virtual=True)
+        with h5py.File("virtual_photons.h5", "r") as f:
+            assert f["data"]["energy"].is_virtual
+        merged.append(PhotonList.from_file("virtual_photons.h5"))
+
+    for p in merged:
+        assert p.parameters["FiducialExposureTime"] == 3*exp_time
+        for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+            np.testing.assert_array_equal(p[key], np.concatenate([p0[key] for p0 in photons]))
+        np.testing.assert_array_equal(p["Energy"].data,
+                                      np.concatenate([p0["Energy"].data for p0 in photons]))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_photon_info():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission", 1.1, prng=45)
+    photons = PhotonList.from_data_source(sphere, redshift, A, exp_time, plaw_model)
+    photons.write_h5_file("photons.h5")
+
+    def check_info(info, photons):
+        n_ph = np.asarray(photons["NumberOfPhotons"])
+        energy = photons["Energy"].data.d
+        assert info["num_cells"] == n_ph.size
+        assert info["num_photons"] == n_ph.sum()
+        assert info["spectrum"].sum() == n_ph.sum()
+        assert info["energy_min"].v == energy.min()
+        assert info["energy_max"].v == energy.max()
+        for i, ax in enumerate("xyz"):
+            pos = np.asarray(photons[ax])
+            assert info["left_edge"][i].v == pos.min()
+            assert info["right_edge"][i].v == pos.max()
+            assert info["images"][ax].shape == (64, 64)
+            assert info["images"][ax].sum() <= n_ph.sum()
+        hist = np.histogram(np.clip(energy, 0.01, 100.0), info["spectrum_bins"].d)[0]
+        np.testing.assert_array_equal(info["spectrum"], hist)
+
+    info = PhotonList.info("photons.h5")
+    check_info(info, photons)
+    assert info["parameters"]["FiducialExposureTime"] == exp_time
+
+    # Files without a summary are summarized from their photons
+    shutil.copy("photons.h5", "no_summary.h5")
+    with h5py.File("no_summary.h5", "r+") as f:
+        del f["summary"]
+    info2 = PhotonList.info("no_summary.h5")
+    for key in ["num_cells", "num_photons", "spectrum"]:
+        np.testing.assert_array_equal(info[key], info2[key])
+    for ax in "xyz":
+        np.testing.assert_array_equal(info["images"][ax], info2["images"][ax])
+
+    # The summary is updated when photons are appended or files are merged
+    plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission", 1.1, prng=46)
+    photons2 = PhotonList.from_data_source(sphere, redshift, A, exp_time, plaw_model)
+    photons2.write_h5_file("photons2.h5")
+    shutil.copy("photons.h5", "appended.h5")
+    photons2.append_to_file("appended.h5")
+    merge_files(["photons.h5", "photons2.h5"], "merged.h5", add_exposure_times=True)
+    for fn in ["appended.h5", "merged.h5"]:
+        check_info(PhotonList.info(fn), PhotonList.from_file(fn))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_virtual_dataset():
+
+    if not hasattr(h5py, "VirtualLayout"):
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    # The files of three processors, one of which has no photons
+    sizes = [3, 0, 4]
+    disps = [0, 3, 3]
+    filenames = ["photons.h5.%d" % rank for rank in range(3)]
+    for rank, fn in enumerate(filenames):
+        with h5py.File(fn, "w") as f:
+            f.create_group("data").create_dataset("x", data=np.arange(sizes[rank])+10.*rank)
+    with h5py.File("photons.h5", "w") as f:
+        write_virtual_dataset(f.create_group("data"), "x", "float64", filenames,
+                              sizes, disps)
+
+    # The files are found relative to the virtual file
+    os.chdir(curdir)
+    with h5py.File(os.path.join(tmpdir, "photons.h5"), "r") as f:
+        np.testing.assert_array_equal(f["data"]["x"][:],
+                                      [0., 1., 2., 20., 21., 22., 23.])
+
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_photon_file()
+    test_resume()
+    test_lazy_file()
+    test_spatial_index()
+    test_energy_band()
+    test_io_options()
+    test_append_file()
+    test_merge_files()
+    test_photon_info()
+    test_virtual_dataset()
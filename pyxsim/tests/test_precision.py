@@ -0,0 +1,64 @@
+from pyxsim import \
+    PowerLawSourceModel, PhotonList
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity
+import numpy as np
+import tempfile
+import os
+import shutil
+from yt.utilities.physical_constants import mp
+
+def test_precision():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    photons = []
+    for precision in ["double", "single"]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=41)
+        photons.append(PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                                   plaw_model, precision=precision))
+
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "Energy"]:
+        assert photons[0].photons[key].dtype == np.float64
+        assert photons[1].photons[key].dtype == np.float32
+        np.testing.assert_allclose(photons[0].photons[key].d,
+                                   photons[1].photons[key].d,
+                                   rtol=1.0e-6, atol=1.0e-4)
+    assert photons[1]["NumberOfPhotons"].dtype == np.int32
+    np.testing.assert_array_equal(photons[0]["NumberOfPhotons"],
+                                  photons[1]["NumberOfPhotons"])
+
+    photons[0].write_h5_file("double_photons.h5")
+    photons[1].write_h5_file("single_photons.h5")
+    assert os.path.getsize("single_photons.h5") < 0.6*os.path.getsize("double_photons.h5")
+
+    single_photons = PhotonList.from_file("single_photons.h5")
+    assert single_photons.photons["Energy"].dtype == np.float32
+    double_photons = PhotonList.from_file("single_photons.h5", precision="double")
+    assert double_photons.photons["Energy"].dtype == np.float64
+    assert double_photons["NumberOfPhotons"].dtype == np.int64
+    np.testing.assert_array_equal(single_photons.photons["Energy"].d,
+                                  photons[1].photons["Energy"].d)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_precision()
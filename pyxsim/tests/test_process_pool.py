@@ -0,0 +1,120 @@
+from pyxsim import \
+    TableApecModel, ThermalSourceModel, PowerLawSourceModel, PhotonList
+from pyxsim.process_pool import pack_arrays, unpack_arrays, shared_memory
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.utilities.answer_testing.framework import requires_ds, \
+    data_dir_load
+from yt.utilities.grid_data_format.writer import write_to_gdf
+from yt.units.yt_array import YTQuantity
+from yt.utilities.physical_constants import mp
+from yt.convenience import load
+from yt import add_field
+from numpy.testing import assert_array_equal, assert_raises
+import numpy as np
+import multiprocessing
+import pickle
+import tempfile
+import os
+import shutil
+
+gslr = "GasSloshingLowRes/sloshing_low_res_hdf5_plt_cnt_0300"
+
+def setup():
+    from yt.config import ytcfg
+    ytcfg["yt", "__withintesting"] = "True"
+
+@requires_ds(gslr)
+def test_process_pool():
+
+    ds = data_dir_load(gslr)
+    A = 2000.
+    exp_time = 1.0e4
+    redshift = 0.1
+
+    apec_model = TableApecModel(0.1, 11.0, 10000)
+
+    sphere = ds.sphere("c", (0.1, "Mpc"))
+    sphere.set_field_parameter("X_H", 0.75)
+
+    photons = []
+    for nprocs in [1, 2]:
+        thermal_model = ThermalSourceModel(apec_model, Zmet=0.3, prng=25)
+        photons.append(PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                                   thermal_model, nprocs=nprocs))
+
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+        assert_array_equal(photons[0][key], photons[1][key])
+    assert_array_equal(photons[0].photons["Energy"], photons[1].photons["Energy"])
+
+def _hard_emission(field, data):
+    return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+
+def test_process_pool_grid():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    # The worker processes reopen the dataset from disk, so the grid is
+    # written to a file, and the emission field is added to every dataset
+    bms = BetaModelSource()
+    write_to_gdf(bms.ds, "beta_model.gdf")
+    add_field(("gas", "hard_emission"), function=_hard_emission,
+              units="keV**-1*s**-1")
+    ds = load("beta_model.gdf")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    photons = []
+    for nprocs in [1, 2]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=41)
+        photons.append(PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                                   plaw_model, nprocs=nprocs))
+
+    assert photons[0].num_cells > 0
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+        assert_array_equal(photons[0][key], photons[1][key])
+    assert_array_equal(photons[0].photons["Energy"], photons[1].photons["Energy"])
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+def test_pickle_apec():
+
+    apec_model = TableApecModel(0.1, 11.0, 1000)
+    apec_model.prepare_spectrum(0.05)
+    cspec1, mspec1 = apec_model.get_spectrum(6.0)
+    apec_model2 = pickle.loads(pickle.dumps(apec_model))
+    cspec2, mspec2 = apec_model2.get_spectrum(6.0)
+
+    assert_array_equal(cspec1, cspec2)
+    assert_array_equal(mspec1, mspec2)
+
+def pack_test_arrays(i):
+    return pack_arrays({"x": np.arange(10.)*i, "n": np.arange(3)})
+
+def test_shared_memory():
+
+    if shared_memory is None:
+        return
+
+    # The blocks must outlive the workers which wrote them, until they
+    # are read by this process
+    pool = multiprocessing.Pool(2)
+    try:
+        packed = pool.map(pack_test_arrays, range(4))
+    finally:
+        pool.close()
+        pool.join()
+
+    for i, (name, layout) in enumerate(packed):
+        arrays = unpack_arrays(name, layout)
+        assert_array_equal(arrays["x"], np.arange(10.)*i)
+        assert_array_equal(arrays["n"], np.arange(3))
+        assert_raises(FileNotFoundError, shared_memory.SharedMemory, name=name)
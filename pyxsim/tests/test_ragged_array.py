@@ -0,0 +1,67 @@
+from pyxsim import RaggedArray
+from yt.units.yt_array import YTArray
+from numpy.random import RandomState
+from numpy.testing import assert_array_equal, assert_allclose, \
+    assert_raises
+import numpy as np
+
+def test_ragged_array():
+
+    prng = RandomState(25)
+    counts = prng.randint(0, 5, size=100)
+    counts[0] = 0
+    counts[-1] = 0
+    data = YTArray(prng.uniform(0.1, 10.0, size=counts.sum()), "keV")
+    energy = RaggedArray.from_counts(data, counts)
+    rows = [data[i0:i1] for i0, i1 in zip(energy.offsets[:-1], energy.offsets[1:])]
+
+    assert len(energy) == 100
+    assert str(energy.units) == "keV"
+    assert_array_equal(energy.count(), counts)
+    assert_raises(IndexError, energy.__getitem__, 100)
+    assert_raises(ValueError, RaggedArray, data, [0, 10])
+
+    for i in [0, 1, 50, -1, -2]:
+        assert_array_equal(energy[i], rows[i])
+    assert_array_equal(list(energy)[3], rows[3])
+
+    sub = energy[10:40]
+    assert np.shares_memory(sub.data, data)
+    for idxs in [slice(10, 40), slice(None, None, 3), slice(80, 20, -4),
+                 np.array([5, 5, -1, 17]), counts > 2]:
+        sub = energy[idxs]
+        expected = [rows[i] for i in np.arange(100)[idxs]]
+        assert len(sub) == len(expected)
+        for e1, e2 in zip(sub, expected):
+            assert_array_equal(e1, e2)
+
+    has_data = counts > 0
+    assert str(energy.sum().units) == "keV"
+    assert_allclose(energy.sum().d, [row.d.sum() for row in rows])
+    assert_allclose(energy.mean().d[has_data],
+                    [row.d.mean() for row in rows if row.size > 0])
+    assert_array_equal(energy.min().d[has_data],
+                       [row.d.min() for row in rows if row.size > 0])
+    assert_array_equal(energy.max().d[has_data],
+                       [row.d.max() for row in rows if row.size > 0])
+    assert np.isnan(energy.min().d[~has_data]).all()
+    assert (energy.max(fill=0.0).d[~has_data] == 0.0).all()
+    assert (energy.sum().d[~has_data] == 0.0).all()
+
+    sorted_energy = RaggedArray.from_counts(data.copy(), counts)
+    sorted_energy.sort()
+    for row, sorted_row in zip(rows, sorted_energy):
+        assert_array_equal(sorted_row, np.sort(row))
+
+    values = prng.uniform(0.0, 11.0, size=100)
+    for side in ["left", "right"]:
+        for v in [values, 5.0]:
+            pos = sorted_energy.searchsorted(v, side=side)
+            v = np.broadcast_to(v, (100,))
+            for i, row in enumerate(sorted_energy):
+                assert pos[i] == sorted_energy.offsets[i] + \
+                    np.searchsorted(row.d, v[i], side=side)
+    assert_raises(ValueError, sorted_energy.searchsorted, 5.0, side="middle")
+
+if __name__ == "__main__":
+    test_ragged_array()
@@ -0,0 +1,41 @@
+from pyxsim.scheduling import lpt_schedule, partition_offsets
+import numpy as np
+
+def test_lpt_schedule():
+
+    prng = np.random.RandomState(24)
+
+    # A few expensive chunks, like the core of a cluster, and many cheap ones
+    costs = np.concatenate([20.0*prng.uniform(size=8), prng.uniform(size=500)])
+    prng.shuffle(costs)
+
+    for size in [1, 3, 8]:
+        owners = lpt_schedule(costs, size)
+        loads = np.array([costs[owners == rank].sum() for rank in range(size)])
+        assert loads.sum() == costs.sum()
+        assert loads.max()-loads.min() <= costs.max()
+
+def test_partition_offsets():
+
+    prng = np.random.RandomState(24)
+
+    # Numbers of photons in cells which vary by orders of magnitude, with
+    # the brightest cells all together, like the core of a cluster
+    n_ph = np.sort((10**prng.uniform(0, 4, size=5000)).astype("int64"))
+    n_ph[prng.uniform(size=5000) < 0.3] = 0
+
+    for size in [1, 3, 8, 64]:
+        offsets = partition_offsets(n_ph, size)
+        assert offsets[0] == 0 and offsets[-1] == n_ph.size
+        assert (np.diff(offsets) >= 0).all()
+        loads = np.array([n_ph[i0:i1].sum() for i0, i1 in zip(offsets[:-1], offsets[1:])])
+        # Each end of a range is off by at most half of the photons of a cell
+        assert loads.max()-loads.min() <= 2*n_ph.max()
+
+    np.testing.assert_array_equal(partition_offsets(np.zeros(6, dtype="int64"), 3),
+                                  [0, 2, 4, 6])
+    np.testing.assert_array_equal(partition_offsets([100, 1, 1, 1], 2), [0, 1, 4])
+
+if __name__ == "__main__":
+    test_lpt_schedule()
+    test_partition_offsets()
@@ -0,0 +1,61 @@
+from pyxsim import \
+    TableSpectrumSourceModel, PhotonList
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity, uconcatenate
+import numpy as np
+from yt.utilities.physical_constants import mp
+from numpy.random import RandomState
+
+def test_table_spectrum():
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    prng = RandomState(33)
+
+    alpha_sim = 1.5
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="s**-1")
+
+    def _spectral_index(field, data):
+        return alpha_sim*data["ones"]
+    ds.add_field(("gas", "spectral_index"), function=_spectral_index, units="")
+
+    ebins = np.linspace(0.5, 10.0, 2001)
+    emid = 0.5*(ebins[1:]+ebins[:-1])
+    index = np.linspace(1.0, 2.0, 11)
+    # Normalize each spectrum to unity so that the emission field is the
+    # photon count rate
+    table = np.array([emid**(-alpha)*np.diff(ebins) for alpha in index])
+    table /= table.sum(axis=1)[:,np.newaxis]
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    table_model = TableSpectrumSourceModel(ebins, index, table, "spectral_index",
+                                           "hard_emission", prng=prng)
+
+    photons = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                          table_model)
+
+    D_A = photons.parameters["FiducialAngularDiameterDistance"]
+    dist_fac = 1.0/(4.*np.pi*D_A*D_A*(1.+redshift)**3)
+    n_E_pred = (exp_time*A*sphere["hard_emission"].sum()*dist_fac).in_units("dimensionless")
+
+    E = uconcatenate(photons["Energy"]).d
+    n_E = len(E)
+
+    spec = emid**(-alpha_sim)*np.diff(ebins)
+    E_pred = (spec*emid).sum()/spec.sum()/(1.+redshift)
+
+    assert np.abs(n_E-n_E_pred) < 1.645*np.sqrt(n_E)
+    assert np.abs(E.mean()-E_pred) < 1.645*E.std()/np.sqrt(n_E)
+
+if __name__ == "__main__":
+    test_table_spectrum()
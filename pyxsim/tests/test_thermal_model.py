@@ -0,0 +1,44 @@
+from pyxsim import \
+    TableApecModel, ThermalSourceModel, PhotonList, RaggedArray
+from pyxsim.tests.utils import \
+    BetaModelSource
+from numpy.testing import assert_array_equal, assert_raises
+import numpy as np
+
+def test_thermal_methods():
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    A = 3000.
+    exp_time = 1.0e5
+    redshift = 0.05
+
+    apec_model = TableApecModel(0.1, 11.5, 2000, thermal_broad=False)
+
+    sphere = ds.sphere("c", (0.5, "Mpc"))
+
+    # The energies of the photons in each cell are sorted
+    for method in ["invert_cdf", "mixture"]:
+        thermal_model = ThermalSourceModel(apec_model, Zmet=0.3, prng=30,
+                                           method=method)
+        photons = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                              thermal_model)
+        energy = photons["Energy"]
+        sorted_energy = RaggedArray(energy.data.d.copy(), energy.offsets)
+        sorted_energy.sort()
+        assert_array_equal(sorted_energy.data, energy.data.d)
+
+    # The photons drawn by the acceptance-rejection method are at the
+    # centers of the channels
+    thermal_model = ThermalSourceModel(apec_model, Zmet=0.3, prng=30,
+                                       method="accept_reject")
+    assert thermal_model.method == "accept_reject"
+    photons = PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                          thermal_model)
+    assert np.isin(photons["Energy"].data.d, apec_model.emid.d).all()
+
+    assert_raises(ValueError, ThermalSourceModel, apec_model, method="rejection")
+
+if __name__ == "__main__":
+    test_thermal_methods()
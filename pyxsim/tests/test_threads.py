@@ -0,0 +1,57 @@
+from pyxsim import \
+    PowerLawSourceModel, PhotonList
+from pyxsim.tests.utils import \
+    BetaModelSource
+from yt.units.yt_array import YTQuantity
+import numpy as np
+from yt.utilities.physical_constants import mp
+from numpy.random import RandomState
+
+def test_threads():
+    check_photons(nthreads=4)
+
+def test_prefetch():
+    check_photons(prefetch=2)
+    check_photons(nthreads=4, prefetch=2)
+
+def test_threads_legacy_prng():
+    # Each chunk draws from its own RandomState, so the photons do not
+    # depend on the number of threads
+    check_photons(base_kwargs={"nthreads": 2}, nthreads=4,
+                  prng=lambda: RandomState(41))
+
+def check_photons(base_kwargs=None, prng=lambda: 41, **kwargs):
+
+    if base_kwargs is None:
+        base_kwargs = {}
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return YTQuantity(1.0e-18, "s**-1*keV**-1")*data["density"]*data["cell_volume"]/mp
+    ds.add_field(("gas", "hard_emission"), function=_hard_emission, units="keV**-1*s**-1")
+
+    A = YTQuantity(2000., "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100., "kpc"))
+
+    photons = []
+    for kw in [base_kwargs, kwargs]:
+        plaw_model = PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission",
+                                         1.1, prng=prng())
+        photons.append(PhotonList.from_data_source(sphere, redshift, A, exp_time,
+                                                   plaw_model, **kw))
+
+    for key in ["x", "y", "z", "vx", "vy", "vz", "dx", "NumberOfPhotons"]:
+        np.testing.assert_array_equal(np.asarray(photons[0][key]),
+                                      np.asarray(photons[1][key]))
+    np.testing.assert_array_equal(photons[0].photons["Energy"].d,
+                                  photons[1].photons["Energy"].d)
+
+if __name__ == "__main__":
+    test_threads()
+    test_prefetch()
+    test_threads_legacy_prng()
@@ -1,8 +1,9 @@
 import numpy as np
 from yt.funcs import iterable
-from yt.units.yt_array import YTQuantity
+from yt.units.yt_array import YTQuantity, YTArray
 from six import string_types
 from collections import defaultdict
+from pyxsim.photon_summary import PhotonSummary
 import h5py
 import os
 import sys
@@ -61,6 +62,23 @@ def parse_value(value, default_units, ds=None):
     else:
         return quan(value, default_units)
 
+def parse_array(arr, default_units):
+    if isinstance(arr, YTArray):
+        return arr.in_units(default_units)
+    else:
+        return YTArray(np.asarray(arr, dtype="float64"), default_units)
+
+def get_conversion_factor(arr, units):
+    """
+    Return the scalar factor which converts the raw values of the
+    array *arr* to *units*. Multiplying the plain NumPy array by this
+    factor avoids creating unit-aware temporaries in hot loops. Arrays
+    without units are assumed to already be in *units*.
+    """
+    if not hasattr(arr, "units"):
+        return 1.0
+    return float(arr.uq.in_units(units))
+
 def validate_parameters(first, second, skip=[]):
     keys1 = list(first.keys())
     keys2 = list(first.keys())
@@ -80,8 +98,150 @@ def validate_parameters(first, second, skip=[]):
                 raise RuntimeError("The values for the parameter '%s' in the two inputs" % k1 +
                                    " are not identical (%s vs. %s)!" % (v1, v2))
 
+class HDF5Options(object):
+    r"""
+    Options for how the datasets of photon and event files are laid out
+    and compressed on disk, which may be passed to
+    :meth:`~pyxsim.photon_list.PhotonList.write_h5_file`,
+    :meth:`~pyxsim.event_list.EventList.write_h5_file` and
+    :func:`~pyxsim.utils.merge_files`.
+
+    Parameters
+    ----------
+    chunk_size : integer or None, optional
+        The number of elements in each chunk of a dataset. HDF5 reads and
+        decompresses whole chunks, so large chunks are fastest for reading
+        a file from start to end, and small ones waste less for reading a
+        few elements at a time. If None, the datasets are stored without
+        chunks, which rules out the filters. Default: 262144.
+    compression : string or None, optional
+        The compression filter, "gzip", "lzf", or None for no compression.
+        "gzip" is available everywhere HDF5 is, "lzf" is faster but
+        only available in h5py. Default: "gzip"
+    compression_level : integer, optional
+        The level of "gzip" compression, from 0 to 9. Higher levels make
+        files only slightly smaller for X-ray photons, but take much longer
+        to write. Default: 1
+    shuffle : boolean, optional
+        Whether or not to shuffle the bytes of the elements before they
+        are compressed, which puts the bytes of the exponents of floats
+        together and makes them compress much better. Default: True
+    fletcher32 : boolean, optional
+        Whether or not to store a checksum with each chunk, which is checked
+        when it is read. Default: False
+    precision : string or None, optional
+        If "single" or "double", floating-point datasets are written as
+        single or double precision floats. If None, they are written with
+        the types they have in memory. Default: None
+
+    Examples
+    --------
+    >>> io_options = HDF5Options(compression="lzf", precision="single")
+    >>> photons.write_h5_file("photons.h5", io_options=io_options)
+    """
+    def __init__(self, chunk_size=262144, compression="gzip", compression_level=1,
+                 shuffle=True, fletcher32=False, precision=None):
+        if compression not in ("gzip", "lzf", None):
+            raise ValueError("compression must be 'gzip', 'lzf', or None, not '%s'!" % compression)
+        if precision not in ("single", "double", None):
+            raise ValueError("precision must be 'single', 'double', or None, not '%s'!" % precision)
+        if chunk_size is None and (compression is not None or shuffle or fletcher32):
+            raise ValueError("Datasets without chunks cannot be compressed, shuffled, "
+                             "or checksummed!")
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.shuffle = shuffle
+        self.fletcher32 = fletcher32
+        self.precision = precision
+
+    def __repr__(self):
+        return "HDF5Options(chunk_size=%s, compression=%s, compression_level=%d, " \
+               "shuffle=%s, fletcher32=%s, precision=%s)" % \
+               (self.chunk_size, repr(self.compression), self.compression_level,
+                self.shuffle, self.fletcher32, repr(self.precision))
+
+    def get_dataset_kwargs(self, size, filters=True, resizable=False):
+        """
+        Return the keyword arguments to :meth:`h5py.Group.create_dataset`
+        for a 1D dataset with *size* elements. If *filters* is False, the
+        dataset is chunked but not compressed, shuffled, or checksummed.
+        If *resizable* is True, the dataset may be extended later, which
+        requires chunks.
+        """
+        if self.chunk_size is None:
+            return {}
+        if resizable:
+            kwargs = {"chunks": (min(self.chunk_size, max(size, self.chunk_size//16)),),
+                      "maxshape": (None,)}
+        elif size == 0:
+            return {}
+        else:
+            # Chunks cannot be larger than a dataset which cannot grow
+            kwargs = {"chunks": (min(self.chunk_size, size),)}
+        if filters:
+            if self.compression is not None:
+                kwargs["compression"] = self.compression
+            if self.compression == "gzip":
+                kwargs["compression_opts"] = self.compression_level
+            kwargs["shuffle"] = self.shuffle
+            kwargs["fletcher32"] = self.fletcher32
+        return kwargs
+
+    def get_dtype(self, dtype):
+        """
+        Return the type which arrays of type *dtype* are written with.
+        """
+        dtype = np.dtype(dtype)
+        if self.precision is None or dtype.kind != "f":
+            return dtype
+        return np.dtype("float32" if self.precision == "single" else "float64")
+
+    def cast(self, arr):
+        """
+        Cast the array *arr* to the floating-point type of the precision,
+        if it is a floating-point array.
+        """
+        arr = np.asarray(arr)
+        return arr.astype(self.get_dtype(arr.dtype), copy=False)
+
+    def create_dataset(self, group, name, data, resizable=False):
+        """
+        Write the 1D array *data* to the dataset *name* in *group*, which
+        may be extended later if *resizable* is True.
+        """
+        data = self.cast(data)
+        return group.create_dataset(name, data=data,
+                                    **self.get_dataset_kwargs(data.size,
+                                                              resizable=resizable))
+
+def write_virtual_dataset(group, name, dtype, filenames, sizes, disps):
+    """
+    Create the dataset *name* in *group* as a virtual dataset which joins
+    together the datasets of the same name in the "data" groups of the
+    *filenames*, with the given *sizes*, at the offsets *disps*. The files
+    are referred to by their paths relative to the directory of the file
+    of *group*, so they may be moved along with it.
+    """
+    vds_dir = os.path.dirname(os.path.abspath(group.file.filename))
+    size = sum(sizes)
+    if size == 0:
+        group.create_dataset(name, (0,), dtype=dtype)
+        return
+    layout = h5py.VirtualLayout(shape=(size,), dtype=dtype)
+    for fn, n, start in zip(filenames, sizes, disps):
+        if n > 0:
+            path = os.path.relpath(os.path.abspath(fn), vds_dir)
+            layout[start:start+n] = h5py.VirtualSource(path, "data/%s" % name,
+                                                       shape=(n,))
+    group.create_virtual_dataset(name, layout)
+
+def read_parameter_values(p):
+    return dict((key, force_unicode(param.value)) for key, param in p.items())
+
 def merge_files(input_files, output_file, clobber=False,
-                add_exposure_times=False):
+                add_exposure_times=False, io_options=None, virtual=False,
+                block_size=1048576):
     r"""
     Helper function for merging PhotonList or EventList HDF5 files.
 
@@ -97,6 +257,18 @@ def merge_files(input_files, output_file, clobber=False,
     add_exposure_times : boolean, default False
         If set to True, exposure times will be added together. Otherwise,
         the exposure times of all of the files must be the same.
+    io_options : :class:`~pyxsim.utils.HDF5Options`, optional
+        How the datasets of the merged file are chunked and compressed.
+        Default: The default :class:`~pyxsim.utils.HDF5Options`.
+    virtual : boolean, default False
+        If set to True, the datasets of the merged file are HDF5 virtual
+        datasets which refer to those of the input files, so that no data
+        is copied, but the input files must be kept where they are relative
+        to the merged file. This requires HDF5 1.10, and *io_options* are
+        not used.
+    block_size : integer, default 1048576
+        The number of elements of each dataset which are copied at a time,
+        which bounds the memory used to merge the files.
 
     Examples
     --------
@@ -108,48 +280,95 @@ def merge_files(input_files, output_file, clobber=False,
     -----
     Currently, to merge files it is mandated that all of the parameters have the
     same values, with the exception of the exposure time parameter "exp_time". If
-    add_exposure_times=False, the maximum exposure time will be used.
+    add_exposure_times=False, the maximum exposure time will be used. Only the
+    datasets which all of the files have are merged, and the summaries of photon
+    files are added together if all of the files have one.
     """
     if os.path.exists(output_file) and not clobber:
         raise IOError("Cannot overwrite existing file %s. " % output_file +
                       "If you want to do this, set clobber=True.")
+    if virtual and not hasattr(h5py, "VirtualLayout"):
+        raise RuntimeError("Merging files into virtual datasets requires h5py 2.9 "
+                           "and HDF5 1.10!")
 
-    f_in = h5py.File(input_files[0], "r")
-    f_out = h5py.File(output_file, "w")
+    if io_options is None:
+        io_options = HDF5Options()
 
+    # The first pass only reads the parameters and the shapes and types
+    # of the datasets
     exp_time_key = ""
-    p_out = f_out.create_group("parameters")
-    for key, param in f_in["parameters"].items():
-        if key.endswith("exp_time"):
-            exp_time_key = key
-        else:
-            p_out[key] = param.value
-
-    skip = [exp_time_key] if add_exposure_times else []
-    for fn in input_files[1:]:
-        f = h5py.File(fn, "r")
-        validate_parameters(f_in["parameters"], f["parameters"], skip=skip)
-        f.close()
-
-    f_in.close()
-
-    data = defaultdict(list)
     tot_exp_time = 0.0
-
+    sizes = defaultdict(list)
+    dtypes = defaultdict(list)
+    summaries = []
     for i, fn in enumerate(input_files):
         f = h5py.File(fn, "r")
+        parameters = read_parameter_values(f["parameters"])
+        if i == 0:
+            first_parameters = parameters
+            for key in parameters:
+                if key.endswith("exp_time"):
+                    exp_time_key = key
+        else:
+            skip = [exp_time_key] if add_exposure_times else []
+            validate_parameters(first_parameters, parameters, skip=skip)
         if add_exposure_times:
-            tot_exp_time += f["/parameters"][exp_time_key].value
+            tot_exp_time += parameters[exp_time_key]
         else:
-            tot_exp_time = max(tot_exp_time, f["/parameters"][exp_time_key].value)
-        for key in f["/data"]:
-            data[key].append(f["/data"][key][:])
+            tot_exp_time = max(tot_exp_time, parameters[exp_time_key])
+        for key, dset in f["data"].items():
+            sizes[key].append(dset.shape[0])
+            dtypes[key].append(dset.dtype)
+        if "summary" in f:
+            summaries.append(PhotonSummary.read(f))
         f.close()
 
-    p_out["exp_time"] = tot_exp_time
+    keys = [key for key in sizes if len(sizes[key]) == len(input_files)]
+    for key in sizes:
+        if key not in keys:
+            mylog.warning("Not merging the dataset '%s', " % key +
+                          "since not all of the files have it.")
+
+    f_out = h5py.File(output_file, "w")
+
+    p_out = f_out.create_group("parameters")
+    for key, param in first_parameters.items():
+        if key != exp_time_key:
+            p_out[key] = param
+    p_out[exp_time_key] = tot_exp_time
 
     d = f_out.create_group("data")
-    for k in data:
-        d.create_dataset(k, data=np.concatenate(data[k]))
+    for key in keys:
+        size = sum(sizes[key])
+        dtype = np.result_type(*dtypes[key])
+        if virtual:
+            disps = np.insert(np.cumsum(sizes[key]), 0, 0)[:-1]
+            write_virtual_dataset(d, key, dtype, input_files, sizes[key], disps)
+        else:
+            d.create_dataset(key, (size,), dtype=io_options.get_dtype(dtype),
+                             **io_options.get_dataset_kwargs(size, resizable=True))
+
+    if not virtual:
+        # Each dataset is copied a block at a time into its place in the
+        # merged one, so only one block is held in memory
+        starts = dict((key, 0) for key in keys)
+        for fn in input_files:
+            with h5py.File(fn, "r") as f:
+                for key in keys:
+                    dset_in = f["data"][key]
+                    dset_out = d[key]
+                    n = dset_in.shape[0]
+                    start = starts[key]
+                    for i in range(0, n, block_size):
+                        j = min(i+block_size, n)
+                        dset_out[start+i:start+j] = dset_in[i:j]
+                    starts[key] += n
+
+    # The summaries of photon files are added together, if they all have one
+    if summaries and len(summaries) == len(input_files):
+        summary = summaries[0]
+        for other in summaries[1:]:
+            summary.add_summary(other)
+        summary.write(f_out)
 
     f_out.close()